@@ -0,0 +1,78 @@
+import json
+import logging
+import os
+import platform
+import time
+
+# Host profile: the runtime settings autotune.py measured as fastest on this
+# machine, one section per runtime. Servers read their section at startup;
+# environment variables still take precedence over it. Used by the llama.cpp
+# server in docker/ and the ONNX server in microsoft/.
+HOST_PROFILE = os.getenv("HOST_PROFILE", "host_profile.json")
+
+
+def cpu_model():
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or platform.machine()
+
+
+def fingerprint():
+    # A profile only applies to the kind of machine it was measured on
+    return {"cpu_model": cpu_model(), "cpus": os.cpu_count()}
+
+
+def available_cpus():
+    # CPUs this process may run on, which is fewer than the host has when it
+    # is pinned (router.py workers, docker --cpuset-cpus)
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def read(path=HOST_PROFILE):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def load(section, path=HOST_PROFILE):
+    # Settings of one section, or {} when there is no profile for this host
+    profile = read(path)
+    if profile is None:
+        return {}
+    if profile.get("host") != fingerprint():
+        logging.warning(f"Ignoring {path}: measured on {profile.get('host')}, this host is {fingerprint()}")
+        return {}
+    settings = dict(profile.get(section, {}).get("settings", {}))
+    # Thread counts are capped at the CPUs this process can actually use
+    for name, value in settings.items():
+        if name.endswith("threads"):
+            settings[name] = min(value, available_cpus())
+    if settings:
+        logging.info(f"Using {section} settings from {path}: {settings}")
+    return settings
+
+
+def save(section, settings, measurements, path=HOST_PROFILE):
+    # Replace one section, keeping the others if they were measured here
+    profile = read(path)
+    if profile is None or profile.get("host") != fingerprint():
+        profile = {"host": fingerprint()}
+    profile[section] = {
+        "settings": settings,
+        "measured_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "measurements": measurements,
+    }
+    with open(path + ".tmp", "w") as f:
+        json.dump(profile, f, indent=2)
+    os.replace(path + ".tmp", path)
+    return profile
@@ -0,0 +1,78 @@
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+# The one set of metrics for every server (the llama.cpp FastAPI app in
+# docker/, the Flask apps and the Gradio vision app in microsoft/), so names
+# and buckets match and one dashboard covers all of them. A server only
+# exports what it observes. Process RSS and CPU come from prometheus_client's
+# default process collector (process_resident_memory_bytes etc).
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+QUEUE_WAIT = Histogram("llm_queue_wait_seconds", "Time a request waited before generation started", buckets=LATENCY_BUCKETS)
+TOKENIZE = Histogram("llm_tokenize_seconds", "Time spent tokenizing the prompt", buckets=LATENCY_BUCKETS)
+PREFILL = Histogram("llm_prefill_seconds", "Prompt processing time up to the first generated token", buckets=LATENCY_BUCKETS)
+DECODE = Histogram("llm_decode_seconds", "Time spent generating tokens after the first", buckets=LATENCY_BUCKETS)
+TIME_TO_FIRST_TOKEN = Histogram("llm_time_to_first_token_seconds", "Request arrival to first generated token", buckets=LATENCY_BUCKETS)
+DECODE_RATE = Histogram("llm_decode_tokens_per_second", "Per-request decode speed", buckets=RATE_BUCKETS)
+
+PROMPT_TOKENS = Counter("llm_prompt_tokens", "Prompt tokens processed")
+COMPLETION_TOKENS = Counter("llm_completion_tokens", "Tokens generated")
+
+IN_FLIGHT = Gauge("llm_requests_in_flight", "Requests currently generating")
+QUEUE_DEPTH = Gauge("llm_queue_depth", "Requests waiting to start generating")
+CACHE_HIT_RATE = Gauge("llm_cache_hit_rate", "Hit rate of each cache since startup", ["cache"])
+COALESCED_REQUESTS = Counter("llm_coalesced_requests", "Requests served by joining an identical generation already in flight")
+
+# Vision: image preprocessing, and KV memory reserved under the KV budget
+IMAGE_PREPROCESS = Histogram("llm_image_preprocess_seconds", "Time spent loading and preprocessing the image", buckets=LATENCY_BUCKETS)
+KV_RESERVED = Gauge("llm_kv_reserved_bytes", "KV cache memory reserved by running requests")
+
+# Speculative decoding; accepted over drafted tokens is the acceptance rate
+DRAFT_TOKENS = Counter("llm_speculative_draft_tokens", "Tokens drafted for verification by the target model")
+ACCEPTED_TOKENS = Counter("llm_speculative_accepted_tokens", "Drafted tokens accepted by the target model")
+TOKENS_PER_PASS = Histogram(
+    "llm_speculative_tokens_per_pass",
+    "Tokens generated per target model forward pass",
+    buckets=(1, 1.25, 1.5, 2, 2.5, 3, 4, 6, 8),
+)
+
+
+def observe_generation(tokenize, prefill, decode, prompt_tokens, completion_tokens):
+    # Per-stage timings of one finished generation, in seconds. tokenize is
+    # None when it was already observed elsewhere.
+    if tokenize is not None:
+        TOKENIZE.observe(tokenize)
+    PREFILL.observe(prefill)
+    DECODE.observe(decode)
+    PROMPT_TOKENS.inc(prompt_tokens)
+    COMPLETION_TOKENS.inc(completion_tokens)
+    if completion_tokens > 1 and decode > 0:
+        DECODE_RATE.observe((completion_tokens - 1) / decode)
+
+
+def observe_request(request):
+    # Timings of a finished batcher.BatchRequest
+    if request.started_at is None or request.finished_at is None:
+        return
+    QUEUE_WAIT.observe(request.started_at - request.submitted_at)
+    first_token_at = request.first_token_at or request.finished_at
+    if request.first_token_at is not None:
+        TIME_TO_FIRST_TOKEN.observe(request.first_token_at - request.submitted_at)
+    observe_generation(
+        tokenize=request.tokenize_time,
+        prefill=first_token_at - request.started_at,
+        decode=request.finished_at - first_token_at,
+        prompt_tokens=request.prompt_tokens,
+        completion_tokens=request.completion_tokens,
+    )
+
+
+def hit_rate(hits, misses):
+    lookups = hits + misses
+    return hits / lookups if lookups else 0.0
+
+
+def render():
+    # Body and content type for the /metrics response
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,91 @@
+import argparse
+import statistics
+import time
+
+import host_profile
+
+# Helpers shared by the autotune.py scripts: each sweeps its runtime's
+# settings on a synthetic prompt, keeps the median prefill and decode speed
+# of every setting and saves the fastest to its host profile section.
+
+# Plain text long enough to tokenize into any prompt length we test
+FILLER = (
+    "The history of computing is a story of layers: vacuum tubes gave way to transistors, "
+    "transistors to integrated circuits, and each generation of hardware made room for new "
+    "abstractions in software, from assembly language to compilers, operating systems and networks. "
+)
+
+
+def thread_counts(limit):
+    # Powers of two plus a few fractions of the CPUs available
+    counts = {limit, max(limit // 2, 1), max(limit * 3 // 4, 1)}
+    n = 1
+    while n < limit:
+        counts.add(n)
+        n *= 2
+    return sorted(counts)
+
+
+def parse_ints(text):
+    return [int(value) for value in text.split(",")] if text else None
+
+
+def positive_int(text):
+    # argparse type for the token and repeat counts, which every sweep divides
+    # by or takes the median over
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return value
+
+
+def build_prompt(tokenize, n_tokens):
+    # n_tokens of FILLER; tokenize turns text into a list of token ids
+    text = FILLER
+    tokens = tokenize(text)
+    while len(tokens) < n_tokens:
+        text += FILLER
+        tokens = tokenize(text)
+    return tokens[:n_tokens]
+
+
+def tokens_per_second(n_tokens, start):
+    # start is the time.perf_counter() reading taken before the work
+    return n_tokens / (time.perf_counter() - start)
+
+
+def summarize(settings, prefill_rates, decode_rates):
+    # One measurement as stored in the host profile: the settings plus the
+    # median rates (decode only when it was timed)
+    result = dict(settings, prefill_tokens_per_second=statistics.median(prefill_rates))
+    if decode_rates:
+        result["decode_tokens_per_second"] = statistics.median(decode_rates)
+    return result
+
+
+def report(settings, result):
+    line = f"{settings}: prefill {result['prefill_tokens_per_second']:.1f} tok/s"
+    if "decode_tokens_per_second" in result:
+        line += f", decode {result['decode_tokens_per_second']:.2f} tok/s"
+    if "request_seconds" in result:
+        line += f", request {result['request_seconds']:.2f} s"
+    print(line)
+
+
+def argument_parser(description, model, prompt_tokens):
+    # The options every autotune script takes; each adds its own sweep
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--model", default=model)
+    parser.add_argument("--prompt-tokens", type=positive_int, default=prompt_tokens, help="Prompt length used to time prefill")
+    parser.add_argument("--decode-tokens", type=positive_int, default=64, help="Tokens generated to time decode")
+    parser.add_argument("--repeats", type=positive_int, default=3)
+    parser.add_argument("--output", default=host_profile.HOST_PROFILE, help="Host profile to update")
+    parser.add_argument("--dry-run", action="store_true", help="Print the result without writing the profile")
+    return parser
+
+
+def save(section, settings, measurements, args):
+    print(f"Fastest on this host: {settings}")
+    if not args.dry_run:
+        host_profile.save(section, settings, measurements, args.output)
+        print(f"Wrote {args.output}")
@@ -1,24 +1,223 @@
+import os
+import json
+import random
+import sys
+import time
 from fastapi import FastAPI
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from typing import Optional
 from pydantic import BaseModel
 from llama_cpp import Llama
 import logging
 
+# host_profile.py and metrics.py are shared with microsoft/ and live in
+# ../common; the image copies them into /app
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+import host_profile
+import metrics
+from prefix_cache import PrefixCache
+from scheduler import InferenceScheduler, QueueFullError
+from single_flight import SingleFlight
+
 app = FastAPI()
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 
-# Initialize the model
-llm = Llama(
-    model_path="./Phi-3-mini-4k-instruct-q4.gguf",
-    n_ctx=4096,
-    n_threads=8,
-    n_gpu_layers=0,  # Set to 0 if running on CPU
-)
+# Inference scheduling: each worker thread owns one Llama instance. The GGUF
+# file is mmapped, so extra workers share the weight pages and only add their
+# own KV cache.
+WORKERS = int(os.getenv("LLAMA_WORKERS", "1"))
+QUEUE_SIZE = int(os.getenv("LLAMA_QUEUE_SIZE", "16"))
+
+# Threads and batch sizes come from the host profile written by autotune.py
+# when there is one; the LLAMA_* variables override it. n_threads is used
+# for decoding, n_threads_batch for the prompt.
+tuned = host_profile.load("llama_cpp")
+N_CTX = int(os.getenv("LLAMA_CTX", "4096"))
+N_THREADS = int(os.getenv("LLAMA_THREADS", tuned.get("n_threads", 8)))
+N_THREADS_BATCH = int(os.getenv("LLAMA_THREADS_BATCH", tuned.get("n_threads_batch", N_THREADS)))
+N_BATCH = int(os.getenv("LLAMA_BATCH", tuned.get("n_batch", 512)))
+N_UBATCH = int(os.getenv("LLAMA_UBATCH", tuned.get("n_ubatch", 512)))
+
+# Prompt-prefix KV reuse: the KV state of the system preamble is snapshotted
+# per worker and restored before prefill, within a byte budget per worker.
+SYSTEM_PROMPT = os.getenv("LLAMA_SYSTEM_PROMPT", "")
+PREFIX_CACHE_BYTES = int(os.getenv("LLAMA_PREFIX_CACHE_BYTES", str(1 << 30)))
+PREFIX_MIN_TOKENS = int(os.getenv("LLAMA_PREFIX_MIN_TOKENS", "32"))
+
+# Cold start: the GGUF file is mmapped by default so weights are paged in on
+# demand (LLAMA_MLOCK=1 pins them in RAM). Each worker then runs
+# WARMUP_PROMPTS short generations before it reports ready.
+USE_MMAP = os.getenv("LLAMA_MMAP", "1") != "0"
+USE_MLOCK = os.getenv("LLAMA_MLOCK", "0") == "1"
+WARMUP_PROMPT = "Hello! Introduce yourself in one sentence."
+WARMUP_PROMPTS = int(os.getenv("WARMUP_PROMPTS", "1"))
+WARMUP_TOKENS = int(os.getenv("WARMUP_TOKENS", "8"))
+
+# llama.cpp NUMA strategy: 0 off, 1 distribute, 2 isolate, 3 follow numactl.
+# router.py sets 3 for workers it starts under numactl.
+NUMA = int(os.getenv("LLAMA_NUMA", "0"))
+
+# Sampling: requests may send their own temperature; LLAMA_TEMPERATURE is
+# the default (0.8 is llama.cpp's). Temperature 0 decodes greedily.
+TEMPERATURE = float(os.getenv("LLAMA_TEMPERATURE", "0.8"))
+MAX_TOKENS = 512
+STOP = ["<|end|>"]
+
+# Greedy requests for a prompt that is already generating join that
+# generation and share its tokens instead of queueing their own; sampled
+# requests always generate, since each should get its own sample.
+# SINGLE_FLIGHT=0 turns this off.
+SINGLE_FLIGHT = os.getenv("SINGLE_FLIGHT", "1") != "0"
+
+# Full prompts and outputs are only logged for this fraction of requests
+LOG_PAYLOAD_RATE = float(os.getenv("LOG_PAYLOAD_RATE", "0"))
+
+prefix_caches = []
+load_timings = []
+
+
+# Initialize the model. Runs on each worker thread.
+def load_model():
+    timings = {}
+    start = time.perf_counter()
+    llm = Llama(
+        model_path="./Phi-3-mini-4k-instruct-q4.gguf",
+        n_ctx=N_CTX,
+        n_threads=N_THREADS,
+        n_threads_batch=N_THREADS_BATCH,
+        n_batch=N_BATCH,
+        n_ubatch=N_UBATCH,
+        n_gpu_layers=0,  # Set to 0 if running on CPU
+        use_mmap=USE_MMAP,
+        use_mlock=USE_MLOCK,
+        numa=NUMA,
+    )
+    timings["model"] = round(time.perf_counter() - start, 3)
+    prefix_cache = PrefixCache(PREFIX_CACHE_BYTES, min_tokens=PREFIX_MIN_TOKENS)
+    worker = (llm, prefix_cache)
+
+    # Warmup touches the mmapped weights and, with a system prompt set,
+    # leaves its KV snapshot in the prefix cache for the first request
+    start = time.perf_counter()
+    for _ in range(WARMUP_PROMPTS):
+        prefix, formatted_prompt = format_prompt(WARMUP_PROMPT)
+        restore_prefix(llm, prefix_cache, prefix, formatted_prompt)
+        llm(formatted_prompt, max_tokens=WARMUP_TOKENS, echo=False)
+    timings["warmup"] = round(time.perf_counter() - start, 3)
+
+    prefix_caches.append(prefix_cache)
+    load_timings.append(timings)
+    logging.info(f"Model worker ready: {timings}")
+    return worker
+
+
+scheduler = InferenceScheduler(load_model, workers=WORKERS, max_queue=QUEUE_SIZE)
+single_flight = SingleFlight()
 
 
 class Item(BaseModel):
     prompt: str
+    system: Optional[str] = None
+    temperature: Optional[float] = None
+
+
+def format_prompt(prompt, system=None):
+    # Format the prompt according to the model schema. The system block is
+    # returned separately as the prefix whose KV state can be reused.
+    system = SYSTEM_PROMPT if system is None else system
+    prefix = f"<|system|>\n{system}<|end|>\n" if system else ""
+    return prefix, f"{prefix}<|user|>\n{prompt}\n<|end|>\n<|assistant|>"
+
+
+def restore_prefix(llm, prefix_cache, prefix, formatted_prompt):
+    if not prefix or PREFIX_CACHE_BYTES <= 0:
+        return 0
+    return prefix_cache.prepare(llm, prefix, formatted_prompt)
+
+
+def generate(worker, emit, prefix, formatted_prompt, temperature):
+    # Stream a completion through emit(text), recording per-stage metrics.
+    # Returns the usage and when the first token was produced.
+    llm, prefix_cache = worker
+    start = time.perf_counter()
+    prompt_tokens = len(llm.tokenize(formatted_prompt.encode("utf-8"), special=True))
+    tokenized_at = time.perf_counter()
+    cached_tokens = restore_prefix(llm, prefix_cache, prefix, formatted_prompt)
+
+    first_token_at = None
+    completion_tokens = 0
+    for chunk in llm(formatted_prompt, max_tokens=MAX_TOKENS, stop=STOP, temperature=temperature, echo=False, stream=True):
+        if first_token_at is None:
+            first_token_at = time.perf_counter()
+        completion_tokens += 1
+        if not emit(chunk["choices"][0]["text"]):
+            break
+    end = time.perf_counter()
+
+    metrics.observe_generation(
+        tokenize=tokenized_at - start,
+        prefill=(first_token_at or end) - tokenized_at,
+        decode=end - first_token_at if first_token_at else 0.0,
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+    )
+    usage = {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "cached_tokens": cached_tokens,
+    }
+    return usage, first_token_at
+
+
+def run_streaming_completion(worker, emit, prefix, formatted_prompt, temperature):
+    usage, _ = generate(worker, emit, prefix, formatted_prompt, temperature)
+    return usage
+
+
+def join_generation(prefix, formatted_prompt, temperature):
+    # Queue the completion, or join the identical one already in flight.
+    # Only greedy decoding gives the same output for the same prompt, and
+    # the key holds every setting that shapes it.
+    key = None
+    if SINGLE_FLIGHT and temperature <= 0:
+        key = json.dumps({"prompt": formatted_prompt, "max_tokens": MAX_TOKENS, "stop": STOP, "temperature": 0})
+    return single_flight.join(
+        key,
+        lambda: scheduler.submit_stream(run_streaming_completion, prefix, formatted_prompt, temperature),
+    )
+
+
+def request_temperature(item):
+    return TEMPERATURE if item.temperature is None else item.temperature
+
+
+def log_payload(message):
+    if LOG_PAYLOAD_RATE > 0 and random.random() < LOG_PAYLOAD_RATE:
+        logging.info(message)
+
+
+def sse_event(data, event=None):
+    message = f"event: {event}\n" if event else ""
+    return message + f"data: {json.dumps(data)}\n\n"
+
+
+def not_ready_response():
+    return JSONResponse(
+        status_code=503,
+        content={"error": "Model is not ready"},
+        headers={"Retry-After": "5"},
+    )
+
+
+def busy_response():
+    return JSONResponse(
+        status_code=503,
+        content={"error": "Server busy, try again later"},
+        headers={"Retry-After": "1"},
+    )
 
 
 @app.post("/predict")
@@ -27,30 +226,168 @@ async def predict(item: Item):
     if not prompt:
         logging.info("No prompt provided")
         return {"error": "No prompt provided"}
+    if not scheduler.ready():
+        return not_ready_response()
 
-    # Format the prompt according to the model schema
-    formatted_prompt = f"<|user|>\n{prompt}\n<|end|>\n<|assistant|>"
+    prefix, formatted_prompt = format_prompt(prompt, item.system)
 
-    logging.info(f"Received prompt: {formatted_prompt}")
+    log_payload(f"Received prompt: {formatted_prompt}")
 
-    # Run the model
-    output = llm(formatted_prompt, max_tokens=512, stop=["<|end|>"], echo=False)
-    logging.info(f"Model output: {output}")
+    # Queue the request for a worker instead of running the model on the event loop
+    arrived_at = time.perf_counter()
+    try:
+        flight, started = join_generation(prefix, formatted_prompt, request_temperature(item))
+    except QueueFullError as e:
+        logging.warning(str(e))
+        return busy_response()
 
-    # Extract usage and completion times
-    usage = output.get("usage", {})
-    prompt_tokens = usage.get("prompt_tokens", 0)
-    completion_tokens = usage.get("completion_tokens", 0)
-    total_tokens = usage.get("total_tokens", 0)
+    pieces = []
+    first_token_at = None
+    try:
+        async for text in flight.stream():
+            if first_token_at is None:
+                first_token_at = time.perf_counter()
+            pieces.append(text)
+    finally:
+        flight.leave()
+    output = "".join(pieces)
+    log_payload(f"Model output: {output}")
 
-    # Add timings to the response
+    job = flight.job
+    if started:
+        metrics.QUEUE_WAIT.observe(job.queue_wait)
+    if first_token_at:
+        metrics.TIME_TO_FIRST_TOKEN.observe(first_token_at - arrived_at)
+
+    # Add usage and timings to the response
     response = {
-        "response": output["choices"][0]["text"],
-        "usage": {
-            "prompt_tokens": prompt_tokens,
-            "completion_tokens": completion_tokens,
-            "total_tokens": total_tokens,
+        "response": output,
+        "usage": flight.usage,
+        "timings": {
+            "queue_wait": round(job.queue_wait, 4),
+            "inference": round(job.run_time, 4),
         },
     }
+    if not started:
+        response["coalesced"] = True
 
     return response
+
+
+@app.post("/predict/stream")
+async def predict_stream(item: Item):
+    prompt = item.prompt
+    if not prompt:
+        logging.info("No prompt provided")
+        return {"error": "No prompt provided"}
+    if not scheduler.ready():
+        return not_ready_response()
+
+    prefix, formatted_prompt = format_prompt(prompt, item.system)
+    log_payload(f"Received prompt: {formatted_prompt}")
+
+    arrived_at = time.perf_counter()
+    try:
+        flight, started = join_generation(prefix, formatted_prompt, request_temperature(item))
+    except QueueFullError as e:
+        logging.warning(str(e))
+        return busy_response()
+    job = flight.job
+
+    # Send each token as a Server-Sent Event as soon as the worker produces it,
+    # then a final event with token usage and timings. A request that joined
+    # a generation in flight first gets the tokens produced so far.
+    async def events():
+        first_token_at = None
+        try:
+            async for text in flight.stream():
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                    if started:
+                        metrics.QUEUE_WAIT.observe(job.queue_wait)
+                    metrics.TIME_TO_FIRST_TOKEN.observe(first_token_at - arrived_at)
+                yield sse_event({"token": text})
+            usage = flight.usage
+        except Exception as e:
+            yield sse_event({"error": str(e)}, event="error")
+            return
+        finally:
+            flight.leave()
+
+        decode_time = job.finished_at - first_token_at if first_token_at else 0.0
+        yield sse_event(
+            {
+                "usage": usage,
+                "timings": {
+                    "queue_wait": round(job.queue_wait, 4),
+                    "time_to_first_token": round(first_token_at - arrived_at, 4) if first_token_at else None,
+                    "inference": round(job.run_time, 4),
+                    "tokens_per_second": round(usage["completion_tokens"] / decode_time, 2) if decode_time > 0 else None,
+                },
+                "coalesced": not started,
+            },
+            event="done",
+        )
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.get("/stats")
+async def stats():
+    stats = scheduler.stats()
+    stats["prefix_cache"] = [prefix_cache.stats() for prefix_cache in prefix_caches]
+    stats["load_timings"] = load_timings
+    stats["single_flight"] = single_flight.stats()
+    stats["llama_settings"] = {
+        "n_ctx": N_CTX,
+        "n_threads": N_THREADS,
+        "n_threads_batch": N_THREADS_BATCH,
+        "n_batch": N_BATCH,
+        "n_ubatch": N_UBATCH,
+    }
+    return stats
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    body, content_type = metrics.render()
+    return Response(content=body, media_type=content_type)
+
+
+def prefix_cache_hit_rate():
+    stats = [prefix_cache.stats() for prefix_cache in prefix_caches]
+    return metrics.hit_rate(sum(s["hits"] for s in stats), sum(s["misses"] for s in stats))
+
+
+# Computed on scrape. Multiprocess mode can't record these, so under
+# router.py the router rebuilds them from each worker's /stats.
+metrics.IN_FLIGHT.set_function(lambda: scheduler.stats()["in_flight"])
+metrics.QUEUE_DEPTH.set_function(lambda: scheduler.stats()["queue_depth"])
+metrics.CACHE_HIT_RATE.labels(cache="prefix").set_function(prefix_cache_hit_rate)
+
+
+# Liveness: the process is up and no worker failed to load its model
+@app.get("/healthz")
+async def healthz():
+    if scheduler.load_error:
+        return JSONResponse(status_code=500, content={"status": "failed", "error": scheduler.load_error})
+    return {"status": "ok"}
+
+
+# Readiness: every worker has loaded and warmed up its model
+@app.get("/ready")
+async def ready():
+    status = {
+        "status": "ready" if scheduler.ready() else "loading",
+        "ready_workers": scheduler.stats()["ready_workers"],
+        "workers": WORKERS,
+        "load_timings": load_timings,
+    }
+    if scheduler.load_error:
+        status.update(status="failed", error=scheduler.load_error)
+    return JSONResponse(status_code=200 if scheduler.ready() else 503, content=status)
+
+
+# Models load on the worker threads, so the server starts answering
+# /healthz right away
+scheduler.start()
@@ -0,0 +1,97 @@
+import os
+import sys
+import time
+
+from llama_cpp import Llama
+
+# host_profile and tuning are shared with microsoft/ and live in ../common
+# (the image copies them into /app)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+import host_profile
+import tuning
+
+# Finds the llama.cpp settings that are fastest on this host and writes them
+# to the host profile app.py reads at startup. Prefill and decode are timed
+# separately because llama.cpp runs them with separate thread counts:
+# n_threads_batch for the prompt, n_threads for each generated token.
+#
+#   1. threads: every candidate count is used for both, and the fastest
+#      prefill and fastest decode are kept independently
+#   2. batch: n_batch x n_ubatch is swept for prefill at the chosen
+#      n_threads_batch (n_ubatch is the chunk computed at once, n_batch the
+#      tokens handed to llama_decode per call)
+MODEL_PATH = "./Phi-3-mini-4k-instruct-q4.gguf"
+N_CTX = int(os.getenv("LLAMA_CTX", "4096"))
+
+
+def build_prompt(model_path, n_tokens):
+    vocab = Llama(model_path=model_path, vocab_only=True, verbose=False)
+    return tuning.build_prompt(lambda text: vocab.tokenize(text.encode("utf-8")), n_tokens)
+
+
+def measure(model_path, settings, prompt, decode_tokens, repeats):
+    # Median prefill and decode speed, in tokens per second, of one setting
+    llm = Llama(model_path=model_path, n_ctx=N_CTX, n_gpu_layers=0, verbose=False, **settings)
+    llm.eval(prompt[:16])
+
+    prefill_rates = []
+    decode_rates = []
+    for _ in range(repeats):
+        llm.reset()
+        start = time.perf_counter()
+        llm.eval(prompt)
+        prefill_rates.append(tuning.tokens_per_second(len(prompt), start))
+
+        if decode_tokens:
+            token = llm.sample(temp=0.0)
+            start = time.perf_counter()
+            for _ in range(decode_tokens):
+                llm.eval([token])
+                token = llm.sample(temp=0.0)
+            decode_rates.append(tuning.tokens_per_second(decode_tokens, start))
+    del llm
+
+    result = tuning.summarize(settings, prefill_rates, decode_rates)
+    tuning.report(settings, result)
+    return result
+
+
+def main():
+    parser = tuning.argument_parser(
+        "Sweep llama.cpp threads and batch sizes and save the fastest to the host profile", MODEL_PATH, 1024,
+    )
+    parser.add_argument("--threads", help="Comma-separated thread counts (default: derived from the CPUs available)")
+    parser.add_argument("--batch-sizes", default="256,512,1024,2048", help="Comma-separated n_batch values")
+    parser.add_argument("--ubatch-sizes", default="128,256,512", help="Comma-separated n_ubatch values")
+    args = parser.parse_args()
+
+    if args.prompt_tokens + args.decode_tokens > N_CTX:
+        parser.error(f"--prompt-tokens + --decode-tokens must fit in the {N_CTX}-token context (LLAMA_CTX)")
+
+    prompt = build_prompt(args.model, args.prompt_tokens)
+    threads = tuning.parse_ints(args.threads) or tuning.thread_counts(host_profile.available_cpus())
+
+    measurements = []
+    for n in threads:
+        measurements.append(measure(
+            args.model, {"n_threads": n, "n_threads_batch": n}, prompt, args.decode_tokens, args.repeats,
+        ))
+    n_threads = max(measurements, key=lambda m: m["decode_tokens_per_second"])["n_threads"]
+    n_threads_batch = max(measurements, key=lambda m: m["prefill_tokens_per_second"])["n_threads_batch"]
+
+    batch_runs = []
+    for n_batch in tuning.parse_ints(args.batch_sizes):
+        for n_ubatch in tuning.parse_ints(args.ubatch_sizes):
+            if n_ubatch > n_batch:
+                continue
+            settings = {"n_threads": n_threads, "n_threads_batch": n_threads_batch, "n_batch": n_batch, "n_ubatch": n_ubatch}
+            batch_runs.append(measure(args.model, settings, prompt, 0, args.repeats))
+    measurements += batch_runs
+    best = max(batch_runs, key=lambda m: m["prefill_tokens_per_second"])
+
+    settings = {name: best[name] for name in ("n_threads", "n_threads_batch", "n_batch", "n_ubatch")}
+    tuning.save("llama_cpp", settings, measurements, args)
+
+
+if __name__ == "__main__":
+    main()
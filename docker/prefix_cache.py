@@ -0,0 +1,98 @@
+from collections import OrderedDict
+
+from llama_cpp import Llama
+
+
+class PrefixCache:
+    # LRU of llama.cpp state snapshots keyed by prompt-prefix tokens. Before a
+    # completion, the longest cached prefix of the prompt is loaded back into
+    # the context, so llama.cpp only has to prefill the tokens after it.
+    #
+    # A cache belongs to a single Llama instance (one per worker) and is not
+    # thread-safe.
+    def __init__(self, capacity_bytes, min_tokens=32):
+        self.capacity_bytes = capacity_bytes
+        self.min_tokens = min_tokens
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def longest_prefix(self, tokens):
+        best = None
+        for key in self._entries:
+            if len(key) <= len(tokens) and (best is None or len(key) > len(best)):
+                if Llama.longest_token_prefix(key, tokens) == len(key):
+                    best = key
+        return best
+
+    def prepare(self, llm, prefix_text, prompt_text):
+        # Make sure the context starts with the KV state for prefix_text,
+        # either by restoring a snapshot or by evaluating and snapshotting it.
+        # Returns the number of prompt tokens that need no prefill.
+        tokens = llm.tokenize(prompt_text.encode("utf-8"), special=True)
+        prefix = llm.tokenize(prefix_text.encode("utf-8"), special=True)
+        # Tokenizing the prefix on its own can split the last token
+        # differently from the full prompt; only keep what matches.
+        prefix = tuple(tokens[:Llama.longest_token_prefix(prefix, tokens)])
+        # Leave at least one prompt token for llama.cpp to evaluate
+        if len(prefix) >= len(tokens):
+            prefix = prefix[:len(tokens) - 1]
+
+        current = Llama.longest_token_prefix(llm._input_ids.tolist(), tokens)
+
+        key = self.longest_prefix(tokens)
+        if key is not None:
+            self._entries.move_to_end(key)
+            if len(key) > current:
+                llm.load_state(self._entries[key])
+                current = len(key)
+            if len(key) >= len(prefix):
+                self.hits += 1
+                self.reused_tokens += current
+                return current
+
+        self.misses += 1
+        self.reused_tokens += current
+        if len(prefix) < self.min_tokens:
+            return current
+
+        # Evaluate the missing part of the prefix and snapshot it; the
+        # completion that follows picks it up through llama.cpp's own
+        # prefix matching against the tokens already in the context.
+        if current < len(prefix):
+            llm.n_tokens = current
+            llm.eval(list(prefix[current:]))
+            self._insert(prefix, llm.save_state())
+        else:
+            # The context already holds the prefix and more; snapshot only
+            # the prefix without giving up the rest of the match.
+            llm.n_tokens = len(prefix)
+            state = llm.save_state()
+            llm.n_tokens = current
+            self._insert(prefix, state)
+        return current
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "size_bytes": self.size_bytes,
+            "capacity_bytes": self.capacity_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "reused_tokens": self.reused_tokens,
+        }
+
+    def _insert(self, key, state):
+        size = state.llama_state_size
+        if size > self.capacity_bytes:
+            return
+        self._entries[key] = state
+        self.size_bytes += size
+        while self.size_bytes > self.capacity_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size_bytes -= evicted.llama_state_size
@@ -0,0 +1,364 @@
+import asyncio
+import itertools
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, generate_latest, multiprocess
+from prometheus_client.core import GaugeMetricFamily
+
+# Multi-process mode: `uvicorn router:app` starts ROUTER_PROCESSES copies of
+# app.py, each in its own process with its own llama.cpp context and thread
+# pool, and forwards every request to the worker with the fewest requests in
+# flight. The workers mmap the same GGUF file, so the weights sit in the page
+# cache once however many workers there are; each only adds its KV cache.
+#
+# Pinning: ROUTER_CPUS gives each worker a CPU list ("0-7;8-15"), or "auto"
+# to split this process's CPUs evenly. ROUTER_NUMA_NODES ("0;1") binds each
+# worker to a NUMA node instead: its CPUs, and its memory with numactl when
+# that is installed. LLAMA_THREADS defaults to the number of CPUs a worker
+# gets.
+PROCESSES = int(os.getenv("ROUTER_PROCESSES", "2"))
+CPUS = os.getenv("ROUTER_CPUS", "")
+NUMA_NODES = os.getenv("ROUTER_NUMA_NODES", "")
+HEALTH_INTERVAL = float(os.getenv("ROUTER_HEALTH_INTERVAL", "2"))
+RESTART_DELAY = float(os.getenv("ROUTER_RESTART_DELAY", "5"))
+
+logging.basicConfig(level=logging.INFO)
+
+# Router metrics live in their own registry; the workers' counters and
+# histograms are merged from PROMETHEUS_MULTIPROC_DIR. The workers' gauges
+# are computed when read (set_function), which multiprocess mode can't
+# record, so the router builds those from each worker's /stats instead.
+LIVE_GAUGES = {"llm_requests_in_flight", "llm_queue_depth", "llm_cache_hit_rate", "process_resident_memory_bytes"}
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+registry = CollectorRegistry()
+WORKER_IN_FLIGHT = Gauge("llm_router_in_flight", "Requests forwarded to each worker and not yet finished", ["worker"], registry=registry)
+WORKER_REQUESTS = Counter("llm_router_requests", "Requests forwarded to each worker", ["worker"], registry=registry)
+
+
+def parse_cpu_list(text):
+    # "0-3,8" -> [0, 1, 2, 3, 8]
+    cpus = []
+    for part in text.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        low, _, high = part.partition("-")
+        cpus.extend(range(int(low), int(high or low) + 1))
+    return cpus
+
+
+def node_cpus(node):
+    with open(f"/sys/devices/system/node/node{node}/cpulist") as f:
+        return parse_cpu_list(f.read())
+
+
+def placements(count):
+    # (cpus, numa node) of each worker; None means unpinned
+    if NUMA_NODES:
+        nodes = [int(node) for node in NUMA_NODES.split(";")]
+        return [(node_cpus(nodes[i % len(nodes)]), nodes[i % len(nodes)]) for i in range(count)]
+    if CPUS == "auto":
+        available = sorted(os.sched_getaffinity(0))
+        share = max(len(available) // count, 1)
+        return [(available[i * share:(i + 1) * share] or available, None) for i in range(count)]
+    if CPUS:
+        lists = CPUS.split(";")
+        return [(parse_cpu_list(lists[i % len(lists)]), None) for i in range(count)]
+    return [(None, None)] * count
+
+
+class Worker:
+    # One app.py process listening on a unix socket
+    def __init__(self, index, socket_path, cpus=None, numa_node=None):
+        self.index = index
+        self.name = str(index)
+        self.socket_path = socket_path
+        self.cpus = cpus
+        self.numa_node = numa_node
+        self.process = None
+        self.started_at = None
+        self.ready = False
+        self.in_flight = 0
+        self.client = httpx.AsyncClient(
+            transport=httpx.AsyncHTTPTransport(uds=socket_path),
+            base_url="http://worker",
+            timeout=httpx.Timeout(None, connect=5.0),
+        )
+
+    def start(self, metrics_dir):
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        env = dict(os.environ, LLAMA_WORKERS="1", PROMETHEUS_MULTIPROC_DIR=metrics_dir)
+        if self.cpus and "LLAMA_THREADS" not in os.environ:
+            env["LLAMA_THREADS"] = str(len(self.cpus))
+        command = [sys.executable, "-m", "uvicorn", "app:app", "--uds", self.socket_path]
+        if self.numa_node is not None and shutil.which("numactl"):
+            command = ["numactl", f"--cpunodebind={self.numa_node}", f"--membind={self.numa_node}"] + command
+            # Let llama.cpp follow the numactl placement
+            env.setdefault("LLAMA_NUMA", "3")
+
+        cpus = self.cpus
+
+        def pin():
+            if cpus:
+                os.sched_setaffinity(0, cpus)
+
+        # app.py and the GGUF file are found relative to this directory
+        cwd = os.path.dirname(os.path.abspath(__file__))
+        self.process = subprocess.Popen(command, env=env, cwd=cwd, preexec_fn=pin)
+        self.started_at = time.monotonic()
+        self.ready = False
+        logging.info(f"Worker {self.index} started (pid {self.process.pid}, cpus {cpus or 'all'}, numa {self.numa_node})")
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    async def check(self):
+        try:
+            response = await self.client.get("/ready", timeout=2.0)
+            self.ready = response.status_code == 200
+        except httpx.HTTPError:
+            self.ready = False
+
+    def stop(self):
+        if self.alive():
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+
+app = FastAPI()
+workers = []
+metrics_dir = None
+monitor_task = None
+tie_breaker = itertools.count()
+
+
+def pick_worker():
+    # Least requests in flight; ties rotate so idle workers share the load
+    ready = [worker for worker in workers if worker.ready]
+    if not ready:
+        return None
+    offset = next(tie_breaker)
+    return min(ready, key=lambda w: (w.in_flight, (w.index - offset) % len(workers)))
+
+
+async def monitor():
+    # Restart workers that exit and track which ones are ready
+    while True:
+        for worker in workers:
+            if worker.process is not None and not worker.alive():
+                logging.error(f"Worker {worker.index} exited with {worker.process.returncode}")
+                multiprocess.mark_process_dead(worker.process.pid, metrics_dir)
+                worker.ready = False
+                worker.process = None
+                worker.started_at = time.monotonic()
+            elif worker.process is None and time.monotonic() - worker.started_at >= RESTART_DELAY:
+                worker.start(metrics_dir)
+            elif worker.alive():
+                await worker.check()
+        await asyncio.sleep(HEALTH_INTERVAL)
+
+
+@app.on_event("startup")
+async def start_workers():
+    global metrics_dir, monitor_task
+    metrics_dir = tempfile.mkdtemp(prefix="llm-metrics-")
+    socket_dir = tempfile.mkdtemp(prefix="llm-workers-")
+    for index, (cpus, node) in enumerate(placements(PROCESSES)):
+        worker = Worker(index, os.path.join(socket_dir, f"worker-{index}.sock"), cpus, node)
+        worker.start(metrics_dir)
+        WORKER_IN_FLIGHT.labels(worker=worker.name).set_function(lambda w=worker: w.in_flight)
+        workers.append(worker)
+    monitor_task = asyncio.create_task(monitor())
+
+
+@app.on_event("shutdown")
+async def stop_workers():
+    if monitor_task:
+        monitor_task.cancel()
+    for worker in workers:
+        worker.stop()
+        await worker.client.aclose()
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+
+
+def not_ready_response():
+    return JSONResponse(
+        status_code=503,
+        content={"error": "Model is not ready"},
+        headers={"Retry-After": "5"},
+    )
+
+
+async def forward(request, path):
+    worker = pick_worker()
+    if worker is None:
+        return not_ready_response()
+    body = await request.body()
+    headers = {"content-type": request.headers.get("content-type", "application/json")}
+    WORKER_REQUESTS.labels(worker=worker.name).inc()
+
+    # The request counts against the worker from here until its response has
+    # been relayed. Starlette never starts relay() if the client disconnects
+    # first, so done() also runs as the response's background task, and only
+    # the first call has any effect.
+    worker.in_flight += 1
+    upstream = None
+    finished = False
+
+    async def done():
+        nonlocal finished
+        if finished:
+            return
+        finished = True
+        worker.in_flight -= 1
+        if upstream is not None:
+            await upstream.aclose()
+
+    try:
+        upstream = await worker.client.send(
+            worker.client.build_request("POST", path, content=body, headers=headers),
+            stream=True,
+        )
+    except httpx.HTTPError as e:
+        await done()
+        worker.ready = False
+        logging.warning(f"Worker {worker.index} unreachable: {e}")
+        return JSONResponse(status_code=502, content={"error": "Worker unavailable"}, headers={"Retry-After": "1"})
+    except BaseException:
+        await done()
+        raise
+
+    async def relay():
+        # Pass bytes through as they arrive, so token streams stay streamed
+        try:
+            async for chunk in upstream.aiter_raw():
+                yield chunk
+        finally:
+            await done()
+
+    passthrough = {k: v for k, v in upstream.headers.items() if k.lower() in ("retry-after", "content-type")}
+    passthrough["X-Worker"] = worker.name
+    return StreamingResponse(
+        relay(),
+        status_code=upstream.status_code,
+        headers=passthrough,
+        media_type=upstream.headers.get("content-type"),
+        background=BackgroundTask(done),
+    )
+
+
+@app.post("/predict")
+async def predict(request: Request):
+    return await forward(request, "/predict")
+
+
+@app.post("/predict/stream")
+async def predict_stream(request: Request):
+    return await forward(request, "/predict/stream")
+
+
+@app.get("/stats")
+async def stats():
+    per_worker = []
+    for worker in workers:
+        entry = {
+            "worker": worker.index,
+            "pid": worker.process.pid if worker.alive() else None,
+            "cpus": worker.cpus,
+            "numa_node": worker.numa_node,
+            "ready": worker.ready,
+            "in_flight": worker.in_flight,
+        }
+        if worker.ready:
+            try:
+                entry["stats"] = (await worker.client.get("/stats", timeout=2.0)).json()
+            except httpx.HTTPError:
+                pass
+        per_worker.append(entry)
+    return {"processes": PROCESSES, "workers": per_worker}
+
+
+def worker_rss_bytes(worker):
+    try:
+        with open(f"/proc/{worker.process.pid}/statm") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, AttributeError):
+        return None
+
+
+async def live_gauges():
+    # The workers' set_function gauges, rebuilt from their /stats
+    in_flight = GaugeMetricFamily("llm_requests_in_flight", "Requests currently generating", labels=["worker"])
+    queue_depth = GaugeMetricFamily("llm_queue_depth", "Requests waiting to start generating", labels=["worker"])
+    hit_rate = GaugeMetricFamily("llm_cache_hit_rate", "Hit rate of each cache since startup", labels=["cache"])
+    rss = GaugeMetricFamily("process_resident_memory_bytes", "Resident memory size in bytes", labels=["worker"])
+    hits = misses = 0
+    for worker in workers:
+        if not worker.alive():
+            continue
+        memory = worker_rss_bytes(worker)
+        if memory is not None:
+            rss.add_metric([worker.name], memory)
+        if not worker.ready:
+            continue
+        try:
+            stats = (await worker.client.get("/stats", timeout=2.0)).json()
+        except (httpx.HTTPError, ValueError):
+            continue
+        in_flight.add_metric([worker.name], stats["in_flight"])
+        queue_depth.add_metric([worker.name], stats["queue_depth"])
+        hits += sum(cache["hits"] for cache in stats["prefix_cache"])
+        misses += sum(cache["misses"] for cache in stats["prefix_cache"])
+    lookups = hits + misses
+    hit_rate.add_metric(["prefix"], hits / lookups if lookups else 0.0)
+    return [in_flight, queue_depth, hit_rate, rss]
+
+
+class MetricsSnapshot:
+    # Worker metrics for one scrape: counters and histograms summed across
+    # processes, minus the gauges multiprocess mode leaves at zero, which
+    # come from live_gauges() instead
+    def __init__(self, gauges):
+        self.gauges = gauges
+        self.merged = multiprocess.MultiProcessCollector(None, path=metrics_dir)
+
+    def collect(self):
+        for family in self.merged.collect():
+            if family.name not in LIVE_GAUGES:
+                yield family
+        yield from self.gauges
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    snapshot = CollectorRegistry()
+    snapshot.register(MetricsSnapshot(await live_gauges()))
+    return Response(content=generate_latest(snapshot) + generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+
+
+# Liveness: the router is up; dead workers are restarted by the monitor
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok", "workers_alive": sum(worker.alive() for worker in workers)}
+
+
+# Readiness: at least one worker can take requests
+@app.get("/ready")
+async def ready():
+    ready_workers = sum(worker.ready for worker in workers)
+    status = {"status": "ready" if ready_workers else "loading", "ready_workers": ready_workers, "workers": PROCESSES}
+    return JSONResponse(status_code=200 if ready_workers else 503, content=status)
@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import queue
+import threading
+import time
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class Job:
+    # A unit of work waiting for (or running on) a worker thread. Awaiting the
+    # job returns whatever the submitted function returned.
+    def __init__(self, fn, args, loop):
+        self.fn = fn
+        self.args = args
+        self.loop = loop
+        self.future = loop.create_future()
+        self.queued_at = time.perf_counter()
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def queue_wait(self):
+        if self.started_at is None:
+            return time.perf_counter() - self.queued_at
+        return self.started_at - self.queued_at
+
+    @property
+    def run_time(self):
+        if self.started_at is None or self.finished_at is None:
+            return 0.0
+        return self.finished_at - self.started_at
+
+    def __await__(self):
+        return self.future.__await__()
+
+    def run(self, model):
+        return self.fn(model, *self.args)
+
+    def _resolve(self, result=None, error=None):
+        # Runs on the event loop thread
+        if self.future.done():
+            return
+        if error is not None:
+            self.future.set_exception(error)
+        else:
+            self.future.set_result(result)
+
+
+class StreamJob(Job):
+    # A job whose function also receives an emit(chunk) callback. Chunks are
+    # handed to the event loop as they are produced and read back with
+    # `async for chunk in job.stream()`.
+    def __init__(self, fn, args, loop):
+        super().__init__(fn, args, loop)
+        self.chunks = asyncio.Queue()
+        self.cancel_event = threading.Event()
+
+    def run(self, model):
+        return self.fn(model, self.emit, *self.args)
+
+    def emit(self, chunk):
+        # Runs on the worker thread; returns False once the consumer has gone
+        # away so the generation loop can stop early.
+        if self.cancel_event.is_set():
+            return False
+        self.loop.call_soon_threadsafe(self.chunks.put_nowait, chunk)
+        return True
+
+    def cancel(self):
+        self.cancel_event.set()
+        self.future.cancel()
+
+    async def stream(self):
+        while True:
+            get = asyncio.ensure_future(self.chunks.get())
+            done, _ = await asyncio.wait({get, self.future}, return_when=asyncio.FIRST_COMPLETED)
+            if get in done:
+                yield get.result()
+                continue
+            get.cancel()
+            # Results are delivered after every emitted chunk, so anything left
+            # in the queue is already there.
+            while not self.chunks.empty():
+                yield self.chunks.get_nowait()
+            self.future.result()
+            return
+
+
+class InferenceScheduler:
+    # Runs blocking inference calls off the event loop. Each worker thread
+    # builds and owns its own model instance, so a model is never touched by
+    # two threads at once. Requests wait in a bounded FIFO queue; when it is
+    # full, submit() fails fast instead of letting latency grow unbounded.
+    #
+    # Models are built on the worker threads, so start() returns right away
+    # and ready() reports when every worker has its model.
+    def __init__(self, model_factory, workers=1, max_queue=16):
+        self.model_factory = model_factory
+        self.workers = workers
+        self.max_queue = max_queue
+        self.load_error = None
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._ready_workers = 0
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"inference-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def submit(self, fn, *args):
+        # fn is called on a worker thread as fn(model, *args)
+        return self._enqueue(Job(fn, args, asyncio.get_running_loop()))
+
+    def submit_stream(self, fn, *args):
+        # fn is called on a worker thread as fn(model, emit, *args)
+        return self._enqueue(StreamJob(fn, args, asyncio.get_running_loop()))
+
+    def _enqueue(self, job):
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            raise QueueFullError(f"Inference queue is full ({self.max_queue} waiting)")
+        return job
+
+    def ready(self):
+        with self._lock:
+            return self._ready_workers == self.workers
+
+    def stats(self):
+        with self._lock:
+            in_flight = self._in_flight
+            ready_workers = self._ready_workers
+        return {
+            "workers": self.workers,
+            "ready_workers": ready_workers,
+            "in_flight": in_flight,
+            "queue_depth": self._queue.qsize(),
+            "max_queue": self.max_queue,
+        }
+
+    def _worker(self):
+        try:
+            model = self.model_factory()
+        except Exception as e:
+            logging.exception("Model load failed")
+            self.load_error = str(e)
+            return
+        with self._lock:
+            self._ready_workers += 1
+
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            # The client went away while the job was still queued
+            if job.future.cancelled():
+                continue
+
+            job.started_at = time.perf_counter()
+            with self._lock:
+                self._in_flight += 1
+            try:
+                result = job.run(model)
+            except Exception as e:
+                logging.exception("Inference job failed")
+                job.finished_at = time.perf_counter()
+                job.loop.call_soon_threadsafe(job._resolve, None, e)
+            else:
+                job.finished_at = time.perf_counter()
+                job.loop.call_soon_threadsafe(job._resolve, result)
+            finally:
+                with self._lock:
+                    self._in_flight -= 1
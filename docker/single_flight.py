@@ -0,0 +1,104 @@
+import asyncio
+
+import metrics
+
+
+class Flight:
+    # One generation shared by every identical request that arrived while it
+    # ran. Chunks are kept as they are produced, so a request that joins late
+    # gets the text so far and then follows along live. Read it with
+    # `async for chunk in flight.stream()` and leave() when done; the job is
+    # cancelled once nobody is reading it any more.
+    def __init__(self, job):
+        self.job = job
+        self.chunks = []
+        self.usage = None
+        self.done = False
+        self.error = None
+        self.followers = 0
+        self._readers = 1
+        self._changed = asyncio.Event()
+
+    def join(self):
+        self.followers += 1
+        self._readers += 1
+
+    def leave(self):
+        self._readers -= 1
+        if self._readers == 0 and not self.done:
+            self.job.cancel()
+
+    def emit(self, chunk):
+        self.chunks.append(chunk)
+        self._wake()
+
+    def finish(self, usage=None, error=None):
+        self.done = True
+        self.usage = usage
+        self.error = error
+        self._wake()
+
+    async def stream(self):
+        sent = 0
+        while True:
+            if sent < len(self.chunks):
+                chunks = self.chunks[sent:]
+                sent += len(chunks)
+                for chunk in chunks:
+                    yield chunk
+                continue
+            if self.done:
+                break
+            await self._changed.wait()
+        if self.error is not None:
+            raise self.error
+
+    def _wake(self):
+        # Wake every reader waiting on the current event, then start a new one
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+
+class SingleFlight:
+    # Coalesces identical in-flight requests on the event loop: the first
+    # request for a key submits the job and later ones join its Flight
+    # instead of queueing their own. A task reads the job into the flight,
+    # so the stream goes on for the others if the request that started it
+    # goes away. A flight is forgotten as soon as it finishes.
+    def __init__(self):
+        self.started = 0
+        self.coalesced = 0
+        self._flights = {}
+
+    def join(self, key, start):
+        # start() submits the StreamJob. Returns (flight, started); started
+        # is True for the request that submitted it. A key of None is never
+        # shared.
+        flight = self._flights.get(key) if key is not None else None
+        if flight is not None:
+            flight.join()
+            self.coalesced += 1
+            metrics.COALESCED_REQUESTS.inc()
+            return flight, False
+
+        flight = Flight(start())
+        if key is not None:
+            self._flights[key] = flight
+        self.started += 1
+        asyncio.ensure_future(self._pump(key, flight))
+        return flight, True
+
+    def stats(self):
+        return {"in_flight": len(self._flights), "started": self.started, "coalesced": self.coalesced}
+
+    async def _pump(self, key, flight):
+        usage = error = None
+        try:
+            async for chunk in flight.job.stream():
+                flight.emit(chunk)
+            usage = flight.job.future.result()
+        except (Exception, asyncio.CancelledError) as e:
+            error = e
+        if key is not None and self._flights.get(key) is flight:
+            del self._flights[key]
+        flight.finish(usage, error)
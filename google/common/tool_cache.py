@@ -0,0 +1,267 @@
+import functools
+import hashlib
+import inspect
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from phi.model.google import Gemini
+from phi.tools import Toolkit
+from phi.tools.duckduckgo import DuckDuckGo
+
+# Tool results are cached by tool name and normalised arguments for
+# TOOL_CACHE_TTL seconds, TOOL_CACHE_ENTRIES at most in memory. Set
+# TOOL_CACHE_DIR to also keep them on disk across restarts.
+TOOL_CACHE_ENTRIES = int(os.getenv("TOOL_CACHE_ENTRIES", "1024"))
+TOOL_CACHE_TTL = int(os.getenv("TOOL_CACHE_TTL", "21600"))
+TOOL_CACHE_DIR = os.getenv("TOOL_CACHE_DIR", "")
+
+# Independent tool calls from one model turn run on up to TOOL_PARALLELISM
+# threads
+TOOL_PARALLELISM = int(os.getenv("TOOL_PARALLELISM", "4"))
+
+# "duckduckgo" or "fake" (offline, canned results)
+SEARCH_TOOL = os.getenv("SEARCH_TOOL", "duckduckgo")
+
+
+def normalize(value):
+    # "  Apple  Stock News" and "apple stock news" are the same search
+    if isinstance(value, str):
+        return " ".join(value.lower().split())
+    return value
+
+
+class ToolCache:
+    # LRU cache of tool results with a TTL, plus an optional on-disk tier
+    # (one JSON file per key). Only successful calls are cached. Shared by
+    # all sessions, so it is thread safe.
+    def __init__(self, max_entries=TOOL_CACHE_ENTRIES, ttl=TOOL_CACHE_TTL, directory=TOOL_CACHE_DIR or None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        # Keys a prefetch fetched that the agent has not looked up yet
+        self._prefetched = set()
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def key(self, name, arguments):
+        return json.dumps([name, {k: normalize(v) for k, v in arguments.items()}], sort_keys=True, default=str)
+
+    def get(self, key, count=True):
+        # Returns (found, value). Prefetch lookups pass count=False so the
+        # hit rate only reflects the agent's own calls.
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                self._entries.move_to_end(key)
+                if count:
+                    self._count(key, True)
+                return True, entry[1]
+            if entry:
+                del self._entries[key]
+
+        entry = self._read_disk(key, now)
+        with self._lock:
+            if entry is None:
+                if count:
+                    self._count(key, False)
+                return False, None
+            if count:
+                self._count(key, True)
+            self._remember(key, entry)
+            return True, entry[1]
+
+    def put(self, key, value, prefetched=False):
+        entry = (time.time() + self.ttl, value)
+        with self._lock:
+            self._remember(key, entry)
+            if prefetched:
+                self._prefetched.add(key)
+        self._write_disk(key, entry)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def wrap(self, name, fn):
+        # Same signature and docstring as fn, so phi builds the same tool
+        # schema from it
+        signature = inspect.signature(fn)
+
+        def call(count, args, kwargs):
+            key = cache_key(*args, **kwargs)
+            found, value = self.get(key, count)
+            if found:
+                return value
+            value = fn(*args, **kwargs)
+            self.put(key, value, prefetched=not count)
+            return value
+
+        @functools.wraps(fn)
+        def cached(*args, **kwargs):
+            return call(True, args, kwargs)
+
+        def cache_key(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            return self.key(name, bound.arguments)
+
+        cached.cache_key = cache_key
+        # Fills the cache ahead of the agent's call without counting a lookup
+        cached.fill = lambda *args, **kwargs: call(False, args, kwargs)
+        return cached
+
+    def wrap_toolkit(self, toolkit):
+        for function in toolkit.functions.values():
+            function.entrypoint = self.wrap(function.name, function.entrypoint)
+        return toolkit
+
+    def _count(self, key, found):
+        # The agent's lookup of a result a prefetch fetched for it still
+        # needed a fresh call, so it counts as a miss. Called with the lock
+        # held.
+        if key in self._prefetched:
+            self._prefetched.discard(key)
+            found = False
+        if found:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def _remember(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest() + ".json")
+
+    def _read_disk(self, key, now):
+        if not self.directory:
+            return None
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                expires_at, value = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if expires_at <= now:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        return expires_at, value
+
+    def _write_disk(self, key, entry):
+        if not self.directory:
+            return
+        path = self._path(key)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(entry, f)
+            os.replace(tmp, path)
+        except (OSError, TypeError, ValueError):
+            # Results that are not JSON stay in memory only
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+
+class FakeSearch(Toolkit):
+    # Offline stand-in for DuckDuckGo with the same tool names. Each call
+    # sleeps `latency` seconds and returns canned results built from the
+    # query, so caching and parallel tool calls can be exercised without
+    # the network.
+    def __init__(self, latency=0.5):
+        super().__init__(name="duckduckgo")
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+        self.register(self.duckduckgo_search)
+        self.register(self.duckduckgo_news)
+
+    def _results(self, kind, query, max_results):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.latency)
+        return json.dumps([
+            {
+                "title": f"{kind} result {i + 1} for {query}",
+                "href": f"https://example.com/{kind}/{i + 1}?q={'+'.join(query.split())}",
+                "body": f"Placeholder {kind} result about {query}.",
+            }
+            for i in range(max_results)
+        ], indent=2)
+
+    def duckduckgo_search(self, query: str, max_results: int = 5) -> str:
+        """Use this function to search DuckDuckGo for a query.
+
+        Args:
+            query(str): The query to search for.
+            max_results (optional, default=5): The maximum number of results to return.
+
+        Returns:
+            The result from DuckDuckGo.
+        """
+        return self._results("search", query, max_results)
+
+    def duckduckgo_news(self, query: str, max_results: int = 5) -> str:
+        """Use this function to get the latest news from DuckDuckGo.
+
+        Args:
+            query(str): The query to search for.
+            max_results (optional, default=5): The maximum number of results to return.
+
+        Returns:
+            The latest news from DuckDuckGo.
+        """
+        return self._results("news", query, max_results)
+
+
+def search_toolkit(cache):
+    toolkit = FakeSearch() if SEARCH_TOOL == "fake" else DuckDuckGo()
+    return cache.wrap_toolkit(toolkit)
+
+
+def prefetch(function_calls, workers=TOOL_PARALLELISM):
+    # Run the cached tool calls of one turn concurrently so their results
+    # are in the cache when phi executes the calls one by one. Errors are
+    # ignored here; phi's own call raises and reports them.
+    calls = {}
+    for call in function_calls:
+        entrypoint = call.function.entrypoint
+        if call.error is not None or not hasattr(entrypoint, "fill"):
+            continue
+        try:
+            calls.setdefault(entrypoint.cache_key(**(call.arguments or {})), call)
+        except TypeError:
+            continue
+    if len(calls) < 2:
+        return
+
+    def run(call):
+        try:
+            call.function.entrypoint.fill(**(call.arguments or {}))
+        except Exception:
+            pass
+
+    with ThreadPoolExecutor(min(workers, len(calls)), thread_name_prefix="tool") as pool:
+        list(pool.map(run, calls.values()))
+
+
+class ParallelToolsGemini(Gemini):
+    # phi runs the tool calls of a turn sequentially; searches the model
+    # asks for together are independent, so prefetch them in parallel first
+    def run_function_calls(self, function_calls, function_call_results, tool_role="tool"):
+        prefetch(function_calls)
+        yield from super().run_function_calls(function_calls, function_call_results, tool_role)
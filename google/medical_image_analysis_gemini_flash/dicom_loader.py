@@ -0,0 +1,135 @@
+import numpy as np
+import pydicom
+from PIL import Image
+from pydicom.multival import MultiValue
+from pydicom.uid import ExplicitVRLittleEndian, ImplicitVRLittleEndian
+
+# Transfer syntaxes whose pixel data is stored raw and can be memory-mapped
+MAPPABLE_SYNTAXES = {ExplicitVRLittleEndian, ImplicitVRLittleEndian}
+
+
+def is_dicom(data):
+    # DICOM Part 10 files have "DICM" after a 128-byte preamble
+    return len(data) >= 132 and data[128:132] == b"DICM"
+
+
+def first_value(value, default=None):
+    # Window centre/width may be multi-valued; use the first setting
+    if value is None:
+        return default
+    if isinstance(value, MultiValue):
+        return float(value[0]) if len(value) else default
+    return float(value)
+
+
+class DicomStudy:
+    # The frames of one study: a multi-frame file, a series of single-frame
+    # files, or both. Only headers are read up front. Uncompressed pixel
+    # data is memory-mapped, so a frame is read from disk only when it is
+    # rendered; compressed files are decoded by pydicom on first use.
+    def __init__(self, paths):
+        self.frames = []
+        self._headers = {}
+        self._pixels = {}
+        positions = []
+        for path in paths:
+            header = pydicom.dcmread(path, stop_before_pixels=True)
+            if "Rows" not in header:
+                continue
+            self._headers[path] = header
+            frame_count = int(getattr(header, "NumberOfFrames", 1) or 1)
+            for index in range(frame_count):
+                self.frames.append((path, index))
+                positions.append(self._position(header, index))
+        if not self.frames:
+            raise ValueError("No DICOM files with image data were found")
+
+        # Order slices through the body, not by upload order
+        order = sorted(range(len(self.frames)), key=positions.__getitem__)
+        self.frames = [self.frames[i] for i in order]
+
+    def __len__(self):
+        return len(self.frames)
+
+    def header(self, i):
+        return self._headers[self.frames[i][0]]
+
+    def select(self, max_frames):
+        # Evenly spaced slices, so a long series still yields a bounded,
+        # representative set
+        if len(self.frames) <= max_frames:
+            return list(range(len(self.frames)))
+        return sorted(set(np.linspace(0, len(self.frames) - 1, max_frames).round().astype(int).tolist()))
+
+    def frame(self, i):
+        # Pixel values of one frame in modality units (e.g. Hounsfield)
+        path, index = self.frames[i]
+        header = self._headers[path]
+        frame = self._pixel_array(path)[index]
+        slope = float(getattr(header, "RescaleSlope", 1) or 1)
+        intercept = float(getattr(header, "RescaleIntercept", 0) or 0)
+        return frame.astype(np.float32) * slope + intercept
+
+    def render(self, i):
+        # Window the frame to 8 bits for display and upload
+        header = self.header(i)
+        frame = self.frame(i)
+        if frame.ndim == 3:
+            # Colour (e.g. ultrasound) frames need no windowing
+            return Image.fromarray(np.clip(frame, 0, 255).astype(np.uint8))
+
+        center = first_value(getattr(header, "WindowCenter", None))
+        width = first_value(getattr(header, "WindowWidth", None))
+        if center is None or not width:
+            low, high = np.percentile(frame, [0.5, 99.5])
+            center, width = (low + high) / 2, max(high - low, 1.0)
+        low = center - width / 2
+        pixels = np.clip((frame - low) / width, 0.0, 1.0)
+        if getattr(header, "PhotometricInterpretation", "") == "MONOCHROME1":
+            pixels = 1.0 - pixels
+        return Image.fromarray((pixels * 255).astype(np.uint8), mode="L")
+
+    def _pixel_array(self, path):
+        # All frames of a file, indexed by frame number first
+        pixels = self._pixels.get(path)
+        if pixels is None:
+            pixels = self._map_pixels(path)
+            if pixels is None:
+                pixels = pydicom.dcmread(path).pixel_array
+                if int(getattr(self._headers[path], "NumberOfFrames", 1) or 1) == 1:
+                    pixels = pixels[np.newaxis]
+            self._pixels[path] = pixels
+        return pixels
+
+    def _map_pixels(self, path):
+        header = self._headers[path]
+        syntax = header.file_meta.TransferSyntaxUID
+        bits = int(header.BitsAllocated)
+        if syntax not in MAPPABLE_SYNTAXES or bits not in (8, 16) or int(header.SamplesPerPixel) != 1:
+            return None
+
+        # Deferred reading leaves the pixel data on disk and records where
+        # it starts
+        element = pydicom.dcmread(path, defer_size=1024).get_item("PixelData")
+        dtype = np.dtype(f"<{'i' if int(header.PixelRepresentation) else 'u'}{bits // 8}")
+        frames = int(getattr(header, "NumberOfFrames", 1) or 1)
+        return np.memmap(
+            path,
+            dtype=dtype,
+            mode="r",
+            offset=element.value_tell,
+            shape=(frames, int(header.Rows), int(header.Columns)),
+        )
+
+    @staticmethod
+    def _position(header, index):
+        # Slice position along the slice normal (the cross product of the row
+        # and column directions), so sagittal, coronal and oblique series
+        # sort as well as axial ones. Falls back to numbering.
+        position = getattr(header, "ImagePositionPatient", None)
+        orientation = getattr(header, "ImageOrientationPatient", None)
+        if position is not None and len(position) == 3 and orientation is not None and len(orientation) == 6:
+            orientation = [float(value) for value in orientation]
+            normal = np.cross(orientation[:3], orientation[3:])
+            return (float(np.dot([float(value) for value in position], normal)), index)
+        return (float(getattr(header, "InstanceNumber", 0) or 0), index)
@@ -1,9 +1,38 @@
+import hashlib
+import io
 import os
+import sys
+import tempfile
+import time
 from PIL import Image
 from phi.agent import Agent
-from phi.model.google import Gemini
 import streamlit as st
-from phi.tools.duckduckgo import DuckDuckGo
+
+from dicom_loader import DicomStudy, is_dicom
+
+# tool_cache.py is shared by the Gemini apps and lives in google/common; the
+# images copy it next to main.py, local runs pick it up from there
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from tool_cache import ParallelToolsGemini, ToolCache, search_toolkit
+
+# Images are downscaled so the longest side is at most MAX_IMAGE_SIDE pixels
+# and re-encoded as JPEG before upload; the payload size dominates latency
+MAX_IMAGE_SIDE = int(os.getenv("MAX_IMAGE_SIDE", "1024"))
+JPEG_QUALITY = int(os.getenv("JPEG_QUALITY", "85"))
+
+# Analyses are cached by image content hash, shared across sessions
+ANALYSIS_CACHE_ENTRIES = int(os.getenv("ANALYSIS_CACHE_ENTRIES", "256"))
+ANALYSIS_CACHE_TTL = int(os.getenv("ANALYSIS_CACHE_TTL", "86400"))
+
+# DICOM studies are written to disk once (by content hash) so their pixel
+# data can be memory-mapped, and at most MAX_DICOM_FRAMES slices are sent
+DICOM_SPOOL_DIR = os.getenv("DICOM_SPOOL_DIR", os.path.join(tempfile.gettempdir(), "dicom_spool"))
+MAX_DICOM_FRAMES = int(os.getenv("MAX_DICOM_FRAMES", "8"))
+DICOM_CACHE_STUDIES = int(os.getenv("DICOM_CACHE_STUDIES", "4"))
+# Spooled files unused for DICOM_SPOOL_TTL seconds are deleted, and the least
+# recently used go first once the directory passes DICOM_SPOOL_MAX_BYTES
+DICOM_SPOOL_TTL = int(os.getenv("DICOM_SPOOL_TTL", "86400"))
+DICOM_SPOOL_MAX_BYTES = int(os.getenv("DICOM_SPOOL_MAX_BYTES", str(2 << 30)))
 
 if "GOOGLE_API_KEY" not in st.session_state:
     st.session_state.GOOGLE_API_KEY = None
@@ -40,12 +69,19 @@ with st.sidebar:
         "Do not make medical decisions based solely on this analysis."
     )
 
+# Search results are shared by every session, so repeated research about
+# the same condition is answered from the cache
+@st.cache_resource(show_spinner=False)
+def get_tool_cache():
+    return ToolCache()
+
+
 medical_agent = Agent(
-    model=Gemini(
+    model=ParallelToolsGemini(
         api_key=st.session_state.GOOGLE_API_KEY,
         id="gemini-2.0-flash-exp"
     ),
-    tools=[DuckDuckGo()],
+    tools=[search_toolkit(get_tool_cache())],
     markdown=True
 ) if st.session_state.GOOGLE_API_KEY else None
 
@@ -91,6 +127,82 @@ IMPORTANT: Use the DuckDuckGo search tool to:
 Format your response using clear markdown headers and bullet points. Be concise yet thorough.
 """
 
+
+def prepare_upload(image):
+    # Downscale and re-encode in memory; nothing is written to disk.
+    # thumbnail() works in place, so work on a copy.
+    image = image.convert("RGB") if image.mode not in ("L", "RGB") else image.copy()
+    image.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE))
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+    return buffer.getvalue()
+
+
+# Arguments starting with an underscore are not part of the cache key, so
+# repeated images are answered without re-encoding them or calling the model
+@st.cache_data(max_entries=ANALYSIS_CACHE_ENTRIES, ttl=ANALYSIS_CACHE_TTL, show_spinner=False)
+def analyze_images(images_hash, prompt, max_side, quality, _agent, _images):
+    payloads = [prepare_upload(image) for image in _images]
+    response = _agent.run(prompt, images=payloads)
+    return response.content, sum(len(payload) for payload in payloads)
+
+
+def spool_dicom(uploaded_files):
+    # Streamlit keeps uploads in memory; write each file to disk once so it
+    # can be memory-mapped. Files are named by content hash, so sessions
+    # never overwrite each other and reruns reuse the same files.
+    os.makedirs(DICOM_SPOOL_DIR, exist_ok=True)
+    paths = []
+    for uploaded_file in uploaded_files:
+        digest = hashlib.sha256(uploaded_file.getbuffer()).hexdigest()
+        path = os.path.join(DICOM_SPOOL_DIR, f"{digest}.dcm")
+        if os.path.exists(path):
+            # Mark it as recently used for prune_spool
+            os.utime(path)
+        else:
+            with open(path + ".tmp", "wb") as f:
+                f.write(uploaded_file.getbuffer())
+            os.replace(path + ".tmp", path)
+        paths.append(path)
+    prune_spool(keep=paths)
+    return tuple(sorted(paths))
+
+
+def prune_spool(keep=()):
+    # A pruned file that belongs to a cached study is simply written again
+    # the next time that study is uploaded; open memory maps stay valid
+    entries = []
+    for name in os.listdir(DICOM_SPOOL_DIR):
+        if name.endswith(".tmp"):
+            continue
+        path = os.path.join(DICOM_SPOOL_DIR, name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort()
+
+    now = time.time()
+    total = sum(size for _, size, _ in entries)
+    for mtime, size, path in entries:
+        if path in keep:
+            continue
+        if now - mtime <= DICOM_SPOOL_TTL and total <= DICOM_SPOOL_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+# Headers only; frames are decoded when rendered
+@st.cache_resource(max_entries=DICOM_CACHE_STUDIES, show_spinner=False)
+def open_study(paths):
+    return DicomStudy(paths)
+
+
 st.title("🏥 Medical Imaging Diagnosis Agent")
 st.write("Upload a medical image for professional analysis")
 
@@ -100,58 +212,92 @@ image_container = st.container()
 analysis_container = st.container()
 
 with upload_container:
-    uploaded_file = st.file_uploader(
+    uploaded_files = st.file_uploader(
         "Upload Medical Image",
-        type=["jpg", "jpeg", "png", "dicom"],
-        help="Supported formats: JPG, JPEG, PNG, DICOM"
+        type=["jpg", "jpeg", "png", "dcm", "dicom"],
+        accept_multiple_files=True,
+        help="Supported formats: JPG, JPEG, PNG, DICOM (a multi-frame file or all files of a series)"
     )
 
-if uploaded_file is not None:
+if uploaded_files:
+    dicom_files = [f for f in uploaded_files if is_dicom(f.getbuffer()[:132])]
     with image_container:
-        # Center the image using columns
-        col1, col2, col3 = st.columns([1, 2, 1])
-        with col2:
-            image = Image.open(uploaded_file)
-            # Calculate aspect ratio for resizing
-            width, height = image.size
-            aspect_ratio = width / height
-            new_width = 500
-            new_height = int(new_width / aspect_ratio)
-            resized_image = image.resize((new_width, new_height))
-            
-            st.image(
-                resized_image,
-                caption="Uploaded Medical Image",
-                use_container_width=True
+        if dicom_files:
+            try:
+                study = open_study(spool_dicom(dicom_files))
+            except Exception as e:
+                st.error(f"Could not read DICOM files: {e}")
+                st.stop()
+            frame_count = min(len(study), MAX_DICOM_FRAMES)
+            if frame_count > 1:
+                frame_count = st.slider("Slices to analyze", min_value=1, max_value=frame_count, value=frame_count)
+            selected = study.select(frame_count)
+            images = [study.render(i) for i in selected]
+            # Spooled files are named by content hash, so this identifies the slices
+            frame_ids = ",".join(f"{os.path.basename(study.frames[i][0])}:{study.frames[i][1]}" for i in selected)
+            images_hash = hashlib.sha256(frame_ids.encode()).hexdigest()
+            modality = getattr(study.header(0), "Modality", "DICOM")
+            prompt = (
+                f"The {len(images)} images are slices {', '.join(str(i + 1) for i in selected)} of "
+                f"{len(study)} from one {modality} study, in anatomical order.\n" + query
             )
-            
-            analyze_button = st.button(
-                "🔍 Analyze Image",
-                type="primary",
-                use_container_width=True
+            original_size = sum(f.size for f in dicom_files)
+
+            st.image(
+                images,
+                caption=[f"Slice {i + 1}/{len(study)}" for i in selected],
+                width=160
             )
+        else:
+            uploaded_file = uploaded_files[0]
+            # Center the image using columns
+            col1, col2, col3 = st.columns([1, 2, 1])
+            with col2:
+                image = Image.open(uploaded_file)
+                # Calculate aspect ratio for resizing
+                width, height = image.size
+                aspect_ratio = width / height
+                new_width = 500
+                new_height = int(new_width / aspect_ratio)
+                resized_image = image.resize((new_width, new_height))
+
+                st.image(
+                    resized_image,
+                    caption="Uploaded Medical Image",
+                    use_container_width=True
+                )
+            images = [image]
+            images_hash = hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+            prompt = query
+            original_size = uploaded_file.size
+
+        analyze_button = st.button(
+            "🔍 Analyze Image",
+            type="primary",
+            use_container_width=True
+        )
     
     with analysis_container:
         if analyze_button:
-            image_path = "temp_medical_image.png"
-            with open(image_path, "wb") as f:
-                f.write(uploaded_file.getbuffer())
-            
             with st.spinner("🔄 Analyzing image... Please wait."):
                 try:
-                    response = medical_agent.run(query, images=[image_path])
+                    content, payload_size = analyze_images(
+                        images_hash, prompt, MAX_IMAGE_SIDE, JPEG_QUALITY, medical_agent, images
+                    )
                     st.markdown("### 📋 Analysis Results")
                     st.markdown("---")
-                    st.markdown(response.content)
+                    st.markdown(content)
                     st.markdown("---")
+                    st.caption(
+                        f"Uploaded {payload_size / 1024:.0f} KB "
+                        f"(original {original_size / 1024:.0f} KB), "
+                        f"search cache hit rate {get_tool_cache().hit_rate():.0%}"
+                    )
                     st.caption(
                         "Note: This analysis is generated by AI and should be reviewed by "
                         "a qualified healthcare professional."
                     )
                 except Exception as e:
                     st.error(f"Analysis error: {e}")
-                finally:
-                    if os.path.exists(image_path):
-                        os.remove(image_path)
 else:
     st.info("👆 Please upload a medical image to begin analysis")
\ No newline at end of file
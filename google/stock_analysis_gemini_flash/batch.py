@@ -0,0 +1,185 @@
+import argparse
+import csv
+import os
+import random
+import re
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from phi.agent import Agent
+from phi.model.google import Gemini
+
+from indicators import summary_dict, to_json
+from market_data import store_from_env
+
+# Data fetches run on FETCH_WORKERS threads (the store's source is rate
+# limited separately) and agent calls on AGENT_WORKERS threads. Failed
+# calls are retried up to RETRY_ATTEMPTS times with exponential backoff.
+FETCH_WORKERS = int(os.getenv("FETCH_WORKERS", "8"))
+AGENT_WORKERS = int(os.getenv("AGENT_WORKERS", "4"))
+RETRY_ATTEMPTS = int(os.getenv("RETRY_ATTEMPTS", "4"))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "2"))
+
+# Screening asks for a short, parseable verdict per ticker; the single-stock
+# view keeps the full report with web research
+SCREEN_QUERY = """
+You are a financial analyst screening a watchlist. Using only the stock summary below (ticker info plus indicators precomputed from daily prices; returns, volatility and drawdowns are fractions, volatility is annualised), reply in exactly this format:
+
+Outlook: Bullish/Neutral/Bearish
+Risk: Low/Medium/High
+Rationale: at most two sentences
+"""
+
+COLUMNS = [
+    "input", "symbol", "name", "close", "return_1w", "return_1m", "return_6m",
+    "rsi_14", "volatility_6m", "max_drawdown", "outlook", "risk", "rationale",
+    "status", "seconds",
+]
+
+
+def read_watchlist(text):
+    # Tickers or company names separated by newlines or commas; duplicates
+    # and "#" comments are dropped, order is kept
+    names = []
+    for line in text.splitlines():
+        line = line.split("#", 1)[0]
+        names.extend(name.strip() for name in line.split(","))
+    return list(dict.fromkeys(name for name in names if name))
+
+
+def with_retries(fn, attempts=RETRY_ATTEMPTS, base_delay=RETRY_BASE_DELAY):
+    # Exponential backoff with full jitter, so throttled workers do not all
+    # retry at once. ValueError means bad input and is not retried.
+    for attempt in range(attempts):
+        try:
+            return fn()
+        except ValueError:
+            raise
+        except Exception:
+            if attempt == attempts - 1:
+                raise
+            time.sleep(random.uniform(0, base_delay * 2 ** attempt))
+
+
+def agent_factory(api_key):
+    # phi agents keep per-run state, so each call gets its own
+    def make_agent():
+        return Agent(model=Gemini(api_key=api_key, id="gemini-2.0-flash-exp"))
+    return make_agent
+
+
+def fetch(store, name, days):
+    info = with_retries(lambda: store.info(name))
+    if "symbol" not in info:
+        raise ValueError("Invalid ticker symbol or company name.")
+    frame = with_retries(lambda: store.history(info["symbol"], days=days))
+    if frame.empty:
+        raise ValueError("No stock data found for the given company.")
+    return summary_dict(frame, info)
+
+
+def analyze(make_agent, summary):
+    agent = make_agent()
+    response = with_retries(lambda: agent.run(f"{SCREEN_QUERY}\nStock summary:\n{to_json(summary)}"))
+    content = response.content if response and response.content else ""
+    verdict = {}
+    for field in ("outlook", "risk", "rationale"):
+        match = re.search(rf"^\W*{field}\W*:\s*(.+)$", content, re.IGNORECASE | re.MULTILINE)
+        verdict[field] = match.group(1).strip(" *") if match else ""
+    if not any(verdict.values()):
+        verdict["rationale"] = content.strip()
+    return verdict
+
+
+def make_row(name, summary, started):
+    row = dict.fromkeys(COLUMNS, "")
+    row["input"] = name
+    if summary:
+        indicators = summary["indicators"]
+        row.update({k: indicators.get(k) for k in COLUMNS if k in indicators})
+        row["symbol"] = summary.get("symbol", "")
+        row["name"] = summary.get("longName", "")
+    row["seconds"] = round(time.perf_counter() - started, 2)
+    return row
+
+
+def run_batch(names, store, make_agent=None, days=183, fetch_workers=FETCH_WORKERS, agent_workers=AGENT_WORKERS):
+    # Yields one row per name in completion order. A ticker's agent call is
+    # submitted as soon as its data is in, so analysis overlaps fetching.
+    # Without make_agent only the indicators are returned.
+    with ThreadPoolExecutor(fetch_workers, thread_name_prefix="fetch") as fetch_pool, \
+            ThreadPoolExecutor(agent_workers, thread_name_prefix="agent") as agent_pool:
+        pending = {}
+        for name in names:
+            pending[fetch_pool.submit(fetch, store, name, days)] = (name, None, time.perf_counter())
+        try:
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name, summary, started = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        row = make_row(name, summary, started)
+                        row["status"] = f"error: {e}"
+                        yield row
+                        continue
+
+                    if summary is None and make_agent is not None:
+                        pending[agent_pool.submit(analyze, make_agent, result)] = (name, result, started)
+                        continue
+                    if summary is None:
+                        summary, result = result, {}
+                    row = make_row(name, summary, started)
+                    row.update(result)
+                    row["status"] = "ok"
+                    yield row
+        finally:
+            # The consumer stopped early (e.g. a Streamlit rerun); drop
+            # whatever has not started
+            for future in pending:
+                future.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Screen a watchlist of tickers")
+    parser.add_argument("watchlist", help="File with one ticker or company name per line, or - for stdin")
+    parser.add_argument("--output", default="-", help="CSV file to write, - for stdout")
+    parser.add_argument("--days", type=int, default=int(os.getenv("HISTORY_DAYS", "183")))
+    parser.add_argument("--fetch-workers", type=int, default=FETCH_WORKERS)
+    parser.add_argument("--agent-workers", type=int, default=AGENT_WORKERS)
+    parser.add_argument("--no-agent", action="store_true", help="Only compute indicators")
+    args = parser.parse_args()
+
+    with (sys.stdin if args.watchlist == "-" else open(args.watchlist)) as f:
+        names = read_watchlist(f.read())
+
+    make_agent = None
+    if not args.no_agent:
+        api_key = os.getenv("GOOGLE_API_KEY")
+        if not api_key:
+            parser.error("GOOGLE_API_KEY is not set (use --no-agent to skip analysis)")
+        make_agent = agent_factory(api_key)
+
+    out = sys.stdout if args.output == "-" else open(args.output, "w", newline="")
+    writer = csv.DictWriter(out, fieldnames=COLUMNS)
+    writer.writeheader()
+    started = time.perf_counter()
+    failed = 0
+    try:
+        # Rows are written as they complete, so partial results survive
+        for i, row in enumerate(run_batch(names, store_from_env(), make_agent, args.days,
+                                          args.fetch_workers, args.agent_workers), 1):
+            writer.writerow(row)
+            out.flush()
+            failed += row["status"] != "ok"
+            print(f"[{i}/{len(names)}] {row['input']}: {row['status']}", file=sys.stderr)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    print(f"Screened {len(names)} tickers in {time.perf_counter() - started:.1f}s ({failed} failed)", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+# Trading days in each lookback the prompt asks about
+WEEK = 5
+MONTH = 21
+TRADING_DAYS_PER_YEAR = 252
+
+# Ticker info fields worth sending to the model
+INFO_FIELDS = [
+    "symbol", "longName", "sector", "industry", "currency", "marketCap",
+    "trailingPE", "forwardPE", "dividendYield", "beta",
+    "fiftyTwoWeekHigh", "fiftyTwoWeekLow", "recommendationKey",
+]
+
+
+def _round(value, digits=4):
+    if value is None or not np.isfinite(value):
+        return None
+    return round(float(value), digits)
+
+
+def _pct_change(close, periods):
+    # Return over the last `periods` bars, None if the history is too short
+    if len(close) <= periods:
+        return None
+    return close.iloc[-1] / close.iloc[-1 - periods] - 1
+
+
+def rsi(close, period=14):
+    # Wilder's RSI: exponential averages of gains and losses with alpha=1/period
+    delta = close.diff()
+    gain = delta.clip(lower=0).ewm(alpha=1 / period, adjust=False, min_periods=period).mean()
+    loss = (-delta.clip(upper=0)).ewm(alpha=1 / period, adjust=False, min_periods=period).mean()
+    return 100 - 100 / (1 + gain / loss)
+
+
+def macd(close, fast=12, slow=26, signal=9):
+    line = close.ewm(span=fast, adjust=False).mean() - close.ewm(span=slow, adjust=False).mean()
+    signal_line = line.ewm(span=signal, adjust=False).mean()
+    return line, signal_line, line - signal_line
+
+
+def compute_indicators(frame):
+    # Every indicator is a whole-column pandas/NumPy operation; only the
+    # latest values are kept
+    close = frame["Adj Close"] if "Adj Close" in frame else frame["Close"]
+    close = close.dropna().astype(float)
+    if close.empty:
+        raise ValueError("No closing prices to summarise.")
+    last = close.iloc[-1]
+
+    log_returns = np.log(close).diff().dropna()
+    running_peak = close.cummax()
+    drawdown = close / running_peak - 1
+    macd_line, signal_line, histogram = macd(close)
+    sma_20 = close.rolling(20).mean().iloc[-1]
+    sma_50 = close.rolling(50).mean().iloc[-1]
+    volume = frame["Volume"].astype(float) if "Volume" in frame else pd.Series(dtype=float)
+
+    return {
+        "as_of": close.index[-1].date().isoformat(),
+        "bars": len(close),
+        "close": _round(last),
+        "period_high": _round(close.max()),
+        "period_low": _round(close.min()),
+        "return_1w": _round(_pct_change(close, WEEK)),
+        "return_1m": _round(_pct_change(close, MONTH)),
+        "return_6m": _round(last / close.iloc[0] - 1),
+        "sma_20": _round(sma_20),
+        "sma_50": _round(sma_50),
+        "ema_12": _round(close.ewm(span=12, adjust=False).mean().iloc[-1]),
+        "ema_26": _round(close.ewm(span=26, adjust=False).mean().iloc[-1]),
+        "close_vs_sma_50": _round(last / sma_50 - 1),
+        "rsi_14": _round(rsi(close).iloc[-1], 2),
+        "macd": _round(macd_line.iloc[-1]),
+        "macd_signal": _round(signal_line.iloc[-1]),
+        "macd_histogram": _round(histogram.iloc[-1]),
+        # Annualised standard deviation of daily log returns
+        "volatility_1m": _round(log_returns.tail(MONTH).std() * np.sqrt(TRADING_DAYS_PER_YEAR)),
+        "volatility_6m": _round(log_returns.std() * np.sqrt(TRADING_DAYS_PER_YEAR)),
+        "max_drawdown": _round(drawdown.min()),
+        "drawdown_from_peak": _round(drawdown.iloc[-1]),
+        "volume_last": _round(volume.iloc[-1], 0) if len(volume) else None,
+        "volume_avg_20": _round(volume.tail(20).mean(), 0) if len(volume) else None,
+        "last_closes": [_round(v, 2) for v in close.tail(WEEK)],
+    }
+
+
+def summary_dict(frame, info=None):
+    summary = {k: info[k] for k in INFO_FIELDS if info and info.get(k) is not None}
+    summary["indicators"] = compute_indicators(frame)
+    return summary
+
+
+def to_json(summary):
+    return json.dumps(summary, separators=(",", ":"), default=str)
+
+
+def summarize(frame, info=None):
+    # Compact JSON for the prompt: a few hundred characters in place of
+    # every raw OHLCV row
+    return to_json(summary_dict(frame, info))
@@ -1,9 +1,20 @@
 import os
+import sys
+import pandas as pd
 import streamlit as st
 from phi.agent import Agent
-from phi.model.google import Gemini
-from phi.tools.duckduckgo import DuckDuckGo
-import yfinance as yf
+
+from batch import agent_factory, read_watchlist, run_batch
+from indicators import summarize
+from market_data import store_from_env
+
+# tool_cache.py is shared by the Gemini apps and lives in google/common; the
+# images copy it next to main.py, local runs pick it up from there
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from tool_cache import ParallelToolsGemini, ToolCache, search_toolkit
+
+# Days of history behind each analysis
+HISTORY_DAYS = int(os.getenv("HISTORY_DAYS", "183"))
 
 if "GOOGLE_API_KEY" not in st.session_state:
     st.session_state.GOOGLE_API_KEY = None
@@ -40,13 +51,26 @@ with st.sidebar:
         "does not constitute financial advice. Consult with a licensed financial advisor before making investment decisions."
     )
 
+# One store per process, shared by every session
+@st.cache_resource(show_spinner=False)
+def get_market_data():
+    return store_from_env()
+
+
+# Search results are shared by every session, so repeated research about
+# the same ticker is answered from the cache
+@st.cache_resource(show_spinner=False)
+def get_tool_cache():
+    return ToolCache()
+
+
 # Configure stock analysis agent
 stock_agent = Agent(
-    model=Gemini(
+    model=ParallelToolsGemini(
         api_key=st.session_state.GOOGLE_API_KEY,
         id="gemini-2.0-flash-exp"
     ),
-    tools=[DuckDuckGo()],
+    tools=[search_toolkit(get_tool_cache())],
     markdown=True
 ) if st.session_state.GOOGLE_API_KEY else None
 
@@ -55,7 +79,7 @@ if not stock_agent:
 
 # Stock Market Analysis Query Template
 query = """
-You are a highly skilled financial analyst specializing in stock market trends and predictive analysis. Analyze the provided stock data and structure your response as follows:
+You are a highly skilled financial analyst specializing in stock market trends and predictive analysis. Analyze the stock summary below (ticker info plus indicators precomputed from daily prices; returns, volatility and drawdowns are fractions, volatility is annualised) and structure your response as follows:
 
 ### 1. Overview of the Stock
 - Provide an overview of the stock (ticker, company name, sector, etc.)
@@ -109,39 +133,78 @@ with input_container:
 if company_name and fetch_button:
     with data_container:
         try:
-            # Fetch stock data using yfinance
-            ticker = yf.Ticker(company_name)
-            if 'symbol' not in ticker.info:
+            # Fetch stock data from the local store, syncing missing days
+            market_data = get_market_data()
+            info = market_data.info(company_name)
+            if 'symbol' not in info:
                 raise ValueError("Invalid ticker symbol or company name.")
-            
-            ticker_symbol = ticker.info['symbol']
-            stock_data = yf.download(ticker_symbol, period="6mo")
+
+            ticker_symbol = info['symbol']
+            stock_data = market_data.history(ticker_symbol, days=HISTORY_DAYS)
 
             if stock_data.empty:
                 raise ValueError("No stock data found for the given company.")
 
             st.write(f"### Stock Data for {company_name}", stock_data.head())
 
-            # Save data to a temporary file for analysis
-            temp_data_path = "temp_stock_data.csv"
-            stock_data.to_csv(temp_data_path)
+            # The model gets indicators computed here instead of the raw rows
+            summary = summarize(stock_data, info)
+            with st.expander("Summary sent to the model"):
+                st.code(summary, language="json")
 
             with analysis_container:
                 with st.spinner("🔄 Analyzing stock data... Please wait."):
                     try:
-                        response = stock_agent.run(query, files=[temp_data_path])
-                        
+                        response = stock_agent.run(f"{query}\nStock summary:\n{summary}")
+
                         # Display analysis results
                         if response and response.content:
                             st.markdown("### 📋 Analysis Results")
                             st.markdown("---")
                             st.markdown(response.content)
+                            st.caption(f"Search cache hit rate: {get_tool_cache().hit_rate():.0%}")
                         else:
                             st.warning("No analysis results were returned.")
                     except Exception as analysis_error:
                         st.error(f"Analysis error: {analysis_error}")
-                    finally:
-                        if os.path.exists(temp_data_path):
-                            os.remove(temp_data_path)
         except Exception as fetch_error:
             st.error(f"Error fetching stock data: {fetch_error}")
+
+# Watchlist screening: every ticker is fetched and analysed concurrently and
+# the table fills in as results arrive
+st.markdown("---")
+with st.expander("📋 Screen a Watchlist"):
+    watchlist_text = st.text_area(
+        "Tickers or company names:",
+        help="One per line or comma-separated."
+    )
+    watchlist_file = st.file_uploader("...or upload a watchlist", type=["txt", "csv"])
+    indicators_only = st.checkbox(
+        "Indicators only (skip AI analysis)",
+        value=not st.session_state.GOOGLE_API_KEY
+    )
+    screen_button = st.button("📊 Screen Watchlist", use_container_width=True)
+
+if screen_button:
+    if watchlist_file is not None:
+        watchlist_text = watchlist_file.getvalue().decode("utf-8", errors="replace")
+    names = read_watchlist(watchlist_text or "")
+    if not names:
+        st.warning("Please enter at least one ticker.")
+    elif not indicators_only and not st.session_state.GOOGLE_API_KEY:
+        st.warning("Please configure your API key in the sidebar to continue")
+    else:
+        make_agent = None if indicators_only else agent_factory(st.session_state.GOOGLE_API_KEY)
+        progress = st.progress(0.0)
+        table = st.empty()
+        rows = []
+        for row in run_batch(names, get_market_data(), make_agent, days=HISTORY_DAYS):
+            rows.append(row)
+            progress.progress(len(rows) / len(names), text=f"{len(rows)}/{len(names)} screened")
+            table.dataframe(pd.DataFrame(rows), use_container_width=True, hide_index=True)
+        st.download_button(
+            "⬇️ Download Results",
+            pd.DataFrame(rows).to_csv(index=False),
+            file_name="watchlist_screen.csv",
+            mime="text/csv"
+        )
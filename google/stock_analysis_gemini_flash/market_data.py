@@ -0,0 +1,265 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+
+import pandas as pd
+
+# Columns kept in the local store, in this order
+OHLCV_COLUMNS = ["Open", "High", "Low", "Close", "Adj Close", "Volume"]
+
+
+def normalize_history(frame):
+    # One row per trading day, indexed by a tz-naive date, OHLCV columns only
+    if frame is None or frame.empty:
+        return pd.DataFrame(columns=OHLCV_COLUMNS, index=pd.DatetimeIndex([], name="Date"))
+    if isinstance(frame.columns, pd.MultiIndex):
+        # yf.download returns (field, ticker) columns even for one ticker
+        frame = frame.droplevel(-1, axis=1)
+    frame = frame.copy()
+    index = pd.DatetimeIndex(frame.index)
+    if index.tz is not None:
+        index = index.tz_localize(None)
+    frame.index = index.normalize().rename("Date")
+    if "Adj Close" not in frame.columns and "Close" in frame.columns:
+        frame["Adj Close"] = frame["Close"]
+    frame = frame[[c for c in OHLCV_COLUMNS if c in frame.columns]]
+    return frame[~frame.index.duplicated(keep="last")].sort_index()
+
+
+class YahooFinanceSource:
+    # Market data from Yahoo Finance. Any object with the same two methods
+    # can be passed to MarketDataStore instead.
+    def __init__(self):
+        import yfinance as yf
+        self._yf = yf
+
+    def info(self, name):
+        return self._yf.Ticker(name).info
+
+    def history(self, symbol, start, end):
+        # Daily bars for start <= day < end
+        return self._yf.download(
+            symbol,
+            start=start.isoformat(),
+            end=end.isoformat(),
+            auto_adjust=False,
+            progress=False,
+        )
+
+
+class LocalSource:
+    # Offline stand-in for YahooFinanceSource that reads <SYMBOL>.csv (daily
+    # bars with a Date column) and an optional <SYMBOL>.json (ticker info)
+    # from a directory. Used for development and to exercise the store
+    # without the network.
+    def __init__(self, directory):
+        self.directory = directory
+
+    def info(self, name):
+        symbol = name.strip().upper()
+        path = os.path.join(self.directory, f"{symbol}.json")
+        if os.path.exists(path):
+            with open(path) as f:
+                return json.load(f)
+        if os.path.exists(os.path.join(self.directory, f"{symbol}.csv")):
+            return {"symbol": symbol}
+        return {}
+
+    def history(self, symbol, start, end):
+        path = os.path.join(self.directory, f"{symbol}.csv")
+        if not os.path.exists(path):
+            return pd.DataFrame()
+        frame = pd.read_csv(path, index_col="Date", parse_dates=True)
+        days = frame.index.normalize()
+        return frame[(days >= pd.Timestamp(start)) & (days < pd.Timestamp(end))]
+
+
+class RateLimiter:
+    # Token bucket shared by threads: at most `rate` acquisitions per second
+    # on average, with bursts of up to `burst`
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class RateLimitedSource:
+    # Wraps a source so calls that reach it (store misses) are rate limited
+    def __init__(self, source, rate, burst=1):
+        self.source = source
+        self.limiter = RateLimiter(rate, burst) if rate > 0 else None
+
+    def info(self, name):
+        if self.limiter:
+            self.limiter.acquire()
+        return self.source.info(name)
+
+    def history(self, symbol, start, end):
+        if self.limiter:
+            self.limiter.acquire()
+        return self.source.history(symbol, start, end)
+
+
+def source_from_env(spec=None):
+    # MARKET_DATA_SOURCE is "yahoo" (default) or "local:<directory>"
+    spec = spec or os.getenv("MARKET_DATA_SOURCE", "yahoo")
+    if spec.startswith("local:"):
+        return LocalSource(spec[len("local:"):])
+    if spec == "yahoo":
+        return YahooFinanceSource()
+    raise ValueError(f"Unknown MARKET_DATA_SOURCE: {spec}")
+
+
+class MarketDataStore:
+    # Daily OHLCV history per ticker, kept as one Parquet file per symbol
+    # under `root` plus an in-memory copy. A lookup only asks the source for
+    # the days after the last stored bar (and any older days not stored
+    # yet), and not at all while the last sync is younger than history_ttl.
+    # Ticker info is cached by the name it was looked up with for info_ttl.
+    #
+    # The last stored bar is always re-fetched, since it may have been
+    # written while the market was still open.
+    def __init__(self, root, source, history_ttl=900, info_ttl=86400):
+        self.root = root
+        self.source = source
+        self.history_ttl = history_ttl
+        self.info_ttl = info_ttl
+        self.fetches = 0
+        self.fetched_rows = 0
+        self._frames = {}
+        self._meta = {}
+        self._lock = threading.Lock()
+        self._symbol_locks = {}
+        os.makedirs(root, exist_ok=True)
+
+    def info(self, name):
+        key = name.strip().upper()
+        cache = self._load_meta("_info")
+        entry = cache.get(key)
+        if entry and time.time() - entry["fetched_at"] < self.info_ttl:
+            return entry["info"]
+
+        info = self.source.info(name) or {}
+        # Only remember lookups that resolved, so a typo is not cached
+        if "symbol" in info:
+            with self._symbol_lock("_info"):
+                cache = self._load_meta("_info")
+                cache[key] = {"info": info, "fetched_at": time.time()}
+                self._save_meta("_info", cache)
+        return info
+
+    def history(self, symbol, days=183, today=None):
+        # Daily bars covering the last `days` calendar days
+        symbol = symbol.upper()
+        today = today or date.today()
+        start = today - timedelta(days=days)
+        with self._symbol_lock(symbol):
+            frame = self._load_frame(symbol)
+            meta = self._load_meta(symbol)
+            stored_from = meta.get("from")
+
+            fresh = time.time() - meta.get("synced_at", 0) < self.history_ttl
+            covered = stored_from is not None and stored_from <= start.isoformat()
+            if not (fresh and covered):
+                parts = [frame]
+                if not covered:
+                    # Older days than we have; also the first sync
+                    end = date.fromisoformat(stored_from) if stored_from else today + timedelta(days=1)
+                    parts.insert(0, self._fetch(symbol, start, end))
+                if stored_from:
+                    since = frame.index[-1].date() if not frame.empty else date.fromisoformat(stored_from)
+                    parts.append(self._fetch(symbol, since, today + timedelta(days=1)))
+                frame = normalize_history(pd.concat([p for p in parts if not p.empty] or [frame]))
+
+                meta["from"] = min(filter(None, [stored_from, start.isoformat()]))
+                meta["synced_at"] = time.time()
+                self._save_frame(symbol, frame)
+                self._save_meta(symbol, meta)
+
+        return frame.loc[pd.Timestamp(start):]
+
+    def stats(self):
+        return {
+            "symbols_in_memory": len(self._frames),
+            "fetches": self.fetches,
+            "fetched_rows": self.fetched_rows,
+        }
+
+    def _fetch(self, symbol, start, end):
+        frame = normalize_history(self.source.history(symbol, start, end))
+        self.fetches += 1
+        self.fetched_rows += len(frame)
+        return frame
+
+    def _symbol_lock(self, symbol):
+        # One sync per symbol at a time; different symbols sync in parallel
+        with self._lock:
+            return self._symbol_locks.setdefault(symbol, threading.Lock())
+
+    def _path(self, symbol, suffix):
+        safe = "".join(c if c.isalnum() or c in "-_." else "_" for c in symbol.upper())
+        return os.path.join(self.root, safe + suffix)
+
+    def _load_frame(self, symbol):
+        frame = self._frames.get(symbol)
+        if frame is None:
+            path = self._path(symbol, ".parquet")
+            frame = pd.read_parquet(path) if os.path.exists(path) else normalize_history(None)
+            self._frames[symbol] = frame
+        return frame
+
+    def _save_frame(self, symbol, frame):
+        path = self._path(symbol, ".parquet")
+        frame.to_parquet(path + ".tmp")
+        os.replace(path + ".tmp", path)
+        self._frames[symbol] = frame
+
+    def _load_meta(self, symbol):
+        meta = self._meta.get(symbol)
+        if meta is None:
+            path = self._path(symbol, ".json")
+            meta = {}
+            if os.path.exists(path):
+                with open(path) as f:
+                    meta = json.load(f)
+            self._meta[symbol] = meta
+        return meta
+
+    def _save_meta(self, symbol, meta):
+        path = self._path(symbol, ".json")
+        with open(path + ".tmp", "w") as f:
+            # Ticker info holds a few non-JSON values (timestamps etc)
+            json.dump(meta, f, default=str)
+        os.replace(path + ".tmp", path)
+        self._meta[symbol] = meta
+
+
+def store_from_env():
+    # Daily bars are kept per ticker under MARKET_DATA_DIR and re-synced at
+    # most every HISTORY_TTL seconds; ticker info every INFO_TTL seconds.
+    # Calls that reach the source are limited to MARKET_DATA_RATE per second.
+    root = os.getenv("MARKET_DATA_DIR", os.path.join(tempfile.gettempdir(), "market_data"))
+    rate = float(os.getenv("MARKET_DATA_RATE", "2"))
+    return MarketDataStore(
+        root,
+        RateLimitedSource(source_from_env(), rate, burst=max(1, int(rate))),
+        history_ttl=int(os.getenv("HISTORY_TTL", "900")),
+        info_ttl=int(os.getenv("INFO_TTL", "86400")),
+    )
@@ -1,18 +1,57 @@
-from flask import Flask, request, jsonify
+import json
+import os
+import sys
+import time
+from flask import Flask, Response, request, jsonify
 import onnxruntime_genai as og
 
+# host_profile.py and metrics.py are shared with docker/ and live in ../common
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+import host_profile
+import metrics
+from backends import OnnxBackend, onnx_config
+from batcher import DynamicBatcher
+from continuous_batching import ContinuousBatchScheduler
+from response_cache import cache_key, is_deterministic, response_cache_from_env
+from single_flight import SingleFlight
+from startup import WARMUP_PROMPT, WARMUP_TOKENS, ModelLoader, register_health_routes
+from streaming import StreamTimer, replay_cached, sse_event
+
 # Initialize Flask app
 app = Flask(__name__)
 
-# Load the model and tokenizer
-model = og.Model('cpu_and_mobile/cpu-int4-rtn-block-32-acc-level-4')  # Replace with your model path
-tokenizer = og.Tokenizer(model)
-tokenizer_stream = tokenizer.create_stream()
+model_path = 'cpu_and_mobile/cpu-int4-rtn-block-32-acc-level-4'  # Replace with your model path
+
+# Set by load_model() on the loader thread
+model = None
+tokenizer = None
+eos_token_ids = None
+pad_token_id = None
+scheduler = None
 
 # Set search options
 search_options = {}
 search_options['max_length'] = 2048
 
+# ONNX Runtime threads come from the host profile written by autotune.py
+# when there is one; INTRA_OP_THREADS/INTER_OP_THREADS override it
+session_options = host_profile.load("onnx")
+if os.getenv("INTRA_OP_THREADS"):
+    session_options["intra_op_num_threads"] = int(os.getenv("INTRA_OP_THREADS"))
+if os.getenv("INTER_OP_THREADS"):
+    session_options["inter_op_num_threads"] = int(os.getenv("INTER_OP_THREADS"))
+
+# Requests arriving within BATCH_WINDOW_MS of each other are decoded together
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "8"))
+BATCH_WINDOW_MS = int(os.getenv("BATCH_WINDOW_MS", "10"))
+
+# Greedy search is deterministic, so repeated prompts are served from cache
+response_cache = response_cache_from_env()
+
+# Identical greedy requests that arrive while one is generating share its
+# output instead of generating again; SINGLE_FLIGHT=0 turns this off
+single_flight = SingleFlight() if os.getenv("SINGLE_FLIGHT", "1") != "0" else None
+
 # Initialize the message history with system message
 messages = [
     {"role": "system", "content": "You are a pirate chatbot who always responds in pirate speak!"},
@@ -22,38 +61,146 @@ messages = [
 # Define the chat template
 chat_template = '<|user|>\n{input} <|end|>\n<|assistant|>'
 
+# Decode a batch of requests with one generator
+def generate_batch(batch):
+    start = time.perf_counter()
+    input_tokens = tokenizer.encode_batch([req.prompt for req in batch])
+    tokenize_time = time.perf_counter() - start
+    for req, tokens in zip(batch, input_tokens):
+        req.prompt_tokens = sum(1 for token in tokens if token != pad_token_id)
+        req.tokenize_time = tokenize_time
+
+    params = og.GeneratorParams(model)
+    params.set_search_options(batch_size=len(batch), **search_options)
+    params.input_ids = input_tokens
+    generator = og.Generator(model, params)
+
+    # Each sequence needs its own stream: decoding keeps per-sequence state
+    streams = [tokenizer.create_stream() for _ in batch]
+
+    while not generator.is_done():
+        generator.compute_logits()
+        generator.generate_next_token()
+
+        new_tokens = generator.get_next_tokens()
+        for i, req in enumerate(batch):
+            if req.finished:
+                continue
+            if req.cancelled or new_tokens[i] in eos_token_ids:
+                # Hand the finished sequence back right away instead of
+                # waiting for the longest sequence in the batch
+                req.finish()
+                continue
+            req.emit(streams[i].decode(new_tokens[i]))
+
+        # Every sequence is done or abandoned
+        if all(req.finished for req in batch):
+            break
+
+# Load the model and tokenizer
+def load_model(phase):
+    global model, tokenizer, eos_token_ids, pad_token_id, scheduler
+
+    # og.Model reads the weights and builds the ONNX Runtime session
+    with phase("weights"):
+        model = og.Model(onnx_config(model_path, session_options))
+    with phase("tokenizer"):
+        tokenizer = og.Tokenizer(model)
+
+    # End-of-sequence ids, used to tell when one sequence of a batch is finished
+    with open(os.path.join(model_path, 'genai_config.json')) as f:
+        genai_config = json.load(f)['model']
+    eos_token_id = genai_config['eos_token_id']
+    eos_token_ids = set(eos_token_id if isinstance(eos_token_id, list) else [eos_token_id])
+    pad_token_id = genai_config.get('pad_token_id')
+
+    # SCHEDULER=continuous admits new requests at every decode step instead of
+    # waiting for the current batch to finish
+    if os.getenv("SCHEDULER", "batch") == "continuous":
+        scheduler = ContinuousBatchScheduler(
+            OnnxBackend(model, tokenizer, eos_token_ids, search_options),
+            max_batch_size=BATCH_MAX_SIZE,
+            max_new_tokens=search_options['max_length'],
+        )
+    else:
+        scheduler = DynamicBatcher(generate_batch, max_batch_size=BATCH_MAX_SIZE, window=BATCH_WINDOW_MS / 1000)
+
+# Run a few decode steps so the first request doesn't pay for warmup
+def warmup():
+    params = og.GeneratorParams(model)
+    params.set_search_options(**search_options)
+    params.input_ids = tokenizer.encode(format_prompt(WARMUP_PROMPT))
+    generator = og.Generator(model, params)
+    for _ in range(WARMUP_TOKENS):
+        if generator.is_done():
+            break
+        generator.compute_logits()
+        generator.generate_next_token()
+
+# Format the conversation for the prompt
+def format_prompt(text):
+    return f'{chat_template.format(input=text)}'
+
+# Queue a user message for generation
+def submit(text):
+    # Append the user's message to the message history
+    messages.append({"role": "user", "content": text})
+
+    return scheduler.submit(format_prompt(text))
+
+# Key identifying requests with the same output, or None if sampling
+def generation_key(text):
+    if not is_deterministic(search_options):
+        return None
+    return cache_key(format_prompt(text), model_path, search_options)
+
+# Start a generation, or join an identical one already running. Returns the
+# request, an iterable of its text, a function to call once done reading and
+# whether this call started the generation.
+def open_generation(text, key):
+    if single_flight is None or key is None:
+        req = submit(text)
+        return req, req, req.cancel, True
+    flight, started = single_flight.join(key, lambda: submit(text))
+    if not started:
+        messages.append({"role": "user", "content": text})
+    return flight.wait_generation(), flight, flight.leave, started
+
+def request_usage(req):
+    return {
+        "prompt_tokens": req.prompt_tokens,
+        "completion_tokens": req.completion_tokens,
+        "total_tokens": req.prompt_tokens + req.completion_tokens,
+    }
+
 # Function to handle the user input and generate a response
 def chatbot_response(text):
     if not text:
         return "Error, input cannot be empty"
-    
-    # Append the user's message to the message history
-    messages.append({"role": "user", "content": text})
-    
-    # Format the conversation for the prompt
-    prompt = f'{chat_template.format(input=text)}'
-    input_tokens = tokenizer.encode(prompt)
-    
-    params = og.GeneratorParams(model)
-    params.set_search_options(**search_options)
-    params.input_ids = input_tokens
-    generator = og.Generator(model, params)
 
-    response = ""
-    try:
-        while not generator.is_done():
-            generator.compute_logits()
-            generator.generate_next_token()
-
-            new_token = generator.get_next_tokens()[0]
-            response += tokenizer_stream.decode(new_token)
-    except KeyboardInterrupt:
-        response += "  --control+c pressed, aborting generation--"
-    
+    key = generation_key(text)
+    if response_cache is not None and key:
+        cached = response_cache.get(key)
+        if cached is not None:
+            messages.append({"role": "user", "content": text})
+            messages.append({"role": "assistant", "content": cached["response"]})
+            return cached["response"]
+
+    with metrics.IN_FLIGHT.track_inprogress():
+        req, pieces, release, started = open_generation(text, key)
+        try:
+            response = "".join(pieces).strip()
+        finally:
+            release()
+    if started:
+        metrics.observe_request(req)
+
     # Add the bot's response to the message history
-    messages.append({"role": "assistant", "content": response.strip()})
-    
-    return response.strip()
+    messages.append({"role": "assistant", "content": response})
+
+    if response_cache is not None and key:
+        response_cache.put(key, {"response": response, "usage": request_usage(req)})
+    return response
 
 # Define Flask route for the chatbot API
 @app.route("/chat", methods=["POST"])
@@ -61,11 +208,79 @@ def chat():
     user_input = request.json.get("message", "")
     if not user_input:
         return jsonify({"error": "Message is required"}), 400
-    
+
     # Call the chatbot_response function to generate the response
     response = chatbot_response(user_input)
     return jsonify({"response": response})
 
+# Streaming variant: each token is sent as a Server-Sent Event once decoded
+@app.route("/chat/stream", methods=["POST"])
+def chat_stream():
+    user_input = request.json.get("message", "")
+    if not user_input:
+        return jsonify({"error": "Message is required"}), 400
+
+    # A cached response is replayed as one chunk, as /chat would return it
+    key = generation_key(user_input)
+    cached = response_cache.get(key) if response_cache is not None and key else None
+    if cached is not None:
+        messages.append({"role": "user", "content": user_input})
+        messages.append({"role": "assistant", "content": cached["response"]})
+        events = replay_cached(StreamTimer(), cached["response"], {"usage": cached.get("usage")})
+        return Response(events, mimetype="text/event-stream")
+
+    # The generation is opened inside the generator, so a client that goes
+    # away before the first byte never takes a slot that nothing releases
+    def events():
+        timer = StreamTimer()
+        req, pieces, release, started = open_generation(user_input, key)
+        try:
+            with metrics.IN_FLIGHT.track_inprogress():
+                for piece in pieces:
+                    # Tokens that decode to no text yet are not sent or timed
+                    if not piece:
+                        continue
+                    timer.token()
+                    yield sse_event({"token": piece})
+        finally:
+            release()
+        timer.finish()
+        if started:
+            metrics.observe_request(req)
+        response = "".join(req.pieces).strip()
+        messages.append({"role": "assistant", "content": response})
+
+        usage = request_usage(req)
+        if response_cache is not None and key:
+            response_cache.put(key, {"response": response, "usage": usage})
+        yield sse_event({"usage": usage, "timings": timer.timings(req.completion_tokens)}, event="done")
+
+    return Response(events(), mimetype="text/event-stream")
+
+@app.route("/stats", methods=["GET"])
+def stats():
+    return jsonify({
+        "response_cache": response_cache.stats() if response_cache else None,
+        "single_flight": single_flight.stats() if single_flight else None,
+        "queue_depth": scheduler.queue_depth() if scheduler else 0,
+        "session_options": session_options,
+        "model": loader.status(),
+    })
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+metrics.QUEUE_DEPTH.set_function(lambda: scheduler.queue_depth() if scheduler else 0)
+if response_cache is not None:
+    metrics.CACHE_HIT_RATE.labels(cache="response").set_function(lambda: response_cache.stats()["hit_rate"])
+
+# Load the model in the background; the API answers /healthz meanwhile
+loader = ModelLoader(load_model, warmup)
+loader.start()
+register_health_routes(app, loader, exempt=("stats", "metrics_endpoint"))
+
 # Run the Flask API
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000)
@@ -1,40 +1,82 @@
-from flask import Flask, request, jsonify
-from transformers import AutoModelForCausalLM, AutoTokenizer
+import os
+import sys
+import time
+from threading import Event, Thread
+from flask import Flask, Response, request, jsonify
+from transformers import AutoModelForCausalLM, AutoTokenizer, DynamicCache, StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
 import torch
 
+# metrics.py is shared with docker/ and lives in ../common
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+import metrics
+from backends import TransformersBackend
+from quantization import QUANTIZE, load_int8
+from continuous_batching import ContinuousBatchScheduler
+from response_cache import cache_key, is_deterministic, response_cache_from_env
+from session_store import SessionStore
+from single_flight import SingleFlight
+from speculative import Speculation
+from startup import WARMUP_PROMPT, WARMUP_TOKENS, ModelLoader, register_health_routes
+from streaming import StreamTimer, replay_cached, sse_event
+
 app = Flask(__name__)
 
-# Load model and tokenizer
 model_id = "microsoft/Phi-3-mini-4k-instruct"
-tokenizer = AutoTokenizer.from_pretrained(model_id)
 
-model = AutoModelForCausalLM.from_pretrained(
-    model_id,
-    torch_dtype=torch.bfloat16,  # Use float32 for CPU
-    device_map="cpu",  # Explicitly set to CPU
-)
+# Adjust for performance; with SPECULATIVE on, several tokens come out of
+# each forward pass, so a higher cap costs less latency
+MAX_NEW_TOKENS = int(os.getenv("MAX_NEW_TOKENS", "32"))
+TEMPERATURE = 0.6
+TOP_P = 0.9
 
-# Initialize conversation history
-messages = []
+# Set by load_model() on the loader thread
+tokenizer = None
+model = None
+MAX_CONTEXT = None
+terminators = None
+speculation = None
 
-@app.route("/chat", methods=["POST"])
-def chat():
-    global messages
+# Cached responses for greedy (temperature 0) requests
+response_cache = response_cache_from_env()
 
-    # Get user input from the request
-    user_input = request.json.get("message", "")
-    if not user_input:
-        return jsonify({"error": "Message is required"}), 400
+# Identical greedy turns that arrive while one is generating share its
+# output instead of generating again; SINGLE_FLIGHT=0 turns this off
+single_flight = SingleFlight() if os.getenv("SINGLE_FLIGHT", "1") != "0" else None
 
-    # Append the user's message to the conversation history
-    messages.append({"role": "user", "content": user_input})
+# SCHEDULER=continuous runs every session's turns through one step-level
+# batch instead of a model.generate call per request. Sessions keep their
+# history but not their KV cache in that mode.
+scheduler = None
 
-    # Tokenize input
-    input_ids = tokenizer.apply_chat_template(
-        messages,
-        add_generation_prompt=True,
-        return_tensors="pt"  # Keep tensors on CPU
-    )
+
+# Load model and tokenizer
+def load_model(phase):
+    global tokenizer, model, MAX_CONTEXT, terminators, scheduler, speculation
+
+    with phase("tokenizer"):
+        tokenizer = AutoTokenizer.from_pretrained(model_id)
+
+    # safetensors weights are mmapped; low_cpu_mem_usage skips building a
+    # randomly initialised copy of the model first
+    def load_weights(torch_dtype):
+        return AutoModelForCausalLM.from_pretrained(
+            model_id,
+            torch_dtype=torch_dtype,
+            device_map="cpu",  # Explicitly set to CPU
+            low_cpu_mem_usage=True,
+            use_safetensors=True,
+        )
+
+    if QUANTIZE == "int8":
+        model = load_int8(model_id, lambda: load_weights(torch.float32), phase)
+    else:
+        with phase("weights"):
+            model = load_weights(torch.bfloat16)  # Use float32 for CPU
+    MAX_CONTEXT = model.config.max_position_embeddings
+
+    # Speculative decoding applies to model.generate, not to the continuous
+    # batching scheduler
+    speculation = Speculation.load(model, tokenizer, torch.bfloat16, phase)
 
     # Define terminators
     terminators = [
@@ -42,24 +84,426 @@ def chat():
         tokenizer.convert_tokens_to_ids("<|eot_id|>")
     ]
 
-    # Generate outputs
-    outputs = model.generate(
+    if os.getenv("SCHEDULER", "generate") == "continuous":
+        scheduler = ContinuousBatchScheduler(
+            TransformersBackend(model, tokenizer, eos_token_ids=terminators),
+            max_batch_size=int(os.getenv("BATCH_MAX_SIZE", "8")),
+            max_new_tokens=MAX_NEW_TOKENS,
+        )
+
+
+# Short greedy generation so the first request doesn't pay for warmup
+def warmup():
+    input_ids = tokenizer.apply_chat_template(
+        [{"role": "user", "content": WARMUP_PROMPT}],
+        add_generation_prompt=True,
+        return_tensors="pt",
+    )
+    model.generate(
         input_ids,
-        max_new_tokens=32,  # Adjust for performance
+        attention_mask=torch.ones_like(input_ids),
+        max_new_tokens=WARMUP_TOKENS,
+        do_sample=False,
+        **(speculation.generate_kwargs() if speculation else {}),
+    )
+
+
+# Conversation history and KV cache per client session
+sessions = SessionStore(
+    ttl=int(os.getenv("SESSION_TTL", "1800")),
+    max_bytes=int(os.getenv("SESSION_MAX_BYTES", str(2 << 30))),
+    max_sessions=int(os.getenv("SESSION_MAX_COUNT", "256")),
+)
+
+
+# Streamer that also counts the generated tokens for the usage event
+class CountingStreamer(TextIteratorStreamer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.completion_tokens = 0
+        self.first_token_at = None
+
+    def put(self, value):
+        if not (self.skip_prompt and self.next_tokens_are_prompt):
+            if self.first_token_at is None:
+                self.first_token_at = time.perf_counter()
+            self.completion_tokens += value.shape[-1]
+        super().put(value)
+
+
+# Stops model.generate between tokens once set, for abandoned requests
+class StopFlag(StoppingCriteria):
+    def __init__(self):
+        self.event = Event()
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool)
+
+
+def observe_generate(received_at, started_at, first_token_at, prompt_tokens, completion_tokens):
+    # Metrics of one model.generate call; tokenization was observed already
+    end = time.perf_counter()
+    if first_token_at is not None:
+        metrics.TIME_TO_FIRST_TOKEN.observe(first_token_at - received_at)
+    first_token_at = first_token_at or end
+    metrics.observe_generation(
+        tokenize=None,
+        prefill=first_token_at - started_at,
+        decode=end - first_token_at,
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+    )
+
+
+def generate_with_stats(input_ids, streamer, generation_kwargs):
+    # model.generate, plus per-request acceptance stats when SPECULATIVE is on
+    if speculation is None:
+        return model.generate(input_ids, streamer=streamer, **generation_kwargs), None
+
+    uncached = input_ids.shape[-1] - generation_kwargs["past_key_values"].get_seq_length()
+    speculation.start()
+    try:
+        outputs = model.generate(input_ids, streamer=streamer, **generation_kwargs, **speculation.generate_kwargs())
+    except Exception:
+        speculation.stop()
+        raise
+    return outputs, speculation.finish(uncached, outputs.shape[-1] - input_ids.shape[-1])
+
+
+def get_session():
+    session_id = request.json.get("session_id") or request.headers.get("X-Session-ID")
+    return sessions.get(session_id)
+
+
+def build_prompt_ids(session):
+    # Tokenize the conversation, dropping the oldest turns (but keeping a
+    # system message) once the prompt and answer no longer fit in context.
+    start = 1 if session.messages[0]["role"] == "system" else 0
+    with metrics.TOKENIZE.time():
+        while True:
+            token_ids = tokenizer.apply_chat_template(session.messages, add_generation_prompt=True)
+            if len(token_ids) + MAX_NEW_TOKENS <= MAX_CONTEXT or len(session.messages) - start <= 1:
+                break
+            del session.messages[start:start + 2]
+    return token_ids[-(MAX_CONTEXT - MAX_NEW_TOKENS):]
+
+
+def prepare_generation(session, user_input, temperature):
+    # Append the user's message to the conversation history
+    session.messages.append({"role": "user", "content": user_input})
+
+    # Tokenize input
+    token_ids = build_prompt_ids(session)
+    input_ids = torch.tensor([token_ids])
+
+    # Reuse the KV cache of the previous turns; generate() only prefills the
+    # tokens past what the cache already holds.
+    reused = session.reusable_prefix(token_ids)
+    if reused:
+        past_key_values = session.past_key_values
+        past_key_values.crop(reused)
+    else:
+        past_key_values = DynamicCache()
+    session.update_cache(token_ids, past_key_values)
+
+    generation_kwargs = dict(
+        attention_mask=torch.ones_like(input_ids),
+        past_key_values=past_key_values,
+        max_new_tokens=MAX_NEW_TOKENS,
         eos_token_id=terminators,
-        do_sample=True,
-        temperature=0.6,
-        top_p=0.9,
     )
+    if temperature > 0:
+        generation_kwargs.update(do_sample=True, temperature=temperature, top_p=TOP_P)
+    else:
+        generation_kwargs.update(do_sample=False)
+    return input_ids, generation_kwargs
+
+
+def schedule_turn(session, user_input, temperature):
+    # Continuous-batching path: queue the turn and return its request
+    session.messages.append({"role": "user", "content": user_input})
+    return scheduler.submit(
+        None,
+        prompt_ids=build_prompt_ids(session),
+        max_new_tokens=MAX_NEW_TOKENS,
+        temperature=temperature,
+        top_p=TOP_P,
+    )
+
+
+class Generation:
+    # One model.generate call for a session's turn, run on a background
+    # thread; iterate it for the decoded text as it is produced. The
+    # session's KV cache is in use until join() returns.
+    def __init__(self, session, user_input, temperature, received_at):
+        self.session = session
+        self.received_at = received_at
+        self.input_ids, self.generation_kwargs = prepare_generation(session, user_input, temperature)
+        self.stop = StopFlag()
+        self.generation_kwargs["stopping_criteria"] = StoppingCriteriaList([self.stop])
+        self.streamer = CountingStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        self.prompt_tokens = self.input_ids.shape[-1]
+        self.outputs = None
+        self.speculation = None
+        self.error = None
+        self.started_at = time.perf_counter()
+        self._thread = Thread(target=self._run)
+        self._thread.start()
+
+    @property
+    def completion_tokens(self):
+        return self.streamer.completion_tokens
+
+    def __iter__(self):
+        for text in self.streamer:
+            if text:
+                yield text
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+    def cancel(self):
+        # The client went away; generate() stops after the current token
+        self.stop.event.set()
+
+    def join(self):
+        self._thread.join()
+
+    def finish(self, bot_response):
+        # Record metrics and keep the turn and its KV cache in the session
+        self.join()
+        observe_generate(self.received_at, self.started_at, self.streamer.first_token_at, self.prompt_tokens, self.completion_tokens)
+        finish_turn(self.session, self.outputs, self.generation_kwargs["past_key_values"], bot_response)
+
+    def _run(self):
+        try:
+            self.outputs, self.speculation = generate_with_stats(self.input_ids, self.streamer, self.generation_kwargs)
+        except Exception as e:
+            self.error = e
+            # Unblock the consumer, which would otherwise wait on the streamer
+            self.streamer.end()
+
+
+def request_temperature():
+    return float(request.json.get("temperature", TEMPERATURE))
+
+
+def generation_key(session, user_input, temperature):
+    # Key on the templated conversation plus everything that shapes the
+    # output; None when sampling, since then outputs differ by design
+    params = {"max_new_tokens": MAX_NEW_TOKENS, "do_sample": temperature > 0, "temperature": temperature}
+    if not is_deterministic(params):
+        return None
+    prompt = tokenizer.apply_chat_template(
+        session.messages + [{"role": "user", "content": user_input}],
+        tokenize=False,
+        add_generation_prompt=True,
+    )
+    return cache_key(prompt, model_id, params)
+
+
+def finish_turn(session, outputs, past_key_values, bot_response):
+    # Add the bot's response to the conversation history and keep the cache
+    session.messages.append({"role": "assistant", "content": bot_response.strip()})
+    session.update_cache(outputs[0].tolist(), past_key_values)
+
+
+def open_turn(session, user_input, temperature, received_at, key):
+    # Start the turn's generation, or join an identical one already running
+    # for another session. Returns the generation (a Generation, or the
+    # scheduler's request), an iterable of its text, a function to call once
+    # done reading, and whether this request started it.
+    def start():
+        if scheduler is not None:
+            return schedule_turn(session, user_input, temperature)
+        return Generation(session, user_input, temperature, received_at)
+
+    flight = None
+    if single_flight is not None and key is not None:
+        flight, started = single_flight.join(key, start)
+        turn, pieces = flight.wait_generation(), flight
+    else:
+        turn = pieces = start()
+        started = True
+
+    def release():
+        if flight is None:
+            turn.cancel()
+        else:
+            flight.leave()
+        # Others may still be reading a shared generation, but this
+        # session's lock must be held until it stops using the KV cache
+        if started and scheduler is None:
+            turn.join()
+
+    return turn, pieces, release, started
+
+
+def end_turn(session, user_input, turn, started, bot_response):
+    # Record a finished turn. A request that joined another session's
+    # generation only takes the text; its KV cache is left as it was.
+    if not started:
+        session.messages.append({"role": "user", "content": user_input})
+        session.messages.append({"role": "assistant", "content": bot_response.strip()})
+    elif scheduler is not None:
+        metrics.observe_request(turn)
+        session.messages.append({"role": "assistant", "content": bot_response.strip()})
+    else:
+        turn.finish(bot_response)
+
+
+def turn_usage(turn):
+    return {
+        "prompt_tokens": turn.prompt_tokens,
+        "completion_tokens": turn.completion_tokens,
+        "total_tokens": turn.prompt_tokens + turn.completion_tokens,
+    }
+
+
+def abandon_turn(session, user_input):
+    # Drop the user message of a turn that got no answer, so the history
+    # keeps alternating user/assistant pairs for build_prompt_ids
+    if session.messages and session.messages[-1] == {"role": "user", "content": user_input}:
+        session.messages.pop()
+
+
+@app.route("/chat", methods=["POST"])
+def chat():
+    received_at = time.perf_counter()
+
+    # Get user input from the request
+    user_input = request.json.get("message", "")
+    if not user_input:
+        return jsonify({"error": "Message is required"}), 400
+
+    temperature = request_temperature()
+    session = get_session()
+    with session.lock:
+        key = generation_key(session, user_input, temperature)
+        cached = response_cache.get(key) if response_cache is not None and key else None
+        if cached is not None:
+            session.messages.append({"role": "user", "content": user_input})
+            session.messages.append({"role": "assistant", "content": cached["response"]})
+            return jsonify({"response": cached["response"], "session_id": session.session_id, "cached": True})
+
+        try:
+            with metrics.IN_FLIGHT.track_inprogress():
+                turn, pieces, release, started = open_turn(session, user_input, temperature, received_at, key)
+                try:
+                    bot_response = "".join(piece for piece in pieces if piece)
+                finally:
+                    release()
+            end_turn(session, user_input, turn, started, bot_response)
+        except Exception:
+            abandon_turn(session, user_input)
+            raise
+
+        if response_cache is not None and key:
+            response_cache.put(key, {"response": bot_response.strip(), "usage": turn_usage(turn)})
+    sessions.enforce_budget()
+
+    body = {"response": bot_response.strip(), "session_id": session.session_id}
+    if not started:
+        body["coalesced"] = True
+    if getattr(turn, "speculation", None):
+        body["speculation"] = turn.speculation
+    return jsonify(body)
+
+
+@app.route("/chat/stream", methods=["POST"])
+def chat_stream():
+    received_at = time.perf_counter()
+    user_input = request.json.get("message", "")
+    if not user_input:
+        return jsonify({"error": "Message is required"}), 400
+
+    temperature = request_temperature()
+    session = get_session()
+    if session.lock.locked():
+        return jsonify({"error": "Session is busy with another request"}), 409, {"Retry-After": "1"}
+
+    # The turn runs inside the generator, so nothing is started or locked if
+    # the response is never read. A turn that doesn't finish (client gone,
+    # generation error) leaves no unanswered message in the history. A
+    # cached response is replayed as one chunk, as /chat would return it.
+    def events():
+        timer = StreamTimer()
+        with session.lock:
+            key = generation_key(session, user_input, temperature)
+            cached = response_cache.get(key) if response_cache is not None and key else None
+            if cached is not None:
+                session.messages.append({"role": "user", "content": user_input})
+                session.messages.append({"role": "assistant", "content": cached["response"]})
+                done = {"session_id": session.session_id, "usage": cached.get("usage")}
+                yield from replay_cached(timer, cached["response"], done)
+                return
+
+            answered = False
+            try:
+                turn, pieces, release, started = open_turn(session, user_input, temperature, received_at, key)
+                try:
+                    text = []
+                    with metrics.IN_FLIGHT.track_inprogress():
+                        for piece in pieces:
+                            if not piece:
+                                continue
+                            timer.token()
+                            text.append(piece)
+                            yield sse_event({"token": piece})
+                finally:
+                    release()
+                timer.finish()
+                bot_response = "".join(text)
+                end_turn(session, user_input, turn, started, bot_response)
+                answered = True
+            finally:
+                if not answered:
+                    abandon_turn(session, user_input)
+
+            if response_cache is not None and key:
+                response_cache.put(key, {"response": bot_response.strip(), "usage": turn_usage(turn)})
+        sessions.enforce_budget()
+
+        yield sse_event(
+            {
+                "session_id": session.session_id,
+                "usage": turn_usage(turn),
+                "timings": timer.timings(turn.completion_tokens),
+                "speculation": getattr(turn, "speculation", None),
+                "coalesced": not started,
+            },
+            event="done",
+        )
+
+    return Response(events(), mimetype="text/event-stream")
+
+
+@app.route("/stats", methods=["GET"])
+def stats():
+    return jsonify({
+        "sessions": sessions.stats(),
+        "response_cache": response_cache.stats() if response_cache else None,
+        "scheduler": scheduler.stats() if scheduler else None,
+        "model": loader.status(),
+    })
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+
+metrics.QUEUE_DEPTH.set_function(lambda: scheduler.queue_depth() if scheduler else 0)
+if response_cache is not None:
+    metrics.CACHE_HIT_RATE.labels(cache="response").set_function(lambda: response_cache.stats()["hit_rate"])
 
-    # Decode the response
-    response = outputs[0][input_ids.shape[-1]:]
-    bot_response = tokenizer.decode(response, skip_special_tokens=True)
 
-    # Add the bot's response to the conversation history
-    messages.append({"role": "assistant", "content": bot_response.strip()})
+# Load the model in the background; the API answers /healthz meanwhile
+loader = ModelLoader(load_model, warmup)
+loader.start()
+register_health_routes(app, loader, exempt=("stats", "metrics_endpoint"))
 
-    return jsonify({"response": bot_response.strip()})
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000)
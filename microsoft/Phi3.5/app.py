@@ -1,17 +1,48 @@
+import argparse
+import json
+import os
+import sys
+import time
+from contextlib import nullcontext
 import torch
 from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline
 
+# quantization.py is shared with the Flask server one directory up; the image
+# copies it next to this script
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from quantization import QUANTIZE, load_int8
+from bulk import chunked, load_progress, read_prompts, save_checkpoint
+
+model_id = "microsoft/Phi-3.5-mini-instruct"
+
 # Set manual seed for reproducibility
 torch.random.manual_seed(0)
 
-# Load the model for CPU
-model = AutoModelForCausalLM.from_pretrained(
-    "microsoft/Phi-3.5-mini-instruct", 
-    device_map="cpu",  # Use CPU
-    torch_dtype="float32",  # Ensure compatibility with CPU
-    trust_remote_code=True, 
-)
-tokenizer = AutoTokenizer.from_pretrained("microsoft/Phi-3.5-mini-instruct")
+
+def load_float_model():
+    # Load the model for CPU
+    return AutoModelForCausalLM.from_pretrained(
+        model_id,
+        device_map="cpu",  # Use CPU
+        torch_dtype="float32",  # Ensure compatibility with CPU
+        trust_remote_code=True,
+    )
+
+
+def load_model():
+    # QUANTIZE=int8 loads the int8 model quantization.py converted and cached
+    if QUANTIZE != "int8":
+        return load_float_model()
+    return load_int8(model_id, load_float_model, lambda name: nullcontext(), trust_remote_code=True)
+
+
+model = load_model()
+tokenizer = AutoTokenizer.from_pretrained(model_id)
+
+# Batched generation pads prompts on the left so the outputs line up
+tokenizer.padding_side = "left"
+if tokenizer.pad_token is None:
+    tokenizer.pad_token = tokenizer.eos_token
 
 # Define conversation messages
 messages = [
@@ -36,6 +67,57 @@ generation_args = {
     "do_sample": False,
 }
 
-# Generate output
-output = pipe(messages, **generation_args)
-print(output[0]['generated_text'])
+
+def run_demo():
+    # Generate output
+    output = pipe(messages, **generation_args)
+    print(output[0]['generated_text'])
+
+
+def run_bulk(args):
+    checkpoint_path = args.checkpoint or args.output + ".checkpoint"
+    done, skip_lines = load_progress(args.output, checkpoint_path)
+    if skip_lines or done:
+        print(f"Resuming from input line {skip_lines} ({len(done)} results already written)")
+
+    start_time = time.time()
+    completed = 0
+    with open(args.output, "a") as out:
+        # Read a window of prompts at a time and sort it by token length, so
+        # each batch pads to about the same length without loading the
+        # whole input into memory.
+        for window in chunked(read_prompts(args.input, skip_lines), args.window):
+            pending = [record for record in window if record[1] not in done]
+            lengths = {
+                line_no: len(tokenizer.apply_chat_template(conversation, add_generation_prompt=True))
+                for line_no, _, conversation in pending
+            }
+            pending.sort(key=lambda record: lengths[record[0]])
+
+            for batch in chunked(pending, args.batch_size):
+                outputs = pipe([conversation for _, _, conversation in batch], batch_size=len(batch), **generation_args)
+                for (_, record_id, _), output in zip(batch, outputs):
+                    out.write(json.dumps({"id": record_id, "response": output[0]["generated_text"]}) + "\n")
+                # Make results durable before moving on
+                out.flush()
+                os.fsync(out.fileno())
+                completed += len(batch)
+
+            save_checkpoint(checkpoint_path, window[-1][0] + 1)
+            elapsed = time.time() - start_time
+            print(f"{completed} prompts done, {completed / elapsed:.2f} prompts/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Phi-3.5 text generation; pass --input for bulk mode")
+    parser.add_argument("--input", help="JSONL file of prompts to run in bulk")
+    parser.add_argument("--output", default="results.jsonl", help="JSONL file results are appended to")
+    parser.add_argument("--checkpoint", help="Progress file (default: <output>.checkpoint)")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--window", type=int, default=1024, help="Prompts read and length-sorted at a time")
+    args = parser.parse_args()
+
+    if args.input:
+        run_bulk(args)
+    else:
+        run_demo()
@@ -0,0 +1,65 @@
+import json
+import os
+
+# Input, output and resume helpers for the bulk mode of app.py. They need no
+# model, so the resume logic can be tested on its own.
+
+
+def read_prompts(path, skip_lines=0):
+    # Stream (line number, id, messages) from a JSONL file. Each line has an
+    # optional "id" and either "prompt" (a single user turn) or "messages".
+    with open(path) as f:
+        for line_no, line in enumerate(f):
+            if line_no < skip_lines or not line.strip():
+                continue
+            record = json.loads(line)
+            conversation = record.get("messages") or [{"role": "user", "content": record["prompt"]}]
+            yield line_no, record.get("id", line_no), conversation
+
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def load_progress(output_path, checkpoint_path):
+    # Input lines before the checkpoint are fully done; ids already in the
+    # output cover the window that was interrupted.
+    done = set()
+    if os.path.exists(output_path):
+        with open(output_path, "rb+") as f:
+            complete = 0
+            for line in f:
+                try:
+                    record = json.loads(line) if line.endswith(b"\n") else None
+                except ValueError:
+                    record = None
+                if record is None and line.strip():
+                    # A run killed mid-write leaves a partial last line. Cut it
+                    # off so the next result starts on a line of its own; a bad
+                    # line anywhere else is not ours to drop.
+                    if f.read(1):
+                        raise ValueError(f"{output_path}: line {line[:80]!r} is not valid JSON")
+                    f.truncate(complete)
+                    break
+                if record is not None:
+                    done.add(record["id"])
+                complete += len(line)
+    skip_lines = 0
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as f:
+            skip_lines = json.load(f)["next_line"]
+    return done, skip_lines
+
+
+def save_checkpoint(checkpoint_path, next_line):
+    tmp_path = checkpoint_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"next_line": next_line}, f)
+    os.replace(tmp_path, checkpoint_path)
@@ -0,0 +1,70 @@
+import os
+import sys
+import time
+
+from backends import OnnxBackend, Sequence
+
+# host_profile and tuning are shared with docker/ and live in ../common
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+import host_profile
+import tuning
+
+# Finds the ONNX Runtime thread settings that are fastest on this host and
+# writes them to the host profile the ONNX server reads at startup. Prefill
+# and decode are timed separately, but one session serves both, so the
+# setting kept is the one that finishes a typical request (--prompt-tokens
+# in, --decode-tokens out) soonest.
+MODEL_PATH = 'cpu_and_mobile/cpu-int4-rtn-block-32-acc-level-4'
+
+
+def measure(model_path, session_options, prompt_tokens, decode_tokens, repeats):
+    # Median prefill and decode speed, in tokens per second, of one setting
+    backend = OnnxBackend.load(model_path, max_length=prompt_tokens + decode_tokens + 1, session_options=session_options)
+    prompt = tuning.build_prompt(backend.tokenize, prompt_tokens)
+    warmup = Sequence(None, prompt[:16], 1)
+    backend.prefill(warmup)
+    backend.release(warmup)
+
+    prefill_rates = []
+    decode_rates = []
+    for _ in range(repeats):
+        seq = Sequence(None, prompt, decode_tokens)
+        start = time.perf_counter()
+        seq.last_token = backend.prefill(seq)
+        prefill_rates.append(tuning.tokens_per_second(len(prompt), start))
+
+        start = time.perf_counter()
+        for _ in range(decode_tokens):
+            seq.last_token = backend.decode_step([seq])[0]
+        decode_rates.append(tuning.tokens_per_second(decode_tokens, start))
+        backend.release(seq)
+
+    result = tuning.summarize(session_options, prefill_rates, decode_rates)
+    result["request_seconds"] = (
+        prompt_tokens / result["prefill_tokens_per_second"] + decode_tokens / result["decode_tokens_per_second"]
+    )
+    tuning.report(session_options, result)
+    return result
+
+
+def main():
+    parser = tuning.argument_parser(
+        "Sweep ONNX Runtime intra/inter-op threads and save the fastest to the host profile", MODEL_PATH, 512,
+    )
+    parser.add_argument("--intra-op", help="Comma-separated intra_op_num_threads values (default: derived from the CPUs available)")
+    parser.add_argument("--inter-op", default="1,2", help="Comma-separated inter_op_num_threads values")
+    args = parser.parse_args()
+
+    measurements = []
+    for intra_op in tuning.parse_ints(args.intra_op) or tuning.thread_counts(host_profile.available_cpus()):
+        for inter_op in tuning.parse_ints(args.inter_op):
+            session_options = {"intra_op_num_threads": intra_op, "inter_op_num_threads": inter_op}
+            measurements.append(measure(args.model, session_options, args.prompt_tokens, args.decode_tokens, args.repeats))
+    best = min(measurements, key=lambda m: m["request_seconds"])
+
+    settings = {name: best[name] for name in ("intra_op_num_threads", "inter_op_num_threads")}
+    tuning.save("onnx", settings, measurements, args)
+
+
+if __name__ == "__main__":
+    main()
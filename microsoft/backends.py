@@ -0,0 +1,395 @@
+import codecs
+import json
+import os
+import time
+from contextlib import nullcontext
+
+# Each backend only needs its own runtime installed
+try:
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer, DynamicCache
+    from quantization import load_int8
+except ImportError:
+    torch = None
+
+try:
+    import onnxruntime_genai as og
+except ImportError:
+    og = None
+
+try:
+    from llama_cpp import Llama
+except ImportError:
+    Llama = None
+
+
+class Sequence:
+    # Backend-side state of one generation: its prompt, sampling settings and
+    # the slot holding its KV cache while it runs.
+    def __init__(self, request, prompt_ids, max_new_tokens, temperature=0.0, top_p=1.0):
+        self.request = request
+        self.prompt_ids = prompt_ids
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.generated = 0
+        self.last_token = None
+        self.position = 0
+        self.slot = None
+        self.detokenizer = None
+
+
+class Backend:
+    # Common interface of the inference runtimes:
+    #
+    #   load(model, **options)  build the backend from a model id or path
+    #   tokenize(text)          prompt text -> token ids
+    #   detokenizer()           object whose decode(token) returns new text
+    #   prefill(seq)            evaluate seq.prompt_ids, return the first token
+    #   decode_step(seqs)       advance every running sequence by one token
+    #   release(seq)            free the sequence's KV slot
+    #   stream(prompt)          yield decoded text for a single prompt
+    #
+    # prefill/decode_step return None for a sequence the runtime has ended.
+    # max_batch_size is the number of sequences that can run at once (None
+    # for no fixed limit).
+    max_batch_size = None
+    eos_token_ids = frozenset()
+
+    @classmethod
+    def load(cls, model, **options):
+        raise NotImplementedError
+
+    def generate(self, prompt_ids, max_new_tokens=256, temperature=0.0, top_p=1.0):
+        # Yield generated token ids for one prompt
+        seq = Sequence(None, prompt_ids, max_new_tokens, temperature=temperature, top_p=top_p)
+        token = self.prefill(seq)
+        try:
+            while token is not None and token not in self.eos_token_ids:
+                yield token
+                seq.generated += 1
+                if seq.generated >= max_new_tokens:
+                    break
+                seq.last_token = token
+                token = self.decode_step([seq])[0]
+        finally:
+            self.release(seq)
+
+    def stream(self, prompt, max_new_tokens=256, temperature=0.0, top_p=1.0):
+        detokenizer = self.detokenizer()
+        for token in self.generate(self.tokenize(prompt), max_new_tokens, temperature, top_p):
+            yield detokenizer.decode(token)
+
+
+def sample_next(logits, temperature=0.0, top_p=1.0):
+    # Pick the next token from a [vocab] logits row
+    if temperature <= 0:
+        return int(logits.argmax())
+    probs = torch.softmax(logits.float() / temperature, dim=-1)
+    if top_p < 1.0:
+        sorted_probs, sorted_ids = probs.sort(descending=True)
+        # Keep the smallest set of tokens whose mass reaches top_p
+        sorted_probs[sorted_probs.cumsum(0) - sorted_probs > top_p] = 0
+        return int(sorted_ids[torch.multinomial(sorted_probs, 1)])
+    return int(torch.multinomial(probs, 1))
+
+
+class IncrementalDecoder:
+    # Turns a token-by-token sequence back into text, holding back output
+    # while a multi-byte character is only partially decoded.
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.token_ids = []
+        self.printed = 0
+
+    def decode(self, token):
+        self.token_ids.append(token)
+        text = self.tokenizer.decode(self.token_ids, skip_special_tokens=True)
+        if text.endswith("\ufffd"):
+            return ""
+        piece = text[self.printed:]
+        self.printed = len(text)
+        return piece
+
+
+class ByteDecoder:
+    # Incremental UTF-8 decoding for backends whose tokens map to raw bytes
+    def __init__(self, token_bytes):
+        self.token_bytes = token_bytes
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def decode(self, token):
+        return self._decoder.decode(self.token_bytes(token))
+
+
+class TransformersBackend(Backend):
+    # Step-level generation on a transformers causal LM. All running sequences
+    # share one batched KV cache; each sequence owns a row (its KV slot), and
+    # rows are left-padded to a common length with the attention mask hiding
+    # the padding. Sequences can join or leave between any two decode steps.
+    def __init__(self, model, tokenizer, eos_token_ids=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.eos_token_ids = set(eos_token_ids or [tokenizer.eos_token_id])
+        self.rows = []
+        self.cache = None
+        self.mask = None
+
+    @classmethod
+    def load(cls, model, torch_dtype="bfloat16", quantize=None, **options):
+        # quantize="int8" loads float32 weights and quantizes the Linear
+        # layers, or reads the cached result of doing so
+        tokenizer = AutoTokenizer.from_pretrained(model)
+        if quantize == "int8":
+            def load_float():
+                return AutoModelForCausalLM.from_pretrained(model, torch_dtype=torch.float32, device_map="cpu")
+            lm = load_int8(model, load_float, lambda name: nullcontext())
+        else:
+            lm = AutoModelForCausalLM.from_pretrained(model, torch_dtype=getattr(torch, torch_dtype), device_map="cpu")
+        eos_token_ids = lm.generation_config.eos_token_id
+        if not isinstance(eos_token_ids, list):
+            eos_token_ids = [eos_token_ids]
+        return cls(lm, tokenizer, eos_token_ids=[tokenizer.eos_token_id] + eos_token_ids)
+
+    def tokenize(self, text):
+        return self.tokenizer.encode(text)
+
+    def detokenizer(self):
+        return IncrementalDecoder(self.tokenizer)
+
+    def prefill(self, seq):
+        with torch.inference_mode():
+            return self._prefill(seq)
+
+    def _prefill(self, seq):
+        input_ids = torch.tensor([seq.prompt_ids])
+        outputs = self.model(input_ids, past_key_values=DynamicCache(), use_cache=True)
+        self._add_row(seq, outputs.past_key_values.to_legacy_cache(), len(seq.prompt_ids))
+        seq.position = len(seq.prompt_ids)
+        return sample_next(outputs.logits[0, -1], seq.temperature, seq.top_p)
+
+    def decode_step(self, seqs):
+        with torch.inference_mode():
+            return self._decode_step(seqs)
+
+    def _decode_step(self, seqs):
+        input_ids = torch.tensor([[seq.last_token] for seq in self.rows])
+        position_ids = torch.tensor([[seq.position] for seq in self.rows])
+        self.mask = torch.cat([self.mask, self.mask.new_ones(len(self.rows), 1)], dim=1)
+        outputs = self.model(
+            input_ids,
+            attention_mask=self.mask,
+            position_ids=position_ids,
+            past_key_values=self.cache,
+            use_cache=True,
+        )
+        self.cache = outputs.past_key_values
+
+        next_tokens = {}
+        for i, seq in enumerate(self.rows):
+            seq.position += 1
+            next_tokens[id(seq)] = sample_next(outputs.logits[i, -1], seq.temperature, seq.top_p)
+        return [next_tokens[id(seq)] for seq in seqs]
+
+    def release(self, seq):
+        index = self.rows.index(seq)
+        del self.rows[index]
+        if not self.rows:
+            self.cache = None
+            self.mask = None
+            return
+
+        keep = torch.tensor([i for i in range(len(self.rows) + 1) if i != index])
+        mask = self.mask.index_select(0, keep)
+        # Drop padding columns no remaining row needs
+        start = int((mask.sum(dim=0) > 0).nonzero()[0])
+        self.mask = mask[:, start:]
+        self.cache = DynamicCache.from_legacy_cache(tuple(
+            (k.index_select(0, keep)[:, :, start:], v.index_select(0, keep)[:, :, start:])
+            for k, v in self.cache.to_legacy_cache()
+        ))
+
+    def _add_row(self, seq, kv, length):
+        if self.cache is None:
+            self.rows = [seq]
+            self.cache = DynamicCache.from_legacy_cache(kv)
+            self.mask = torch.ones(1, length, dtype=torch.long)
+            return
+
+        current = self.mask.shape[1]
+        width = max(current, length)
+        layers = []
+        for (k, v), (new_k, new_v) in zip(self.cache.to_legacy_cache(), kv):
+            k, v = _pad_left(k, width - current), _pad_left(v, width - current)
+            new_k, new_v = _pad_left(new_k, width - length), _pad_left(new_v, width - length)
+            layers.append((torch.cat([k, new_k]), torch.cat([v, new_v])))
+        self.cache = DynamicCache.from_legacy_cache(tuple(layers))
+
+        row_mask = torch.cat([torch.zeros(width - length, dtype=torch.long), torch.ones(length, dtype=torch.long)])
+        self.mask = torch.cat([
+            torch.cat([self.mask.new_zeros(len(self.rows), width - current), self.mask], dim=1),
+            row_mask[None],
+        ])
+        self.rows.append(seq)
+
+
+def _pad_left(t, n):
+    # Pad a [batch, heads, seq, dim] tensor with n zero positions on the left
+    if n == 0:
+        return t
+    return torch.cat([t.new_zeros(t.shape[0], t.shape[1], n, t.shape[3]), t], dim=2)
+
+
+def onnx_eos_token_ids(model_path):
+    # onnxruntime-genai keeps the end-of-sequence ids in genai_config.json
+    with open(os.path.join(model_path, 'genai_config.json')) as f:
+        eos_token_id = json.load(f)['model']['eos_token_id']
+    return set(eos_token_id if isinstance(eos_token_id, list) else [eos_token_id])
+
+
+def onnx_config(model_path, session_options=None):
+    # ONNX Runtime session options (intra_op_num_threads etc.) are applied
+    # as an overlay on genai_config.json
+    if not session_options:
+        return model_path
+    config = og.Config(model_path)
+    config.overlay(json.dumps({"model": {"decoder": {"session_options": session_options}}}))
+    return config
+
+
+class OnnxBackend(Backend):
+    # Step-level generation on onnxruntime-genai. The runtime has no way to
+    # add or remove sequences from a running generator, so each sequence owns
+    # its own og.Generator (and KV cache) as its slot, and a decode step
+    # advances every running generator by one token.
+    def __init__(self, model, tokenizer, eos_token_ids, search_options=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.eos_token_ids = set(eos_token_ids)
+        self.search_options = search_options or {}
+
+    @classmethod
+    def load(cls, model, max_length=2048, session_options=None, **options):
+        og_model = og.Model(onnx_config(model, session_options))
+        return cls(og_model, og.Tokenizer(og_model), onnx_eos_token_ids(model), {'max_length': max_length})
+
+    def tokenize(self, text):
+        return list(self.tokenizer.encode(text))
+
+    def detokenizer(self):
+        return self.tokenizer.create_stream()
+
+    def prefill(self, seq):
+        params = og.GeneratorParams(self.model)
+        search_options = dict(self.search_options)
+        if seq.temperature > 0:
+            search_options.update(do_sample=True, temperature=seq.temperature, top_p=seq.top_p)
+        params.set_search_options(**search_options)
+        params.input_ids = seq.prompt_ids
+        seq.slot = og.Generator(self.model, params)
+        return self._step(seq.slot)
+
+    def decode_step(self, seqs):
+        return [self._step(seq.slot) for seq in seqs]
+
+    def release(self, seq):
+        seq.slot = None
+
+    def _step(self, generator):
+        # None means the generator hit max_length
+        if generator.is_done():
+            return None
+        generator.compute_logits()
+        generator.generate_next_token()
+        return generator.get_next_tokens()[0]
+
+
+class LlamaCppBackend(Backend):
+    # Step-level generation on llama.cpp. A Llama context holds a single
+    # sequence, so this backend runs one sequence at a time.
+    max_batch_size = 1
+
+    def __init__(self, llm, eos_token_ids=None):
+        self.llm = llm
+        self.eos_token_ids = set(eos_token_ids or [llm.token_eos()])
+
+    @classmethod
+    def load(cls, model, n_ctx=4096, n_threads=None, **options):
+        llm = Llama(model_path=model, n_ctx=n_ctx, n_threads=n_threads, n_gpu_layers=0, verbose=False)
+        # Phi-3 ends assistant turns with <|end|> rather than the EOS token
+        end_ids = llm.tokenize(b"<|end|>", add_bos=False, special=True)
+        return cls(llm, eos_token_ids=[llm.token_eos()] + end_ids[:1])
+
+    def tokenize(self, text):
+        return self.llm.tokenize(text.encode("utf-8"), special=True)
+
+    def detokenizer(self):
+        return ByteDecoder(lambda token: self.llm.detokenize([token]))
+
+    def prefill(self, seq):
+        self.llm.reset()
+        self.llm.eval(seq.prompt_ids)
+        return self._sample(seq)
+
+    def decode_step(self, seqs):
+        seq, = seqs
+        if self.llm.n_tokens >= self.llm.n_ctx():
+            return [None]
+        self.llm.eval([seq.last_token])
+        return [self._sample(seq)]
+
+    def release(self, seq):
+        pass
+
+    def _sample(self, seq):
+        return self.llm.sample(temp=seq.temperature, top_p=seq.top_p)
+
+
+class DummyBackend(Backend):
+    # Tiny stand-in model for running the benchmark and the schedulers
+    # offline: byte-level tokens, a deterministic "model" that never emits
+    # EOS, and fixed per-token costs instead of real compute.
+    def __init__(self, prefill_time=0.0005, decode_time=0.005):
+        self.prefill_time = prefill_time
+        self.decode_time = decode_time
+        self.eos_token_ids = set()
+
+    @classmethod
+    def load(cls, model=None, prefill_time=0.0005, decode_time=0.005, **options):
+        return cls(prefill_time=prefill_time, decode_time=decode_time)
+
+    def tokenize(self, text):
+        return list(text.encode("utf-8"))
+
+    def detokenizer(self):
+        return ByteDecoder(lambda token: bytes([token]))
+
+    def prefill(self, seq):
+        time.sleep(self.prefill_time * len(seq.prompt_ids))
+        seq.position = len(seq.prompt_ids)
+        return self._next(seq)
+
+    def decode_step(self, seqs):
+        # One step costs the same however many sequences it carries
+        time.sleep(self.decode_time)
+        return [self._next(seq) for seq in seqs]
+
+    def release(self, seq):
+        pass
+
+    def _next(self, seq):
+        # Printable ASCII derived from the position
+        seq.position += 1
+        return 32 + (seq.position * 7 + seq.prompt_ids[0]) % 95
+
+
+BACKENDS = {
+    "transformers": TransformersBackend,
+    "onnx": OnnxBackend,
+    "llama_cpp": LlamaCppBackend,
+    "dummy": DummyBackend,
+}
+
+
+def load_backend(name, model=None, **options):
+    return BACKENDS[name].load(model, **options)
@@ -0,0 +1,122 @@
+import logging
+import queue
+import threading
+import time
+
+_DONE = object()
+
+
+class BatchRequest:
+    # One prompt waiting for, or being decoded in, a batch. Decoded text is
+    # pushed as it is produced; iterate the request to stream it, or call
+    # result() to wait for the whole response.
+    def __init__(self, prompt):
+        self.prompt = prompt
+        self.pieces = []
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.finished = False
+        self.cancelled = False
+        self.error = None
+        # perf_counter timestamps for metrics; tokenize_time is set by
+        # whoever tokenizes the prompt
+        self.submitted_at = time.perf_counter()
+        self.started_at = None
+        self.first_token_at = None
+        self.finished_at = None
+        self.tokenize_time = None
+        self._queue = queue.Queue()
+
+    def start(self):
+        # Generation for this request has begun
+        self.started_at = time.perf_counter()
+
+    def emit(self, piece):
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        self.pieces.append(piece)
+        self.completion_tokens += 1
+        self._queue.put(piece)
+
+    def finish(self, error=None):
+        if self.finished:
+            return
+        self.finished = True
+        self.finished_at = time.perf_counter()
+        self.error = error
+        self._queue.put(_DONE)
+
+    def cancel(self):
+        # The client went away; the batch stops decoding this sequence
+        self.cancelled = True
+
+    def __iter__(self):
+        while True:
+            piece = self._queue.get()
+            if piece is _DONE:
+                break
+            yield piece
+        if self.error is not None:
+            raise self.error
+
+    def result(self):
+        for _ in self:
+            pass
+        return "".join(self.pieces)
+
+
+class DynamicBatcher:
+    # Collects requests for up to `window` seconds (or until max_batch_size
+    # are waiting) and hands them to run_batch(requests) as one batch on a
+    # single background thread. run_batch emits tokens into each request and
+    # may finish requests early; anything left open is finished afterwards.
+    def __init__(self, run_batch, max_batch_size=8, window=0.01):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.window = window
+        self._pending = queue.Queue()
+        self._thread = threading.Thread(target=self._loop, name="batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, prompt):
+        request = BatchRequest(prompt)
+        self._pending.put(request)
+        return request
+
+    def queue_depth(self):
+        return self._pending.qsize()
+
+    def _collect(self):
+        batch = [self._pending.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._pending.get(timeout=timeout))
+            except queue.Empty:
+                break
+        # Requests cancelled while queued are finished without decoding, so
+        # anything waiting on them wakes up
+        for request in batch:
+            if request.cancelled:
+                request.finish()
+        return [request for request in batch if not request.cancelled]
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            if not batch:
+                continue
+            for request in batch:
+                request.start()
+            try:
+                self.run_batch(batch)
+            except Exception as e:
+                logging.exception("Batch generation failed")
+                for request in batch:
+                    request.finish(e)
+            else:
+                for request in batch:
+                    request.finish()
@@ -0,0 +1,159 @@
+import argparse
+import json
+import resource
+import sys
+import time
+
+from backends import BACKENDS, load_backend
+
+# Fixed prompt set so runs on different backends and hosts are comparable
+PROMPTS = [
+    "What is the capital of France?",
+    "Explain the difference between a process and a thread.",
+    "Write a haiku about autumn leaves.",
+    "How to explain the Internet to a medieval knight?",
+    "Summarize the plot of Romeo and Juliet in three sentences.",
+    "List five tips for writing readable Python code and explain each one briefly.",
+    "A train leaves at 3pm travelling at 80 km/h. Another leaves the same station at 4pm "
+    "travelling at 100 km/h in the same direction. When does the second train catch up?",
+    "You are reviewing a pull request that adds a cache in front of a slow database query. "
+    "Describe what you would check before approving it, covering correctness, invalidation, "
+    "memory use and observability.",
+]
+
+chat_template = '<|user|>\n{input}<|end|>\n<|assistant|>\n'
+
+
+def percentile(values, q):
+    # Linear interpolation between closest ranks
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * q / 100
+    low = int(k)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (k - low)
+
+
+def peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def run_prompt(backend, prompt, max_new_tokens, keep_tokens=False):
+    prompt_ids = backend.tokenize(chat_template.format(input=prompt))
+    start = time.perf_counter()
+    token_times = []
+    token_ids = []
+    for token in backend.generate(prompt_ids, max_new_tokens=max_new_tokens):
+        token_times.append(time.perf_counter())
+        token_ids.append(token)
+    end = time.perf_counter()
+
+    result = {
+        "prompt_tokens": len(prompt_ids),
+        "completion_tokens": len(token_times),
+        "time_to_first_token": token_times[0] - start if token_times else None,
+        "inter_token_latencies": [b - a for a, b in zip(token_times, token_times[1:])],
+        "total": end - start,
+    }
+    decode_time = token_times[-1] - token_times[0] if len(token_times) > 1 else 0
+    result["decode_tokens_per_second"] = (len(token_times) - 1) / decode_time if decode_time > 0 else None
+    if keep_tokens:
+        result["prompt_ids"] = prompt_ids
+        result["token_ids"] = token_ids
+    return result
+
+
+def summarize(results):
+    def distribution(values):
+        values = [v for v in values if v is not None]
+        return {f"p{q}": percentile(values, q) for q in (50, 95, 99)}
+
+    completion_tokens = sum(r["completion_tokens"] for r in results)
+    total_time = sum(r["total"] for r in results)
+    return {
+        "requests": len(results),
+        "completion_tokens": completion_tokens,
+        "tokens_per_second": completion_tokens / total_time if total_time else None,
+        "time_to_first_token": distribution([r["time_to_first_token"] for r in results]),
+        "inter_token_latency": distribution([t for r in results for t in r["inter_token_latencies"]]),
+        "decode_tokens_per_second": distribution([r["decode_tokens_per_second"] for r in results]),
+        "end_to_end": distribution([r["total"] for r in results]),
+    }
+
+
+def load_prompts(path):
+    if not path:
+        return PROMPTS
+    with open(path) as f:
+        return [json.loads(line)["prompt"] for line in f if line.strip()]
+
+
+def format_ms(seconds):
+    return "-" if seconds is None else f"{seconds * 1000:.1f}"
+
+
+def print_report(report):
+    summary = report["summary"]
+    print(f"backend:           {report['backend']} ({report['model']})")
+    print(f"load time:         {report['load_time']:.2f} s")
+    print(f"requests:          {summary['requests']}")
+    print(f"tokens/sec:        {summary['tokens_per_second'] or 0:.2f}")
+    print(f"peak RSS:          {report['peak_rss_bytes'] / 2**20:.0f} MiB")
+    print(f"{'(ms)':<18} {'p50':>9} {'p95':>9} {'p99':>9}")
+    for name in ("time_to_first_token", "inter_token_latency", "end_to_end"):
+        row = summary[name]
+        print(f"{name:<18} {format_ms(row['p50']):>9} {format_ms(row['p95']):>9} {format_ms(row['p99']):>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latency/throughput benchmark for the inference backends")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="dummy")
+    parser.add_argument("--model", help="Model id or path (not needed for the dummy backend)")
+    parser.add_argument("--prompts", help="JSONL file with a 'prompt' field per line (default: built-in set)")
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--repeats", type=int, default=3, help="Times to run the prompt set")
+    parser.add_argument("--warmup", type=int, default=1, help="Untimed prompts run before measuring")
+    parser.add_argument("--threads", type=int, help="CPU threads (llama_cpp backend)")
+    parser.add_argument("--quantize", choices=["int8"], help="Quantize the Linear layers (transformers backend)")
+    parser.add_argument("--output", help="Write the full report as JSON to this path")
+    args = parser.parse_args()
+
+    options = {}
+    if args.threads:
+        options["n_threads"] = args.threads
+    if args.quantize:
+        options["quantize"] = args.quantize
+
+    start = time.perf_counter()
+    backend = load_backend(args.backend, args.model, **options)
+    load_time = time.perf_counter() - start
+
+    prompts = load_prompts(args.prompts)
+    for prompt in prompts[:args.warmup]:
+        run_prompt(backend, prompt, args.max_new_tokens)
+
+    results = []
+    for _ in range(args.repeats):
+        for prompt in prompts:
+            results.append(run_prompt(backend, prompt, args.max_new_tokens))
+
+    report = {
+        "backend": args.backend,
+        "model": args.model,
+        "max_new_tokens": args.max_new_tokens,
+        "load_time": load_time,
+        "peak_rss_bytes": peak_rss_bytes(),
+        "summary": summarize(results),
+        "results": results,
+    }
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
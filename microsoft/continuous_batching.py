@@ -0,0 +1,111 @@
+import logging
+import queue
+import threading
+import time
+
+from backends import Sequence
+from batcher import BatchRequest
+
+
+class ContinuousBatchScheduler:
+    # Iteration-level scheduling: a single thread runs decode steps over the
+    # running batch, and between any two steps it admits waiting sequences
+    # (prefill) into free slots and drops finished ones. A new request never
+    # waits for an unrelated generation to run to completion.
+    #
+    # The backend is any backends.Backend.
+    def __init__(self, backend, max_batch_size=8, max_new_tokens=256):
+        self.backend = backend
+        if backend.max_batch_size:
+            max_batch_size = min(max_batch_size, backend.max_batch_size)
+        self.max_batch_size = max_batch_size
+        self.max_new_tokens = max_new_tokens
+        self._pending = queue.Queue()
+        self._active = []
+        self._thread = threading.Thread(target=self._loop, name="continuous-batching", daemon=True)
+        self._thread.start()
+
+    def submit(self, prompt, max_new_tokens=None, temperature=0.0, top_p=1.0, prompt_ids=None):
+        request = BatchRequest(prompt)
+        if prompt_ids is None:
+            start = time.perf_counter()
+            prompt_ids = self.backend.tokenize(prompt)
+            request.tokenize_time = time.perf_counter() - start
+        request.prompt_tokens = len(prompt_ids)
+        self._pending.put(Sequence(
+            request,
+            prompt_ids,
+            max_new_tokens or self.max_new_tokens,
+            temperature=temperature,
+            top_p=top_p,
+        ))
+        return request
+
+    def queue_depth(self):
+        return self._pending.qsize()
+
+    def stats(self):
+        return {
+            "running": len(self._active),
+            "waiting": self._pending.qsize(),
+            "max_batch_size": self.max_batch_size,
+        }
+
+    def _loop(self):
+        while True:
+            # Sleep until there is work
+            if not self._active:
+                self._admit(self._pending.get())
+
+            while len(self._active) < self.max_batch_size:
+                try:
+                    seq = self._pending.get_nowait()
+                except queue.Empty:
+                    break
+                self._admit(seq)
+
+            if not self._active:
+                continue
+
+            running = list(self._active)
+            try:
+                tokens = self.backend.decode_step(running)
+            except Exception as e:
+                logging.exception("Decode step failed")
+                for seq in running:
+                    self._finish(seq, e)
+                continue
+
+            for seq, token in zip(running, tokens):
+                self._accept(seq, token)
+
+    def _admit(self, seq):
+        if seq.request.cancelled:
+            seq.request.finish()
+            return
+        seq.request.start()
+        seq.detokenizer = self.backend.detokenizer()
+        try:
+            token = self.backend.prefill(seq)
+        except Exception as e:
+            logging.exception("Prefill failed")
+            seq.request.finish(e)
+            return
+        self._active.append(seq)
+        self._accept(seq, token)
+
+    def _accept(self, seq, token):
+        if seq.request.cancelled or token is None or token in self.backend.eos_token_ids:
+            self._finish(seq)
+            return
+        seq.last_token = token
+        seq.generated += 1
+        seq.request.emit(seq.detokenizer.decode(token))
+        if seq.generated >= seq.max_new_tokens:
+            self._finish(seq)
+
+    def _finish(self, seq, error=None):
+        # Free the slot right away so the next step runs without it
+        self._active.remove(seq)
+        self.backend.release(seq)
+        seq.request.finish(error)
@@ -1,87 +1,351 @@
 import gradio as gr
+import hashlib
+import json
 import os
+import sys
+import threading
 import time
+from collections import OrderedDict
+from contextlib import contextmanager
+import numpy as np
 import onnxruntime_genai as og
+import uvicorn
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse, Response
 
-# Global variable to hold the model
+# metrics.py is shared with the other inference servers and lives in
+# ../../common; the image copies it next to app.py
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "common"))
+import metrics
+
+# Global variables to hold the model and the objects built from it once
 model = None
+processor = None
+tokenizer = None
+bos_ids = []
+kv_bytes_per_token = 0
+
+# The model loads on a background thread while the server is already up;
+# /healthz and /ready report progress and per-phase timings in seconds
+load_state = "starting"
+load_error = None
+load_timings = {}
+
+# Short text-only generations run before the app reports ready
+WARMUP_PROMPT = "Hello! Introduce yourself in one sentence."
+WARMUP_PROMPTS = int(os.getenv("WARMUP_PROMPTS", "1"))
+WARMUP_TOKENS = int(os.getenv("WARMUP_TOKENS", "8"))
+
+# The KV cache is allocated for max_length tokens up front, so each request
+# asks for its prompt plus MAX_NEW_TOKENS (never more than MAX_LENGTH), and
+# requests only start while their KV fits in KV_BUDGET_BYTES. A request
+# waits up to ADMISSION_TIMEOUT seconds for room before it is rejected.
+MAX_NEW_TOKENS = int(os.getenv("MAX_NEW_TOKENS", "1024"))
+MAX_LENGTH = int(os.getenv("MAX_LENGTH", "7680"))
+KV_BUDGET_BYTES = int(os.getenv("KV_BUDGET_BYTES", str(4 << 30)))
+KV_DTYPE_BYTES = int(os.getenv("KV_DTYPE_BYTES", "4"))  # float32 KV on CPU
+ADMISSION_TIMEOUT = float(os.getenv("ADMISSION_TIMEOUT", "30"))
+
+# Up to GENERATION_WORKERS requests generate at once, each with its own
+# generator over the shared model; more wait in Gradio's queue (at most
+# QUEUE_SIZE). INTRA_OP_THREADS splits the CPU cores between the workers.
+GENERATION_WORKERS = int(os.getenv("GENERATION_WORKERS", "2"))
+QUEUE_SIZE = int(os.getenv("QUEUE_SIZE", "32"))
+INTRA_OP_THREADS = int(os.getenv("INTRA_OP_THREADS", str(max(1, (os.cpu_count() or 1) // GENERATION_WORKERS))))
+
+# Preprocessed images are kept within this many bytes of pixel tensors
+IMAGE_CACHE_BYTES = int(os.getenv("IMAGE_CACHE_BYTES", str(512 << 20)))
+
+# The image part of the prompt. Everything after it is tokenized per request.
+IMAGE_PROMPT = "<|user|>\n<|image_1|>"
+
+
+class ImageCache:
+    # LRU of preprocessed images keyed by a hash of the file contents, so
+    # follow-up questions about the same image skip image preprocessing.
+    # Each entry holds the pixel tensors plus the token ids of IMAGE_PROMPT
+    # (with the image placeholder expanded for that image's size).
+    def __init__(self, capacity_bytes):
+        self.capacity_bytes = capacity_bytes
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, entry):
+        size = sum(value.nbytes for value in entry.values())
+        if size > self.capacity_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = entry
+            self.size_bytes += size
+            while self.size_bytes > self.capacity_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size_bytes -= sum(value.nbytes for value in evicted.values())
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class AdmissionError(Exception):
+    pass
+
+
+class KVBudget:
+    # Admission control over a global KV memory budget. Requests reserve
+    # their worst-case KV size before generating and release it when done.
+    def __init__(self, capacity_bytes, timeout):
+        self.capacity_bytes = capacity_bytes
+        self.timeout = timeout
+        self.reserved_bytes = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def reserve(self, nbytes):
+        if nbytes > self.capacity_bytes:
+            raise AdmissionError("The request needs more memory than the server allows, try a shorter prompt.")
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.reserved_bytes + nbytes <= self.capacity_bytes, self.timeout):
+                raise AdmissionError("The server is busy, please try again shortly.")
+            self.reserved_bytes += nbytes
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.reserved_bytes -= nbytes
+                self._cond.notify_all()
+
+
+def kv_size_per_token(model_path):
+    # Keys and values for every layer, from the model's genai_config.json
+    with open(os.path.join(model_path, "genai_config.json")) as f:
+        decoder = json.load(f)["model"]["decoder"]
+    return 2 * decoder["num_hidden_layers"] * decoder["num_key_value_heads"] * decoder["head_size"] * KV_DTYPE_BYTES
+
+
+kv_budget = KVBudget(KV_BUDGET_BYTES, ADMISSION_TIMEOUT)
+metrics.KV_RESERVED.set_function(lambda: kv_budget.reserved_bytes)
+
+image_cache = ImageCache(IMAGE_CACHE_BYTES)
+metrics.CACHE_HIT_RATE.labels(cache="image").set_function(image_cache.hit_rate)
+
+
+def preprocess_image(image_path):
+    start = time.time()
+    with open(image_path, "rb") as f:
+        key = hashlib.sha256(f.read()).hexdigest()
+
+    entry = image_cache.get(key)
+    if entry is None:
+        inputs = processor(IMAGE_PROMPT, images=og.Images.open(image_path))
+        entry = {
+            "input_ids": inputs["input_ids"].as_numpy(),
+            "pixel_values": inputs["pixel_values"].as_numpy(),
+            "image_sizes": inputs["image_sizes"].as_numpy(),
+        }
+        image_cache.put(key, entry)
+        # Only requests that actually preprocessed an image are recorded, so
+        # text-only requests and cache hits don't pull the histogram down
+        metrics.IMAGE_PREPROCESS.observe(time.time() - start)
+    return entry
+
+
+def image_inputs(entry, prompt_text):
+    # The processor tokenizes the text around an image tag as separate chunks,
+    # so appending the tokens of the rest of the prompt to the cached image
+    # part gives the same ids as processing the whole prompt. Every encoded
+    # chunk starts with BOS, which the processor already placed.
+    text_ids = tokenizer.encode(f"\n{prompt_text}<|end|>\n<|assistant|>\n")[len(bos_ids):]
+    input_ids = entry["input_ids"]
+    inputs = og.NamedTensors()
+    inputs["input_ids"] = np.concatenate([input_ids, text_ids.astype(input_ids.dtype)[None, :]], axis=1)
+    inputs["pixel_values"] = entry["pixel_values"]
+    inputs["image_sizes"] = entry["image_sizes"]
+    return inputs
+
 
 def generate_response(image, prompt_text, provider):
-    # Ensure the model is loaded once
-    global model
+    # Generator: yields the response so far after every token, which Gradio
+    # streams into the output Textbox
+    if load_state != "ready":
+        yield "The model is still loading, please try again shortly."
+        return
+
+    received_at = time.time()
 
-    # If the image is provided, process it
-    prompt = "<|user|>\n"
+    # If the image is provided, process it (or reuse it from the cache)
+    entry = None
     if image:
         try:
             image_path = image  # Single image path, so no need for a loop
             if not os.path.exists(image_path):
                 raise FileNotFoundError(f"Image file not found: {image_path}")
             print(f"Using image: {image_path}")
-            prompt += f"<|image_1|>\n"
-
-            images = og.Images.open(image_path)
+            entry = preprocess_image(image_path)
         except Exception as e:
-            return f"Error loading image: {e}"
-    else:
-        images = None
+            yield f"Error loading image: {e}"
+            return
+    preprocessed_at = time.time()
 
-    prompt += f"{prompt_text}<|end|>\n<|assistant|>\n"
-    print("Processing images and prompt...")
-    processor = model.create_multimodal_processor()
+    if entry is not None:
+        inputs = image_inputs(entry, prompt_text)
+    else:
+        inputs = processor(f"<|user|>\n{prompt_text}<|end|>\n<|assistant|>\n", images=None)
     tokenizer_stream = processor.create_stream()
-    inputs = processor(prompt, images=images)
-
-    # Generate response
-    print("Generating response...")
-    params = og.GeneratorParams(model)
-    params.set_inputs(inputs)
-    params.set_search_options(max_length=7680)
-
-    generator = og.Generator(model, params)
-    start_time = time.time()
-
-    response = ""
-    while not generator.is_done():
-        generator.compute_logits()
-        generator.generate_next_token()
-
-        new_token = generator.get_next_tokens()[0]
-        response += tokenizer_stream.decode(new_token)
-
-    total_run_time = time.time() - start_time
-    print(f"Total Time: {total_run_time:.2f}")
-    return response
+    tokenized_at = time.time()
+    metrics.TOKENIZE.observe(tokenized_at - preprocessed_at)
+
+    # Size the KV cache for this prompt instead of the model's maximum
+    input_length = inputs["input_ids"].as_numpy().shape[-1]
+    max_length = min(input_length + MAX_NEW_TOKENS, MAX_LENGTH)
+    if input_length >= max_length:
+        yield f"Error: the prompt is {input_length} tokens, the limit is {MAX_LENGTH}."
+        return
+    kv_bytes = max_length * kv_bytes_per_token
+
+    try:
+        with kv_budget.reserve(kv_bytes):
+            metrics.QUEUE_WAIT.observe(time.time() - tokenized_at)
+
+            # Generate response. Every worker thread runs its own generator
+            # over the shared model weights.
+            print(f"Generating response (max_length={max_length}, kv={kv_bytes / 2**20:.0f} MiB)...")
+            params = og.GeneratorParams(model)
+            params.set_inputs(inputs)
+            params.set_search_options(max_length=max_length)
+
+            generator = og.Generator(model, params)
+            start_time = time.time()
+
+            response = ""
+            first_token_time = None
+            completion_tokens = 0
+            with metrics.IN_FLIGHT.track_inprogress():
+                while not generator.is_done():
+                    generator.compute_logits()
+                    generator.generate_next_token()
+                    if first_token_time is None:
+                        first_token_time = time.time()
+
+                    new_token = generator.get_next_tokens()[0]
+                    response += tokenizer_stream.decode(new_token)
+                    completion_tokens += 1
+                    yield response
+            end_time = time.time()
+
+            # Free the KV buffers before giving back the reservation
+            del generator
+    except AdmissionError as e:
+        yield str(e)
+        return
+
+    if first_token_time is None:
+        return
+    prefill_time = first_token_time - start_time
+    decode_time = end_time - first_token_time
+    metrics.TIME_TO_FIRST_TOKEN.observe(first_token_time - received_at)
+    # Tokenizing was observed above, with image preprocessing split out
+    metrics.observe_generation(None, prefill_time, decode_time, input_length, completion_tokens)
+
+    print(
+        f"Total Time: {end_time - received_at:.2f} "
+        f"(image preprocessing {preprocessed_at - received_at:.2f}, prefill {prefill_time:.2f}, "
+        f"decode {decode_time:.2f} for {completion_tokens} tokens)"
+    )
 
 
-# Gradio interface
-def gradio_interface(model_path, provider):
-    global model
+# Load the model once and warm it up
+def load_model(model_path, provider):
+    global model, processor, tokenizer, bos_ids, kv_bytes_per_token, load_state, load_error
 
-    # Load the model once, outside the Gradio interface
-    if model is None:
+    try:
+        load_state = "loading"
         print("Loading model...")
+        start_time = time.time()
         if hasattr(og, 'Config'):
             config = og.Config(model_path)
             config.clear_providers()
             if provider != "cpu":
                 print(f"Setting model to {provider}...")
                 config.append_provider(provider)
+            if hasattr(config, 'overlay'):
+                # Keep concurrent workers from oversubscribing the cores
+                config.overlay(json.dumps(
+                    {"model": {"decoder": {"session_options": {"intra_op_num_threads": INTRA_OP_THREADS}}}}
+                ))
             model = og.Model(config)
         else:
             model = og.Model(model_path)
+        load_timings["model"] = round(time.time() - start_time, 3)
         print("Model loaded.")
 
+        # Created once and shared by every request
+        start_time = time.time()
+        processor = model.create_multimodal_processor()
+        tokenizer = og.Tokenizer(model)
+        bos_ids = tokenizer.encode("").tolist()
+        kv_bytes_per_token = kv_size_per_token(model_path)
+        load_timings["processor"] = round(time.time() - start_time, 3)
+
+        load_state = "warming_up"
+        start_time = time.time()
+        for _ in range(WARMUP_PROMPTS):
+            warmup()
+        load_timings["warmup"] = round(time.time() - start_time, 3)
+    except Exception as e:
+        print(f"Error loading model: {e}")
+        load_error = str(e)
+        load_state = "failed"
+        return
+
+    load_state = "ready"
+    print(f"Model ready: {load_timings}")
+
+
+# Text-only, so this warms up the decoder; the vision encoder first runs on
+# the first uploaded image
+def warmup():
+    inputs = processor(f"<|user|>\n{WARMUP_PROMPT}<|end|>\n<|assistant|>\n", images=None)
+    params = og.GeneratorParams(model)
+    params.set_inputs(inputs)
+    params.set_search_options(max_length=inputs["input_ids"].as_numpy().shape[-1] + WARMUP_TOKENS)
+
+    generator = og.Generator(model, params)
+    for _ in range(WARMUP_TOKENS):
+        if generator.is_done():
+            break
+        generator.compute_logits()
+        generator.generate_next_token()
+
+
+# Gradio interface
+def gradio_interface(model_path, provider):
+    # Load the model in the background so health checks answer meanwhile
+    threading.Thread(target=load_model, args=(model_path, provider), daemon=True).start()
+
     # Gradio inputs for image and prompt
     image_input = gr.Image(type="filepath", label="Upload Image")
     prompt_input = gr.Textbox(label="Enter your prompt", lines=2)
 
-    # Function for processing the inputs and generating the response
+    # Function for processing the inputs and streaming the response
     def process_image_and_prompt(image, prompt_text):
-        response = generate_response(image, prompt_text, provider)
-        return response
+        yield from generate_response(image, prompt_text, provider)
 
-    # Create and launch the Gradio interface
+    # Create the Gradio interface
     interface = gr.Interface(
         fn=process_image_and_prompt,
         inputs=[image_input, prompt_input],
@@ -89,8 +353,33 @@ def gradio_interface(model_path, provider):
         title="Phi3 Vision CPU",
         description="Upload an image, enter a prompt, and get a response generated from the model."
     )
-    
-    interface.launch(server_name="0.0.0.0", server_port=4050)
+    interface.queue(default_concurrency_limit=GENERATION_WORKERS, max_size=QUEUE_SIZE)
+
+    # Serve the interface from FastAPI so it can sit next to health checks
+    app = FastAPI()
+
+    # Liveness: the process is up and the model load hasn't failed
+    @app.get("/healthz")
+    def healthz():
+        if load_state == "failed":
+            return JSONResponse(status_code=500, content={"status": load_state, "error": load_error})
+        return {"status": "ok"}
+
+    # Readiness: the model is loaded and warmed up
+    @app.get("/ready")
+    def ready():
+        status = {"status": load_state, "timings": load_timings}
+        if load_error:
+            status["error"] = load_error
+        return JSONResponse(status_code=200 if load_state == "ready" else 503, content=status)
+
+    @app.get("/metrics")
+    def metrics_endpoint():
+        body, content_type = metrics.render()
+        return Response(content=body, media_type=content_type)
+
+    app = gr.mount_gradio_app(app, interface, path="/")
+    uvicorn.run(app, host="0.0.0.0", port=4050)
 
 
 # Example: Initialize Gradio interface with your model path and provider
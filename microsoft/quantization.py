@@ -0,0 +1,77 @@
+import hashlib
+import os
+
+import torch
+import transformers
+from torch.ao.quantization import per_channel_dynamic_qconfig, quantize_dynamic
+from transformers import AutoConfig
+from transformers.dynamic_module_utils import get_class_from_dynamic_module
+
+# QUANTIZE=int8 swaps every nn.Linear for a dynamically quantized one: int8
+# weights with a scale per output channel, activations quantized on the fly
+# for each matmul. The converted model is cached under QUANTIZED_CACHE_DIR so
+# only the first start pays for loading float32 weights and converting them.
+QUANTIZE = os.getenv("QUANTIZE", "off")
+QUANTIZED_CACHE_DIR = os.getenv("QUANTIZED_CACHE_DIR", os.path.expanduser("~/.cache/quantized-models"))
+
+
+def cache_path(model_id, cache_dir=QUANTIZED_CACHE_DIR):
+    # The file pickles the modules themselves, so it is only valid for the
+    # torch and transformers versions that wrote it
+    key = f"{model_id}|int8-dynamic-per-channel|torch-{torch.__version__}|transformers-{transformers.__version__}"
+    name = model_id.strip("/").replace("/", "--")
+    return os.path.join(cache_dir, f"{name}-int8-{hashlib.sha256(key.encode()).hexdigest()[:12]}.pt")
+
+
+def quantize_int8(model):
+    # Dynamic quantization needs float32 weights to start from. Both .float()
+    # and the conversion work in place, so each Linear's float32 weights are
+    # freed as it is swapped for its int8 version instead of the whole float
+    # model staying alive next to the quantized one
+    return quantize_dynamic(
+        model.float(), {torch.nn.Linear: per_channel_dynamic_qconfig}, dtype=torch.qint8, inplace=True,
+    )
+
+
+def import_remote_code(model_id):
+    # A model loaded with trust_remote_code is pickled with references to the
+    # repo's own modelling module, which has to be imported before unpickling
+    config = AutoConfig.from_pretrained(model_id, trust_remote_code=True)
+    if getattr(config, "auto_map", None):
+        get_class_from_dynamic_module(config.auto_map["AutoModelForCausalLM"], model_id)
+
+
+def load_int8(model_id, load_float, phase, cache_dir=QUANTIZED_CACHE_DIR, trust_remote_code=False):
+    # load_float() builds the float model; it only runs on a cache miss
+    path = cache_path(model_id, cache_dir)
+    if os.path.exists(path):
+        with phase("weights"):
+            if trust_remote_code:
+                import_remote_code(model_id)
+            # Written by save below, so unpickling it is safe
+            model = torch.load(path, weights_only=False)
+        model.eval()
+        return model
+
+    with phase("weights"):
+        model = load_float()
+    with phase("quantize"):
+        # The only reference to the float model, which is converted in place
+        model = quantize_int8(model)
+    with phase("save_quantized"):
+        os.makedirs(cache_dir, exist_ok=True)
+        torch.save(model, path + ".tmp")
+        os.replace(path + ".tmp", path)
+    model.eval()
+    return model
+
+
+def weight_bytes(model):
+    # Bytes held by the weights; quantized layers keep theirs in packed
+    # (weight, bias) tuples rather than as parameters
+    total = 0
+    for value in model.state_dict().values():
+        for tensor in value if isinstance(value, tuple) else (value,):
+            if torch.is_tensor(tensor):
+                total += tensor.numel() * tensor.element_size()
+    return total
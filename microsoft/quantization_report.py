@@ -0,0 +1,124 @@
+import argparse
+import json
+import math
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+
+from backends import load_backend
+from benchmark import load_prompts, peak_rss_bytes, run_prompt, summarize
+from quantization import weight_bytes
+
+# Load options of each precision on the transformers backend
+MODES = {
+    "bf16": {"torch_dtype": "bfloat16"},
+    "fp32": {"torch_dtype": "float32"},
+    "int8": {"quantize": "int8"},
+}
+
+
+def score(model, reference):
+    # Teacher-forced on the reference precision's greedy completions: how
+    # often this model's top token is the reference token, and the
+    # perplexity it assigns to the reference text
+    agree = total = 0
+    nll = 0.0
+    for prompt_ids, token_ids in reference:
+        if not token_ids:
+            continue
+        ids = torch.tensor([prompt_ids + token_ids])
+        with torch.inference_mode():
+            logits = model(ids).logits[0, len(prompt_ids) - 1:-1].float()
+        targets = ids[0, len(prompt_ids):]
+        agree += int((logits.argmax(dim=-1) == targets).sum())
+        nll += float(torch.nn.functional.cross_entropy(logits, targets, reduction="sum"))
+        total += len(token_ids)
+    if not total:
+        return {"top1_agreement": None, "perplexity": None}
+    return {"top1_agreement": agree / total, "perplexity": math.exp(nll / total)}
+
+
+def evaluate(mode, model_id, prompts, max_new_tokens, repeats, reference):
+    # Runs in a fresh process per mode, so peak RSS belongs to this mode
+    start = time.perf_counter()
+    backend = load_backend("transformers", model_id, **MODES[mode])
+    load_time = time.perf_counter() - start
+
+    run_prompt(backend, prompts[0], max_new_tokens)
+    results = [run_prompt(backend, prompt, max_new_tokens, keep_tokens=True) for _ in range(repeats) for prompt in prompts]
+    completions = [(r["prompt_ids"], r["token_ids"]) for r in results[:len(prompts)]]
+
+    report = {
+        "mode": mode,
+        "load_time": load_time,
+        "weight_bytes": weight_bytes(backend.model),
+        "peak_rss_bytes": peak_rss_bytes(),
+        "summary": summarize(results),
+        "completions": completions,
+    }
+    if reference is not None:
+        report.update(score(backend.model, reference))
+        report["exact_match"] = sum(ours == theirs for ours, theirs in zip(completions, reference)) / len(prompts)
+    return report
+
+
+def format_value(value, spec):
+    return "-" if value is None else format(value, spec)
+
+
+def print_table(reports):
+    # Markdown, so it can be pasted into a PR or the docs
+    print("| mode | weights (MiB) | peak RSS (MiB) | load (s) | tokens/s | p50 ITL (ms) | exact match | top-1 agreement | perplexity |")
+    print("|---|---|---|---|---|---|---|---|---|")
+    for r in reports:
+        summary = r["summary"]
+        itl = summary["inter_token_latency"]["p50"]
+        cells = [
+            r["mode"],
+            format_value(r["weight_bytes"] / 2**20, ".0f"),
+            format_value(r["peak_rss_bytes"] / 2**20, ".0f"),
+            format_value(r["load_time"], ".1f"),
+            format_value(summary["tokens_per_second"], ".2f"),
+            format_value(itl * 1000 if itl is not None else None, ".1f"),
+            format_value(r.get("exact_match", 1.0), ".2f"),
+            format_value(r.get("top1_agreement"), ".3f"),
+            format_value(r.get("perplexity"), ".3f"),
+        ]
+        print("| " + " | ".join(cells) + " |")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Accuracy vs throughput of the transformers backend at each precision")
+    parser.add_argument("--model", default="microsoft/Phi-3-mini-4k-instruct")
+    parser.add_argument("--modes", default="bf16,int8", help="Comma-separated; the first is the accuracy reference")
+    parser.add_argument("--prompts", help="JSONL file with a 'prompt' field per line (default: built-in set)")
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--repeats", type=int, default=1, help="Times to run the prompt set")
+    parser.add_argument("--output", help="Write the full report as JSON to this path")
+    args = parser.parse_args()
+
+    modes = args.modes.split(",")
+    prompts = load_prompts(args.prompts)
+    context = multiprocessing.get_context("spawn")
+    reports = []
+    reference = None
+    for mode in modes:
+        # An executor rather than a Pool: if the mode runs out of memory and
+        # its process is killed, this raises instead of waiting forever
+        with ProcessPoolExecutor(1, mp_context=context) as pool:
+            report = pool.submit(evaluate, mode, args.model, prompts, args.max_new_tokens, args.repeats, reference).result()
+        if reference is None:
+            reference = report["completions"]
+        reports.append(report)
+        print(f"{mode}: {report['summary']['tokens_per_second'] or 0:.2f} tokens/s")
+
+    print_table(reports)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"model": args.model, "max_new_tokens": args.max_new_tokens, "reports": reports}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+
+def normalize_prompt(text):
+    # Treat prompts that differ only in unicode form or surrounding
+    # whitespace as equal. Whitespace inside the prompt is kept: newlines and
+    # indentation change the output for code, lists and few-shot formats.
+    return unicodedata.normalize("NFC", text).strip()
+
+
+def is_deterministic(params):
+    # Only greedy decoding produces the same output for the same prompt.
+    # Both transformers and onnxruntime-genai default to do_sample=False.
+    return not params.get("do_sample", False) or params.get("temperature", 1.0) <= 0
+
+
+def cache_key(prompt, model_id, params):
+    payload = json.dumps(
+        {"prompt": normalize_prompt(prompt), "model": model_id, "params": params},
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    # Exact-match cache of generated responses. An in-memory LRU sits in
+    # front of an optional sqlite file, so entries survive restarts and can
+    # be shared by workers on the same host. Values must be JSON-serializable.
+    def __init__(self, max_entries=1024, ttl=3600, path=None, max_disk_entries=100000):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_disk_entries = max_disk_entries
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            self._db.commit()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                value, created = entry
+                if now - created <= self.ttl:
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._memory[key]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT value, created FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and now - row[1] <= self.ttl:
+                    value = json.loads(row[0])
+                    self._remember(key, value, row[1])
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return value
+
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._remember(key, value, now)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses (key, value, created) VALUES (?, ?, ?)",
+                    (key, json.dumps(value), now),
+                )
+                # Expire old rows, then trim the oldest beyond the size limit
+                self._db.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+                self._db.execute(
+                    "DELETE FROM responses WHERE key IN "
+                    "(SELECT key FROM responses ORDER BY created DESC LIMIT -1 OFFSET ?)",
+                    (self.max_disk_entries,),
+                )
+                self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._memory),
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+    def _remember(self, key, value, created):
+        self._memory[key] = (value, created)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+
+def response_cache_from_env():
+    # RESPONSE_CACHE_SIZE=0 turns the cache off
+    max_entries = int(os.getenv("RESPONSE_CACHE_SIZE", "1024"))
+    if max_entries <= 0:
+        return None
+    return ResponseCache(
+        max_entries=max_entries,
+        ttl=int(os.getenv("RESPONSE_CACHE_TTL", "3600")),
+        path=os.getenv("RESPONSE_CACHE_PATH"),
+        max_disk_entries=int(os.getenv("RESPONSE_CACHE_DISK_ENTRIES", "100000")),
+    )
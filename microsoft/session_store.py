@@ -0,0 +1,105 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+def cache_nbytes(past_key_values):
+    # Size of a transformers KV cache (Cache object or legacy tuples)
+    if past_key_values is None:
+        return 0
+    if hasattr(past_key_values, "to_legacy_cache"):
+        past_key_values = past_key_values.to_legacy_cache()
+    return sum(t.numel() * t.element_size() for layer in past_key_values for t in layer)
+
+
+class Session:
+    # One client's conversation plus the KV cache of the tokens it has
+    # already been through, so the next turn only prefills new tokens.
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.messages = []
+        self.token_ids = []
+        self.past_key_values = None
+        self.kv_bytes = 0
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reusable_prefix(self, token_ids):
+        # Number of leading tokens of token_ids whose KV is already cached
+        if self.past_key_values is None:
+            return 0
+        cached = min(len(self.token_ids), self.past_key_values.get_seq_length())
+        n = 0
+        for a, b in zip(self.token_ids[:cached], token_ids):
+            if a != b:
+                break
+            n += 1
+        # generate() needs at least one uncached input token
+        return min(n, len(token_ids) - 1)
+
+    def update_cache(self, token_ids, past_key_values):
+        self.token_ids = token_ids
+        self.past_key_values = past_key_values
+        self.kv_bytes = cache_nbytes(past_key_values)
+
+    def drop_cache(self):
+        self.token_ids = []
+        self.past_key_values = None
+        self.kv_bytes = 0
+
+
+class SessionStore:
+    # Sessions keyed by id, in LRU order. Sessions idle for longer than ttl
+    # are dropped. When the KV caches together exceed max_bytes, the least
+    # recently used sessions lose their cache (but keep their history) and
+    # are prefilled from scratch on their next turn.
+    def __init__(self, ttl=1800, max_bytes=2 << 30, max_sessions=256):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id=None):
+        with self._lock:
+            self._expire()
+            if session_id is None:
+                session_id = uuid.uuid4().hex
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = Session(session_id)
+                self._sessions[session_id] = session
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+            self._sessions.move_to_end(session_id)
+            session.last_used = time.monotonic()
+            return session
+
+    def enforce_budget(self):
+        with self._lock:
+            total = sum(s.kv_bytes for s in self._sessions.values())
+            for session in list(self._sessions.values()):
+                if total <= self.max_bytes:
+                    break
+                # Skip sessions that are generating right now
+                if session.kv_bytes and session.lock.acquire(blocking=False):
+                    total -= session.kv_bytes
+                    session.drop_cache()
+                    session.lock.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "kv_bytes": sum(s.kv_bytes for s in self._sessions.values()),
+                "max_bytes": self.max_bytes,
+            }
+
+    def _expire(self):
+        now = time.monotonic()
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if now - session.last_used <= self.ttl:
+                break
+            del self._sessions[session_id]
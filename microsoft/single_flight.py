@@ -0,0 +1,133 @@
+import threading
+
+import metrics
+
+
+class Flight:
+    # One generation shared by every identical request that arrived while it
+    # ran. Pieces are kept as they are produced, so a request that joins late
+    # gets the text so far and then follows along live. Iterate a flight to
+    # stream it; leave() when done so the generation can be cancelled once
+    # nobody is reading it any more.
+    def __init__(self):
+        self.pieces = []
+        self.done = False
+        self.error = None
+        self.followers = 0
+        self._readers = 1
+        # What start() returned; set by SingleFlight once start() is done
+        self.generation = None
+        self._started = threading.Event()
+        self._cond = threading.Condition()
+
+    def emit(self, piece):
+        with self._cond:
+            self.pieces.append(piece)
+            self._cond.notify_all()
+
+    def finish(self, error=None):
+        with self._cond:
+            self.done = True
+            self.error = error
+            self._cond.notify_all()
+
+    def wait_generation(self):
+        # The generation, once the request that started the flight has
+        # created it; raises start()'s error if that failed
+        self._started.wait()
+        if self.generation is None:
+            raise self.error
+        return self.generation
+
+    def join(self):
+        with self._cond:
+            self.followers += 1
+            self._readers += 1
+
+    def leave(self):
+        with self._cond:
+            self._readers -= 1
+            abandoned = self._readers == 0 and not self.done
+        cancel = getattr(self.generation, "cancel", None)
+        if abandoned and cancel is not None:
+            cancel()
+
+    def __iter__(self):
+        sent = 0
+        while True:
+            with self._cond:
+                while sent == len(self.pieces) and not self.done:
+                    self._cond.wait()
+                new = self.pieces[sent:]
+                done = self.done
+            sent += len(new)
+            yield from new
+            if done and sent == len(self.pieces):
+                break
+        if self.error is not None:
+            raise self.error
+
+    def result(self):
+        for _ in self:
+            pass
+        return "".join(self.pieces)
+
+
+class SingleFlight:
+    # Coalesces identical in-flight requests: the first request for a key
+    # starts the generation and later ones join its Flight instead of running
+    # their own. start() returns an iterable of text pieces (and may have a
+    # cancel() method); a background thread drains it into the flight, so the
+    # stream goes on for the others if the request that started it goes away.
+    # A flight is forgotten as soon as it finishes; requests after that start
+    # a new one (or hit the response cache).
+    def __init__(self):
+        self.started = 0
+        self.coalesced = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def join(self, key, start):
+        # Returns (flight, started); started is True for the request whose
+        # start() runs the generation. The flight is registered before
+        # start() runs, outside the lock, so identical requests can join
+        # while it sets up and other keys never wait on it.
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight.join()
+                self.coalesced += 1
+                metrics.COALESCED_REQUESTS.inc()
+                return flight, False
+            flight = Flight()
+            self._flights[key] = flight
+            self.started += 1
+
+        try:
+            flight.generation = start()
+        except Exception as e:
+            self._finish(key, flight, e)
+            raise
+        finally:
+            flight._started.set()
+        threading.Thread(target=self._pump, args=(key, flight), name="single-flight", daemon=True).start()
+        return flight, True
+
+    def stats(self):
+        with self._lock:
+            in_flight = len(self._flights)
+        return {"in_flight": in_flight, "started": self.started, "coalesced": self.coalesced}
+
+    def _pump(self, key, flight):
+        error = None
+        try:
+            for piece in flight.generation:
+                flight.emit(piece)
+        except Exception as e:
+            error = e
+        self._finish(key, flight, error)
+
+    def _finish(self, key, flight, error):
+        with self._lock:
+            del self._flights[key]
+        flight.finish(error)
@@ -0,0 +1,102 @@
+import os
+import threading
+
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+import metrics
+
+# SPECULATIVE=prompt_lookup drafts tokens by matching the newest n-gram
+# against earlier text in the conversation; SPECULATIVE=draft runs the small
+# DRAFT_MODEL ahead of the target. Either way generate() checks all drafted
+# tokens in one forward pass of the target model and keeps only what the
+# target itself would have produced (greedy) or accepts them by
+# speculative sampling, so outputs are distributed exactly as without it.
+SPECULATIVE = os.getenv("SPECULATIVE", "off")
+PROMPT_LOOKUP_TOKENS = int(os.getenv("PROMPT_LOOKUP_TOKENS", "10"))
+DRAFT_MODEL = os.getenv("DRAFT_MODEL", "")
+
+
+class Speculation:
+    # Generation settings for the chosen mode, plus per-request accounting.
+    # A forward pre-hook on the target model counts its passes and input
+    # tokens on the calling thread: each pass takes the tokens not yet in
+    # the KV cache (the uncached prompt on the first pass, the previous
+    # pass's correction token after that) followed by the drafted tokens.
+    def __init__(self, model, mode, lookup_tokens=PROMPT_LOOKUP_TOKENS, draft_model=None, tokenizers=None):
+        self.mode = mode
+        self.lookup_tokens = lookup_tokens
+        self.draft_model = draft_model
+        self.tokenizers = tokenizers
+        self._local = threading.local()
+        model.register_forward_pre_hook(self._count_pass, with_kwargs=True)
+
+    @classmethod
+    def load(cls, model, tokenizer, torch_dtype, phase, mode=SPECULATIVE):
+        if mode == "off":
+            return None
+        if mode == "prompt_lookup":
+            return cls(model, mode)
+        if mode != "draft":
+            raise ValueError(f"Unknown SPECULATIVE mode: {mode}")
+        if not DRAFT_MODEL:
+            raise ValueError("SPECULATIVE=draft needs DRAFT_MODEL")
+
+        with phase("draft"):
+            draft_model = AutoModelForCausalLM.from_pretrained(
+                DRAFT_MODEL,
+                torch_dtype=torch_dtype,
+                device_map="cpu",
+                low_cpu_mem_usage=True,
+            )
+            draft_tokenizer = AutoTokenizer.from_pretrained(DRAFT_MODEL)
+        # A draft with a different vocabulary is aligned through text, which
+        # generate() does when it is given both tokenizers
+        tokenizers = None
+        if draft_tokenizer.get_vocab() != tokenizer.get_vocab():
+            tokenizers = {"tokenizer": tokenizer, "assistant_tokenizer": draft_tokenizer}
+        return cls(model, mode, draft_model=draft_model, tokenizers=tokenizers)
+
+    def generate_kwargs(self):
+        if self.mode == "prompt_lookup":
+            return {"prompt_lookup_num_tokens": self.lookup_tokens}
+        kwargs = {"assistant_model": self.draft_model}
+        kwargs.update(self.tokenizers or {})
+        return kwargs
+
+    def start(self):
+        # Call on the thread that runs generate(), before it starts
+        self._local.passes = 0
+        self._local.input_tokens = 0
+        self._local.active = True
+
+    def stop(self):
+        self._local.active = False
+
+    def finish(self, uncached_prompt_tokens, completion_tokens):
+        # Stats of the generate() call on this thread since start()
+        self.stop()
+        passes = self._local.passes
+        if not passes:
+            return None
+        drafted = max(self._local.input_tokens - uncached_prompt_tokens - (passes - 1), 0)
+        # Every pass yields its accepted draft tokens plus one from the target
+        accepted = max(completion_tokens - passes, 0)
+        metrics.DRAFT_TOKENS.inc(drafted)
+        metrics.ACCEPTED_TOKENS.inc(accepted)
+        metrics.TOKENS_PER_PASS.observe(completion_tokens / passes)
+        return {
+            "mode": self.mode,
+            "target_passes": passes,
+            "draft_tokens": drafted,
+            "accepted_tokens": accepted,
+            "acceptance_rate": round(accepted / drafted, 4) if drafted else None,
+            "tokens_per_pass": round(completion_tokens / passes, 2),
+        }
+
+    def _count_pass(self, module, args, kwargs):
+        if not getattr(self._local, "active", False):
+            return
+        input_ids = kwargs.get("input_ids", args[0] if args else None)
+        if input_ids is not None:
+            self._local.passes += 1
+            self._local.input_tokens += input_ids.shape[-1]
@@ -0,0 +1,88 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import jsonify, request
+
+# Warmup: a few short generations run before the server reports ready, so
+# the first real request doesn't pay for allocator and kernel warmup.
+WARMUP_PROMPT = "Hello! Introduce yourself in one sentence."
+WARMUP_PROMPTS = int(os.getenv("WARMUP_PROMPTS", "1"))
+WARMUP_TOKENS = int(os.getenv("WARMUP_TOKENS", "8"))
+
+
+class ModelLoader:
+    # Loads the model on a background thread so the server answers health
+    # probes during the load. load(phase) does the loading and wraps each
+    # step in `with phase(name):` to record how long it took; warmup() is
+    # then run WARMUP_PROMPTS times.
+    def __init__(self, load, warmup=None, warmup_prompts=WARMUP_PROMPTS):
+        self.load = load
+        self.warmup = warmup
+        self.warmup_prompts = warmup_prompts
+        self.state = "starting"
+        self.error = None
+        self.timings = {}
+        self._thread = threading.Thread(target=self._run, name="model-loader", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = round(time.perf_counter() - start, 3)
+
+    def ready(self):
+        return self.state == "ready"
+
+    def status(self):
+        status = {"status": self.state, "timings": dict(self.timings)}
+        if self.error:
+            status["error"] = self.error
+        return status
+
+    def _run(self):
+        start = time.perf_counter()
+        try:
+            self.state = "loading"
+            self.load(self.phase)
+            if self.warmup is not None and self.warmup_prompts > 0:
+                self.state = "warming_up"
+                with self.phase("warmup"):
+                    for _ in range(self.warmup_prompts):
+                        self.warmup()
+        except Exception as e:
+            logging.exception("Model load failed")
+            self.error = str(e)
+            self.state = "failed"
+            return
+        self.timings["total"] = round(time.perf_counter() - start, 3)
+        self.state = "ready"
+        logging.info(f"Model ready: {self.timings}")
+
+
+def register_health_routes(app, loader, exempt=()):
+    # /healthz is liveness: the process is up and the load hasn't failed.
+    # /ready is readiness: the model is loaded and warmed up. Other routes
+    # (apart from `exempt`) get 503 until then.
+    @app.route("/healthz", methods=["GET"])
+    def healthz():
+        if loader.state == "failed":
+            return jsonify(loader.status()), 500
+        return jsonify({"status": "ok"})
+
+    @app.route("/ready", methods=["GET"])
+    def ready():
+        return jsonify(loader.status()), 200 if loader.ready() else 503
+
+    @app.before_request
+    def require_model():
+        if loader.ready() or request.endpoint in ("healthz", "ready") + tuple(exempt):
+            return None
+        return jsonify({"error": "Model is not ready"}), 503, {"Retry-After": "5"}
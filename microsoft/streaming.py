@@ -0,0 +1,48 @@
+import json
+import time
+
+
+def sse_event(data, event=None):
+    # Format one Server-Sent Event
+    message = f"event: {event}\n" if event else ""
+    return message + f"data: {json.dumps(data)}\n\n"
+
+
+class StreamTimer:
+    # Tracks time-to-first-token and decode rate of a streamed generation
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.first_token_at = None
+        self.end = None
+
+    def token(self):
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+
+    def finish(self):
+        self.end = time.perf_counter()
+
+    def timings(self, completion_tokens):
+        end = self.end or time.perf_counter()
+        timings = {
+            "time_to_first_token": None,
+            "total": round(end - self.start, 4),
+            "tokens_per_second": None,
+        }
+        if self.first_token_at is not None:
+            timings["time_to_first_token"] = round(self.first_token_at - self.start, 4)
+            decode_time = end - self.first_token_at
+            if decode_time > 0:
+                timings["tokens_per_second"] = round(completion_tokens / decode_time, 2)
+        return timings
+
+
+def replay_cached(timer, response, done):
+    # A cached response streamed as a single chunk, then the done event with
+    # the fields in done. Nothing was decoded, so there is no decode rate.
+    timer.token()
+    yield sse_event({"token": response})
+    timer.finish()
+    timings = timer.timings(0)
+    timings["tokens_per_second"] = None
+    yield sse_event(dict(done, timings=timings, cached=True), event="done")
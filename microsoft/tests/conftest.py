@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The servers import their modules from microsoft/ directly
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
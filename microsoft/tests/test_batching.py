@@ -0,0 +1,132 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+
+from backends import DummyBackend
+from batcher import DynamicBatcher
+from benchmark import PROMPTS
+from continuous_batching import ContinuousBatchScheduler
+
+MICROSOFT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class RecordingBackend(DummyBackend):
+    # DummyBackend that records the size of every decode step and which
+    # sequences it released
+    def __init__(self, **options):
+        super().__init__(**options)
+        self.step_sizes = []
+        self.released = []
+
+    def decode_step(self, seqs):
+        self.step_sizes.append(len(seqs))
+        return super().decode_step(seqs)
+
+    def release(self, seq):
+        self.released.append(seq.request)
+
+
+def result_within(request, timeout=5):
+    # request.result(), failing the test instead of hanging if it never ends
+    box = []
+    thread = threading.Thread(target=lambda: box.append(request.result()), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert box, "request never finished"
+    return box[0]
+
+
+def expected_text(prompt, max_new_tokens):
+    # What the dummy model generates for a prompt on its own
+    backend = DummyBackend(prefill_time=0, decode_time=0)
+    return "".join(backend.stream(prompt, max_new_tokens=max_new_tokens))
+
+
+def test_scheduler_batches_concurrent_requests():
+    backend = RecordingBackend(prefill_time=0, decode_time=0.002)
+    scheduler = ContinuousBatchScheduler(backend, max_batch_size=4)
+    requests = [scheduler.submit(prompt, max_new_tokens=16) for prompt in PROMPTS[:4]]
+
+    for prompt, request in zip(PROMPTS, requests):
+        assert result_within(request) == expected_text(prompt, 16)
+        assert request.completion_tokens == 16
+    assert max(backend.step_sizes) > 1
+    assert max(backend.step_sizes) <= 4
+    assert sorted(map(id, backend.released)) == sorted(map(id, requests))
+    assert scheduler.stats()["running"] == 0
+
+
+def test_scheduler_cancel_frees_slot():
+    backend = RecordingBackend(prefill_time=0, decode_time=0.002)
+    scheduler = ContinuousBatchScheduler(backend, max_batch_size=1)
+    long_request = scheduler.submit(PROMPTS[0], max_new_tokens=10_000)
+    next(iter(long_request))
+    waiting = scheduler.submit(PROMPTS[1], max_new_tokens=8)
+
+    long_request.cancel()
+    result_within(long_request)
+    assert long_request.completion_tokens < 10_000
+    assert long_request in backend.released
+    # The freed slot goes to the request that was waiting for it
+    assert result_within(waiting) == expected_text(PROMPTS[1], 8)
+
+
+def test_scheduler_finishes_requests_cancelled_while_waiting():
+    backend = RecordingBackend(prefill_time=0, decode_time=0.002)
+    scheduler = ContinuousBatchScheduler(backend, max_batch_size=1)
+    running = scheduler.submit(PROMPTS[0], max_new_tokens=10_000)
+    next(iter(running))
+    waiting = scheduler.submit(PROMPTS[1], max_new_tokens=8)
+
+    waiting.cancel()
+    running.cancel()
+    assert result_within(waiting) == ""
+    assert waiting.started_at is None
+    assert waiting not in backend.released
+
+
+def test_dynamic_batcher_finishes_requests_cancelled_while_queued():
+    batches = []
+    running = threading.Event()
+    release = threading.Event()
+
+    def run_batch(requests):
+        batches.append([request.prompt for request in requests])
+        running.set()
+        release.wait(5)
+        for request in requests:
+            request.emit(request.prompt.upper())
+
+    batcher = DynamicBatcher(run_batch, max_batch_size=2, window=0.01)
+    first = batcher.submit("first")
+    assert running.wait(5)
+    cancelled = batcher.submit("cancelled")
+    kept = batcher.submit("kept")
+    cancelled.cancel()
+    release.set()
+
+    assert result_within(first) == "FIRST"
+    assert result_within(cancelled) == ""
+    assert result_within(kept) == "KEPT"
+    assert batches == [["first"], ["kept"]]
+
+
+def test_benchmark_dummy_backend(tmp_path):
+    output = tmp_path / "report.json"
+    subprocess.run(
+        [
+            sys.executable, "benchmark.py",
+            "--backend", "dummy", "--max-new-tokens", "8", "--repeats", "2", "--output", str(output),
+        ],
+        cwd=MICROSOFT_DIR, check=True, capture_output=True, timeout=60,
+    )
+    report = json.loads(output.read_text())
+
+    summary = report["summary"]
+    assert summary["requests"] == 2 * len(PROMPTS)
+    assert summary["tokens_per_second"] > 0
+    assert all(result["completion_tokens"] == 8 for result in report["results"])
+    for name in ("time_to_first_token", "inter_token_latency", "end_to_end"):
+        assert summary[name]["p50"] is not None
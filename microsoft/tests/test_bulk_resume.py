@@ -0,0 +1,42 @@
+import json
+import os
+import sys
+
+import pytest
+
+# bulk.py sits next to the Phi-3.5 script rather than in microsoft/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Phi3.5"))
+from bulk import load_progress
+
+
+def write_results(path, ids, tail=""):
+    path.write_text("".join(json.dumps({"id": i, "response": "ok"}) + "\n" for i in ids) + tail)
+
+
+def test_load_progress_truncates_partial_last_line(tmp_path):
+    output = tmp_path / "out.jsonl"
+    write_results(output, [0, 1], tail='{"id": 2, "resp')
+    complete = output.read_text()[: -len('{"id": 2, "resp')]
+
+    done, skip_lines = load_progress(str(output), str(tmp_path / "missing.checkpoint"))
+    assert done == {0, 1}
+    assert skip_lines == 0
+    # The next result is appended on a line of its own
+    assert output.read_text() == complete
+
+
+def test_load_progress_drops_last_line_missing_its_newline(tmp_path):
+    output = tmp_path / "out.jsonl"
+    write_results(output, [0], tail='{"id": 1, "response": "ok"}')
+
+    done, _ = load_progress(str(output), str(tmp_path / "missing.checkpoint"))
+    assert done == {0}
+    assert output.read_text().endswith("\n")
+
+
+def test_load_progress_rejects_corrupt_line_before_the_end(tmp_path):
+    output = tmp_path / "out.jsonl"
+    output.write_text(json.dumps({"id": 0}) + "\nnot json\n" + json.dumps({"id": 1}) + "\n")
+
+    with pytest.raises(ValueError):
+        load_progress(str(output), str(tmp_path / "missing.checkpoint"))
@@ -0,0 +1,22 @@
+from response_cache import ResponseCache, cache_key
+
+PARAMS = {"max_new_tokens": 64, "do_sample": False}
+
+
+def test_internal_whitespace_is_part_of_the_key():
+    assert cache_key("a\nb", "model", PARAMS) != cache_key("a b", "model", PARAMS)
+    assert cache_key("def f():\n    pass", "model", PARAMS) != cache_key("def f():\n  pass", "model", PARAMS)
+
+
+def test_unicode_form_and_surrounding_whitespace_are_not():
+    composed = "caf\u00e9\nmenu"
+    decomposed = "cafe\u0301\nmenu"
+    assert cache_key(composed, "model", PARAMS) == cache_key(decomposed, "model", PARAMS)
+    assert cache_key("  hello\n", "model", PARAMS) == cache_key("hello", "model", PARAMS)
+
+
+def test_prompts_differing_in_layout_get_their_own_answers():
+    cache = ResponseCache()
+    cache.put(cache_key("- a\n- b", "model", PARAMS), {"response": "list"})
+    assert cache.get(cache_key("- a - b", "model", PARAMS)) is None
+    assert cache.get(cache_key("- a\n- b", "model", PARAMS)) == {"response": "list"}